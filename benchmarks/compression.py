@@ -0,0 +1,155 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+import os
+import random
+import shutil
+import struct
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from idarling.shared.commands import CHUNK_SIZE  # noqa: E402
+from idarling.shared.compression import (Decompressor,  # noqa: E402
+                                         compress_file)
+
+# The size of the code of the program, in MiB. The database is about six
+# times as large, as IDA stores a flags word for every byte.
+CODE_SIZE = 8
+PAGE_SIZE = 8192
+
+# Bandwidths of the links the database would be transferred over, in Mbit/s
+LINKS = (10, 100, 1000)
+
+
+def generate_code(rng, size):
+    """
+    Generate bytes that look like x86 code: a few common instructions, with
+    displacements and addresses taken from a small set.
+
+    :param rng: the random generator
+    :param size: the size in bytes
+    :return: the code
+    """
+    addresses = [struct.pack('<I', 0x401000 + rng.randrange(0x40000))
+                 for _ in range(512)]
+    displacements = [struct.pack('<b', rng.randrange(-128, 128))
+                     for _ in range(64)]
+    fragments = [b'\x55', b'\x5d', b'\xc3', b'\x90', b'\x50', b'\x58',
+                 b'\x89\xe5', b'\x31\xc0', b'\x85\xc0', b'\x74', b'\x75',
+                 b'\x8b\x45', b'\x89\x45', b'\x83\xec', b'\xff\x15', b'\xe8',
+                 b'\x68', b'\x8d\x4d', b'\x0f\x84', b'\x33\xd2']
+    parts = []
+    length = 0
+    while length < size:
+        fragment = rng.choice(fragments)
+        if fragment in (b'\xe8', b'\x68', b'\xff\x15', b'\x0f\x84'):
+            fragment += rng.choice(addresses)
+        elif len(fragment) == 2 or fragment in (b'\x74', b'\x75'):
+            fragment += rng.choice(displacements)
+        parts.append(fragment)
+        length += len(fragment)
+    return b''.join(parts)[:size]
+
+
+def generate_flags(code):
+    """
+    Generate the flags of every byte of the code, as stored by IDA: the
+    value of the byte, and whether it is the head of an instruction.
+
+    :param code: the code
+    :return: the flags
+    """
+    head = [struct.pack('<I', 0x600 | value) for value in range(256)]
+    tail = [struct.pack('<I', 0x400 | value) for value in range(256)]
+    return b''.join((tail if index & 3 else head)[value]
+                    for index, value in enumerate(bytearray(code)))
+
+
+def generate_names(rng, size):
+    """
+    Generate b-tree pages of names and addresses, with unused space at the
+    end of each page.
+
+    :param rng: the random generator
+    :param size: the size in bytes
+    :return: the pages
+    """
+    prefixes = [b'sub_', b'loc_', b'off_', b'dword_', b'unk_', b'a']
+    pages = []
+    while len(pages) * PAGE_SIZE < size:
+        page = []
+        length = 0
+        while length < PAGE_SIZE * 2 // 3:
+            ea = 0x401000 + rng.randrange(0x400000)
+            name = rng.choice(prefixes) + (b'%X' % ea)
+            record = struct.pack('<QH', ea, len(name)) + name
+            page.append(record)
+            length += len(record)
+        page = b''.join(page)
+        pages.append(page + b'\0' * (PAGE_SIZE - len(page)))
+    return b''.join(pages)[:size]
+
+
+def main():
+    rng = random.Random(0)
+    code = generate_code(rng, CODE_SIZE << 20)
+    flags = generate_flags(code)
+    names = generate_names(rng, CODE_SIZE << 20)
+    data = code + flags + names
+    print("Synthetic database: %d MiB (code %d, flags %d, names %d MiB)"
+          % (len(data) >> 20, len(code) >> 20, len(flags) >> 20,
+             len(names) >> 20))
+
+    filesDir = tempfile.mkdtemp()
+    try:
+        inputPath = os.path.join(filesDir, 'database.idb')
+        outputPath = inputPath + '.zlib'
+        with open(inputPath, 'wb') as inputFile:
+            inputFile.write(data)
+
+        # The file is compressed as the client does before uploading it
+        start = time.time()
+        compress_file(inputPath, outputPath)
+        compressTime = time.time() - start
+        with open(outputPath, 'rb') as outputFile:
+            compressed = outputFile.read()
+
+        # It is decompressed one chunk at a time, as the client downloads it
+        start = time.time()
+        decompressor = Decompressor()
+        output = []
+        for offset in range(0, len(compressed), CHUNK_SIZE):
+            output.append(decompressor.decompress(
+                compressed[offset:offset + CHUNK_SIZE]))
+        output.append(decompressor.flush())
+        decompressTime = time.time() - start
+        assert b''.join(output) == data
+    finally:
+        shutil.rmtree(filesDir)
+
+    size = float(len(data)) / (1 << 20)
+    print("Compressed to %.1f%% of the original size"
+          % (100.0 * len(compressed) / len(data)))
+    print("Compression %.0f MiB/s, decompression %.0f MiB/s"
+          % (size / compressTime, size / decompressTime))
+    for link in LINKS:
+        rate = link * 1e6 / 8
+        print("%5d Mbit/s: %6.1f s uncompressed, %6.1f s compressed"
+              % (link, len(data) / rate,
+                 len(compressed) / rate + compressTime + decompressTime))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from idarling.shared.database import Database  # noqa: E402
+from idarling.shared.models import Branch, Repository  # noqa: E402
+from idarling.shared.packets import JSONSerializer, Packet  # noqa: E402
+
+EVENTS = 5000
+
+EVENT = {'type': 'event', 'event_type': 'renamed', 'tick': 0,
+         'ea': 4198400, 'new_name': u'sub_401000_renamed',
+         'local_name': False}
+
+
+def make_event(tick):
+    """
+    Create an event as the server receives it, with its JSON payload.
+
+    :param tick: the tick of the event
+    :return: the event
+    """
+    dct = dict(EVENT, tick=tick)
+    payload = JSONSerializer.dumps(dct)
+    event = Packet.parse_packet(JSONSerializer.loads(payload), True)
+    event.payloads[JSONSerializer] = (tick, payload)
+    return event
+
+
+def insert_grouped(dbpath, synchronous, group):
+    """
+    Insert the events with the database of the server, committing them in
+    groups as the server does on its timer.
+
+    :param dbpath: the database path
+    :param synchronous: the synchronous level
+    :param group: the number of events per commit
+    :return: the number of events inserted per second
+    """
+    database = Database(dbpath, synchronous)
+    database.initialize()
+    database.insert_repo(Repository('repo', 'hash', 'file', 'type', 'date'))
+    database.insert_branch(Branch('repo', 'branch', 'date', 0))
+    database.commit()
+    events = [make_event(tick) for tick in range(1, EVENTS + 1)]
+    start = time.time()
+    for event in events:
+        database.insert_event('repo', 'branch', event)
+        if event.tick % group == 0:
+            database.commit()
+    database.commit()
+    elapsed = time.time() - start
+    database.close()
+    return EVENTS / elapsed
+
+
+def insert_autocommit(dbpath):
+    """
+    Insert the events as the server did before, with a rollback journal
+    and a transaction for every event.
+
+    :param dbpath: the database path
+    :return: the number of events inserted per second
+    """
+    conn = sqlite3.connect(dbpath)
+    conn.isolation_level = None
+    conn.execute('create table events (repo text not null, branch text not '
+                 'null, tick integer not null, dict text not null, '
+                 'primary key(repo, branch, tick));')
+    events = [make_event(tick) for tick in range(1, EVENTS + 1)]
+    start = time.time()
+    for event in events:
+        dct = json.dumps(dict(EVENT, tick=event.tick))
+        conn.execute('insert into events (repo, branch, tick, dict) values '
+                     '(?, ?, ?, ?);', ['repo', 'branch', event.tick, dct])
+    elapsed = time.time() - start
+    conn.close()
+    return EVENTS / elapsed
+
+
+def main():
+    filesDir = tempfile.mkdtemp()
+    try:
+        def dbpath(name):
+            return os.path.join(filesDir, '%s.db' % name)
+
+        print("%d events inserted" % EVENTS)
+        rate = insert_autocommit(dbpath('autocommit'))
+        print("%-40s %10.0f events/s" % ("Rollback journal, autocommit", rate))
+        for synchronous in ('normal', 'full'):
+            for group in (1, 10, 100, 1000):
+                rate = insert_grouped(dbpath('%s%d' % (synchronous, group)),
+                                      synchronous, group)
+                name = "WAL, synchronous=%s, %d per commit" \
+                    % (synchronous, group)
+                print("%-40s %10.0f events/s" % (name, rate))
+    finally:
+        shutil.rmtree(filesDir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+import logging
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from idarling.shared.framing import (FRAME_EVENT, FRAME_HEADER,  # noqa: E402
+                                     PROTOCOL_V1, PROTOCOL_V2, build_frame,
+                                     parse_header)
+from idarling.shared.loop import AsyncioLoop, set_loop  # noqa: E402
+from idarling.shared.packets import JSONSerializer  # noqa: E402
+from idarling.shared.server import ServerClient  # noqa: E402
+from idarling.shared.sockets import ServerSocket  # noqa: E402
+
+PEERS = 50
+NUMBER = 2000
+
+EVENT = {'type': 'event', 'event_type': 'cmt_changed', 'tick': 41,
+         'ea': 4198400, 'comment': u'checks the license key',
+         'rptble': False}
+
+
+def connection(server, protocol):
+    """
+    Create a server-side client using a protocol version, without socket.
+
+    :param server: the server
+    :param protocol: the protocol version
+    :return: the client
+    """
+    client = ServerClient(logging.getLogger('IDArling.Bench'), server)
+    client.protocol = protocol
+    client.serializer = JSONSerializer
+    return client
+
+
+def main():
+    set_loop(AsyncioLoop())
+    # The server only needs to be known, so that events are not decoded
+    # into the event classes of the plugin
+    server = ServerSocket(logging.getLogger('IDArling.Bench'))
+    sender = connection(server, PROTOCOL_V2)
+    payload = JSONSerializer.dumps(EVENT)
+    frame = build_frame(FRAME_EVENT, 0, JSONSerializer.__serializer_id__,
+                        EVENT['tick'], payload)
+    header = parse_header(frame[:FRAME_HEADER.size])
+
+    def fan_out(peers, cached=True):
+        # The server gives the event the next tick of the branch
+        event = sender._decode_packet(payload, header)
+        event.tick += 1
+        for peer in peers:
+            if not cached:
+                event.payloads.clear()
+            peer._encode_packet(event)
+
+    print("One event forwarded to %d clients" % PEERS)
+    for name, protocol, cached in (
+            ('Encoded for every client', PROTOCOL_V2, False),
+            ('Framed clients', PROTOCOL_V2, True),
+            ('Line-framed clients', PROTOCOL_V1, True)):
+        peers = [connection(server, protocol) for _ in range(PEERS)]
+        best = min(timeit.repeat(lambda: fan_out(peers, cached),
+                                 number=NUMBER, repeat=3))
+        print("%-26s %8.1f us" % (name, best / NUMBER * 1e6))
+
+
+if __name__ == '__main__':
+    main()
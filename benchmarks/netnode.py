@@ -0,0 +1,83 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# This benchmark must be run within IDA, with File > Script file, on a
+# scratch database: it writes to the netnode of the plugin, and restores
+# its values afterwards.
+import os
+import sys
+import time
+
+import ida_netnode
+
+from PyQt5.QtCore import QTimer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from idarling.core.core import Core  # noqa: E402
+
+EVENTS = 10000
+
+
+class BenchCore(Core):
+    """
+    A core module that is not installed, only its tick timer is set up.
+    """
+
+    def __init__(self):
+        Core.__init__(self, None)
+        self._tickTimer = QTimer()
+        self._tickTimer.setSingleShot(True)
+        self._tickTimer.setInterval(Core.TICK_SAVE_DELAY)
+        self._tickTimer.timeout.connect(self.save_netnode)
+
+
+def main():
+    node = ida_netnode.netnode(Core.NETNODE_NAME, 0, True)
+    keys = ('repo', 'branch', 'tick')
+    values = {key: node.hashval(key) for key in keys}
+    try:
+        core = BenchCore()
+        core.repo = 'benchmark'
+        core.branch = 'benchmark'
+
+        # Previously, the netnode was written for every event
+        start = time.time()
+        for tick in range(1, EVENTS + 1):
+            core.tick = tick
+            core.save_netnode()
+        before = time.time() - start
+
+        # Now, the tick is written once the timer fires, or before saving
+        start = time.time()
+        for tick in range(EVENTS + 1, 2 * EVENTS + 1):
+            core.tick = tick
+        core.save_netnode()
+        after = time.time() - start
+        assert node.hashval('tick') == str(2 * EVENTS)
+    finally:
+        for key in keys:
+            if values[key] is None:
+                node.hashdel(key)
+            else:
+                node.hashset(key, values[key])
+
+    print("%d tick updates" % EVENTS)
+    print("Written for every event: %8.1f us per event, %8.0f events/s"
+          % (before / EVENTS * 1e6, EVENTS / before))
+    print("Written behind a timer:  %8.1f us per event, %8.0f events/s"
+          % (after / EVENTS * 1e6, EVENTS / after))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from idarling.shared.buffers import ReadBuffer  # noqa: E402
+
+LINE = b'{"type": "event", "event_type": "renamed", "tick": 1, ' \
+       b'"ea": 4198400, "new_name": "sub_401000", "local_name": false}\n'
+LINES = 100000
+READ_SIZE = 65536
+
+
+def read_lines(data):
+    """
+    Split a burst of lines with the read buffer, fed as the socket is read.
+
+    :param data: the received bytes
+    :return: the number of lines
+    """
+    buf = ReadBuffer()
+    for pos in range(0, len(data), READ_SIZE):
+        buf.extend(data[pos:pos + READ_SIZE])
+    count = 0
+    while buf.readline() is not None:
+        count += 1
+    return count
+
+
+def read_lines_sliced(data):
+    """
+    Split a burst of lines as it was done before the read buffer, slicing
+    the rest of the received bytes after each line.
+
+    :param data: the received bytes
+    :return: the number of lines
+    """
+    buf = bytearray()
+    for pos in range(0, len(data), READ_SIZE):
+        buf.extend(data[pos:pos + READ_SIZE])
+    count = 0
+    while b'\n' in buf:
+        pos = buf.index(b'\n')
+        buf = buf[pos + 1:]
+        count += 1
+    return count
+
+
+def measure(func, lines):
+    """
+    Print the time taken by a function to split a burst of lines.
+
+    :param func: the function
+    :param lines: the number of lines
+    """
+    data = LINE * lines
+    start = time.time()
+    assert func(data) == lines
+    elapsed = time.time() - start
+    print("%-16s %7d lines %8.3f s %10.0f lines/s"
+          % (func.__name__, lines, elapsed, lines / elapsed))
+
+
+def main():
+    # The slicing is quadratic, it is only run on smaller bursts
+    for lines in (LINES // 20, LINES // 10, LINES // 5):
+        measure(read_lines_sliced, lines)
+    for lines in (LINES // 10, LINES // 5, LINES // 2, LINES):
+        measure(read_lines, lines)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from idarling.shared.packets import SerializerFactory  # noqa: E402
+
+NUMBER = 2000
+
+# The events of the plugin cannot be created outside of IDA, so these are
+# the dictionaries they are built into, with representative values
+LVAR = {
+    'll': {'location': {'atype': 1, 'reg1': 3, 'reg2': 0, 'stkoff': 0,
+                        'ea': 0},
+           'defea': 4198410},
+    'name': u'v1',
+    'type': [u'\x07', None, None],
+    'cmt': u'',
+    'flags': 3,
+}
+NUMFORM = {'flags': 0x1100000, 'opnum': 1, 'props': 0, 'serial': 0,
+           'org_nbytes': 4, 'type_name': u''}
+MEMBER_EXTRA = {'id': 0xff000012}
+
+EVENTS = {
+    'make_code': {'ea': 4198400},
+    'make_data': {'ea': 4198400, 'flags': 0x20000400, 'size': 4,
+                  'tid': 0xffffffff},
+    'renamed': {'ea': 4198400, 'new_name': u'sub_401000_renamed',
+                'local_name': False},
+    'func_added': {'start_ea': 4198400, 'end_ea': 4198512},
+    'deleting_func': {'start_ea': 4198400},
+    'set_func_start': {'start_ea': 4198400, 'new_start': 4198404},
+    'set_func_end': {'start_ea': 4198400, 'new_end': 4198520},
+    'func_tail_appended': {'start_ea_func': 4198400,
+                           'start_ea_tail': 4202496,
+                           'end_ea_tail': 4202528},
+    'func_tail_deleted': {'start_ea_func': 4198400, 'tail_ea': 4202496},
+    'tail_owner_changed': {'tail_ea': 4202496, 'owner_func': 4198400},
+    'cmt_changed': {'ea': 4198400, 'comment': u'checks the license key',
+                    'rptble': False},
+    'range_cmt_changed': {'kind': 1, 'a': [4198400, 4198512],
+                          'cmt': u'license checks', 'rptble': True},
+    'extra_cmt_changed': {'ea': 4198400, 'line_idx': 1000,
+                          'cmt': u'; anterior line'},
+    'ti_changed': {'ea': 4198400,
+                   'py_type': [u'\x0c\x10\x07\x07\x0a', u'\x02a\x02b']},
+    'local_types_changed': {'local_type': [
+        [1, u'\x0d\x31\x07\x07', u'\x02x\x02y', u'point_t'], None]},
+    'op_type_changed': {'ea': 4198400, 'n': 1, 'op': u'enum',
+                        'extra': {'ename': u'flags_t', 'serial': 0}},
+    'enum_created': {'enum': 0xff000010, 'name': u'flags_t'},
+    'enum_deleted': {'ename': u'flags_t'},
+    'enum_renamed': {'oldname': u'flags_t', 'newname': u'open_flags_t',
+                     'is_enum': True},
+    'enum_bf_changed': {'ename': u'flags_t', 'bf_flag': True},
+    'enum_cmt_changed': {'emname': u'flags_t', 'cmt': u'open(2) flags',
+                         'repeatable_cmt': False},
+    'enum_member_created': {'ename': u'flags_t', 'name': u'O_RDWR',
+                            'value': 2, 'bmask': 0xffffffff},
+    'enum_member_deleted': {'ename': u'flags_t', 'value': 2, 'serial': 0,
+                            'bmask': 0xffffffff},
+    'struc_created': {'struc': 0xff000011, 'name': u'context_t',
+                      'is_union': False},
+    'struc_deleted': {'sname': u'context_t'},
+    'struc_renamed': {'oldname': u'context_t', 'newname': u'ssl_context_t'},
+    'struc_cmt_changed': {'sname': u'context_t', 'smname': u'field_8',
+                          'cmt': u'the session', 'repeatable_cmt': False},
+    'struc_member_created': {'sname': u'context_t', 'fieldname': u'field_8',
+                             'offset': 8, 'flag': 0x60000400, 'nbytes': 8,
+                             'extra': MEMBER_EXTRA},
+    'struc_member_changed': {'sname': u'context_t', 'soff': 8, 'eoff': 16,
+                             'flag': 0x60000400, 'extra': MEMBER_EXTRA},
+    'struc_member_deleted': {'sname': u'context_t', 'offset': 8},
+    'struc_member_renamed': {'sname': u'context_t', 'offset': 8,
+                             'newname': u'session'},
+    'expanding_struc': {'sname': u'context_t', 'offset': 16, 'delta': 8},
+    'segm_added_event': {'name': u'.text', 'class_': u'CODE',
+                         'start_ea': 4198400, 'end_ea': 4263936,
+                         'orgbase': 0, 'align': 5, 'comb': 2, 'perm': 5,
+                         'bitness': 2, 'flags': 0x10},
+    'segm_deleted_event': {'ea': 4198400},
+    'segm_start_changed_event': {'newstart': 4198400, 'ea': 4198400},
+    'segm_end_changed_event': {'newend': 4263936, 'ea': 4198400},
+    'segm_name_changed_event': {'ea': 4198400, 'name': u'.text'},
+    'segm_class_changed_event': {'ea': 4198400, 'sclass': u'CODE'},
+    'segm_attrs_updated_event': {'ea': 4198400, 'perm': 5, 'bitness': 2},
+    'undefined': {'ea': 4198400},
+    'byte_patched': {'ea': 4198400, 'value': 0x90},
+    'user_labels': {'ea': 4198400, 'labels': [[1, u'retry'], [2, u'fail']]},
+    'user_cmts': {'ea': 4198400,
+                  'cmts': [[[4198410, 69], u'key length is checked here']]},
+    'user_iflags': {'ea': 4198400, 'iflags': [[[4198410, 73], 1]]},
+    'user_lvar_settings': {'ea': 4198400, 'lvar_settings': {
+        'lvvec': [LVAR] * 4, 'lmaps': [], 'stkoff_delta': 0,
+        'ulv_flags': 1}},
+    'user_numforms': {'ea': 4198400, 'numforms': [
+        [{'ea': 4198410, 'opnum': 1}, NUMFORM]]},
+}
+
+
+def packet(eventType):
+    """
+    Get the dictionary of an event as it is sent.
+
+    :param eventType: the event type
+    :return: the dictionary
+    """
+    dct = {'type': 'event', 'event_type': eventType, 'tick': 123456}
+    dct.update(EVENTS[eventType])
+    return dct
+
+
+def measure(serializer, dct):
+    """
+    Measure the size of an encoded event and the time taken to encode and
+    decode it.
+
+    :param serializer: the serializer
+    :param dct: the event dictionary
+    :return: the size, and the encoding and decoding times in microseconds
+    """
+    data = serializer.dumps(dct)
+    assert serializer.loads(data) == dct
+    encode = min(timeit.repeat(lambda: serializer.dumps(dct),
+                               number=NUMBER, repeat=3))
+    decode = min(timeit.repeat(lambda: serializer.loads(data),
+                               number=NUMBER, repeat=3))
+    return len(data), encode / NUMBER * 1e6, decode / NUMBER * 1e6
+
+
+def main():
+    names = ('json', 'msgpack')
+    serializers = [SerializerFactory.get_class(name) for name in names]
+    header = "".join("%8s %8s %8s" % (name, "enc us", "dec us")
+                     for name in names)
+    print("%-26s" % "event" + header)
+    totals = [[0, 0.0, 0.0] for _ in serializers]
+    for eventType in sorted(EVENTS):
+        line = "%-26s" % eventType
+        for serializer, total in zip(serializers, totals):
+            result = measure(serializer, packet(eventType))
+            line += "%7dB %8.2f %8.2f" % result
+            for i, value in enumerate(result):
+                total[i] += value
+        print(line)
+    print("%-26s" % "total" + "".join("%7dB %8.2f %8.2f" % tuple(total)
+                                      for total in totals))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from idarling.shared.loop import AsyncioLoop, set_loop  # noqa: E402
+from idarling.shared.server import Server, ServerClient  # noqa: E402
+
+CLIENTS = 1000
+BRANCHES = 100
+NUMBER = 1000
+
+
+class BenchServer(Server):
+    """
+    A server storing its files in a temporary directory.
+    """
+
+    def __init__(self, filesDir):
+        self._filesDir = filesDir
+        Server.__init__(self, logging.getLogger('IDArling.Bench'), None)
+
+    def local_file(self, filename):
+        return os.path.join(self._filesDir, filename)
+
+
+def subscribe(server, index):
+    """
+    Create a client subscribed to one of the branches.
+
+    :param server: the server
+    :param index: the index of the client
+    :return: the client
+    """
+    client = ServerClient(server._logger, server)
+    client._repo = 'repo'
+    client._branch = 'branch%d' % (index % BRANCHES)
+    server.register_client(client)
+    return client
+
+
+def main():
+    set_loop(AsyncioLoop())
+    filesDir = tempfile.mkdtemp()
+    server = BenchServer(filesDir)
+    try:
+        clients = [subscribe(server, index) for index in range(CLIENTS)]
+        client = clients[0]
+
+        # The filter that was used before the subscribers were indexed,
+        # going through all the clients
+        def should_forward(other):
+            return other is not client and other.repo == client.repo \
+                and other.branch == client.branch
+
+        def scan():
+            return list(filter(should_forward, list(server._clients)))
+
+        def lookup():
+            return list(client._peers())
+
+        def resubscribe():
+            server.unregister_client(client)
+            server.register_client(client)
+
+        assert set(scan()) == set(lookup())
+        print("%d clients across %d branches" % (CLIENTS, BRANCHES))
+        for name, func in (('Peers by scanning all clients', scan),
+                           ('Peers by branch lookup', lookup),
+                           ('Unregister and register', resubscribe)):
+            best = min(timeit.repeat(func, number=NUMBER, repeat=5))
+            print("%-30s %8.1f us" % (name, best / NUMBER * 1e6))
+    finally:
+        server.stop()
+        shutil.rmtree(filesDir)
+
+
+if __name__ == '__main__':
+    main()
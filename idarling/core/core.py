@@ -10,16 +10,28 @@
 
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
+import collections
+import itertools
 import logging
+import time
 
 import ida_idp
 import ida_kernwin
+import ida_loader
 import ida_netnode
 
+from PyQt5.QtCore import QTimer
+
 from ..module import Module
-from ..shared.commands import Subscribe, Unsubscribe
+from ..shared.commands import (GetRepositories, FlushEvents, Subscribe,
+                               Unsubscribe)
+from ..shared.compaction import Compactor
+from ..shared.framing import PROTOCOL_V3
+from ..shared.packets import Packet
 
+from .events import EventBatch
 from .hooks import Hooks, IDBHooks, IDPHooks, HexRaysHooks, ViewHooks, UIHooks
+from .journal import Journal
 
 logger = logging.getLogger('IDArling.Core')
 
@@ -30,6 +42,25 @@ class Core(Module):
     """
     NETNODE_NAME = '$ idarling'
 
+    # The events are sent in batches, once no event has been triggered for
+    # BATCH_IDLE milliseconds, or when the batch is full or too old. While
+    # the socket is busy, the events are kept in the queue where the later
+    # ones can supersede the earlier ones. The rules are the ones of the
+    # server compaction, so the events that must be applied in order, like
+    # the extra comments, are always sent in the order they happened.
+    BATCH_IDLE = 20
+    BATCH_MAX_AGE = 0.5
+    BATCH_MAX_SIZE = 256
+
+    # The events produced while disconnected are recorded into a journal
+    # stored next to the database, and sent in batches once reconnected.
+    JOURNAL_SUFFIX = '.journal'
+
+    # The tick is written to the netnode at most once every TICK_SAVE_DELAY
+    # milliseconds. The netnode is only written to disk when the database
+    # is saved, so it is always saved before that, and when it is closed.
+    TICK_SAVE_DELAY = 1000
+
     def __init__(self, plugin):
         super(Core, self).__init__(plugin)
         self._hooked = False
@@ -47,11 +78,35 @@ class Core(Module):
         self._repo = None
         self._branch = None
         self._tick = 0
+        self._tickTimer = None
+
+        # Batching members
+        self._events = collections.OrderedDict()
+        self._eventsIds = itertools.count()
+        self._eventsTime = None
+        self._eventsReady = False
+        self._compactor = Compactor()
+        self._batchTimer = None
+
+        # Journal members
+        self._journal = None
+        self._journalSending = False
+        self._journalAcked = None  # Does the server acknowledge the pages?
 
     def _install(self):
         logger.debug("Installing hooks")
         core = self
 
+        self._batchTimer = QTimer()
+        self._batchTimer.setSingleShot(True)
+        self._batchTimer.setInterval(Core.BATCH_IDLE)
+        self._batchTimer.timeout.connect(self._events_ready)
+
+        self._tickTimer = QTimer()
+        self._tickTimer.setSingleShot(True)
+        self._tickTimer.setInterval(Core.TICK_SAVE_DELAY)
+        self._tickTimer.timeout.connect(self.save_netnode)
+
         self._idbHooks = IDBHooks(self._plugin)
         self._idpHooks = IDPHooks(self._plugin)
         self._hxeHooks = HexRaysHooks(self._plugin)
@@ -75,8 +130,14 @@ class Core(Module):
                     self._plugin.network.send_packet(Subscribe(
                         core.repo, core.branch, core.tick,
                         self._plugin.interface.painter.color,
-                        self._plugin.interface.painter.name))
+                        self._plugin.interface.painter.name,
+                        self._plugin.config["serializer"]))
                     core.hook_all()
+                    core.send_journal()
+
+            def saving(self):
+                # Write the pending tick before the database is written
+                core.save_netnode()
 
         self._uiHooksCore = UIHooksCore(self._plugin)
         self._uiHooksCore.hook()
@@ -91,12 +152,18 @@ class Core(Module):
                 Hooks.__init__(self, plugin)
 
             def closebase(self):
+                core.flush_events()
+                core.save_netnode()
                 name = self._plugin.interface.painter.name
                 self._plugin.network.send_packet(Unsubscribe(name))
                 core.unhook_all()
+                core._journal = None
+                core._journalSending = False
                 core.repo = None
                 core.branch = None
-                core.ticks = 0
+                # The pending tick was written above, so it is reset without
+                # starting the timer, which would fire in the next database
+                core._tick = 0
                 return 0
 
         self._idbHooksCore = IDBHooksCore(self._plugin)
@@ -105,6 +172,9 @@ class Core(Module):
 
     def _uninstall(self):
         logger.debug("Uninstalling hooks")
+        self.flush_events()
+        if self._tickTimer.isActive():
+            self.save_netnode()
         self._idbHooksCore.unhook()
         self._uiHooksCore.unhook()
         self.unhook_all()
@@ -136,6 +206,173 @@ class Core(Module):
         self._uiHooks.unhook()
         self._hooked = False
 
+    def send_event(self, event):
+        """
+        Queue an event to be sent to the server. Bulk operations trigger many
+        events in a row, so they are coalesced and sent together.
+
+        :param event: the event
+        """
+        if not self._events:
+            self._eventsTime = time.time()
+
+        # Remove the queued event that this one supersedes, if any
+        eventId = next(self._eventsIds)
+        dct = dict(event.__dict__, event_type=event.__event__)
+        superseded = self._compactor.add(dct, eventId)
+        if superseded is not None:
+            self._events.pop(superseded, None)
+        self._events[eventId] = event
+
+        if len(self._events) >= Core.BATCH_MAX_SIZE:
+            self.flush_events()
+        elif time.time() - self._eventsTime >= Core.BATCH_MAX_AGE:
+            self._events_ready()
+        else:
+            self._batchTimer.start()  # Restart the idle delay
+
+    def _events_ready(self):
+        """
+        Called when the queued events should be sent. They are only sent
+        once the socket has written all its pending packets.
+        """
+        client = self._plugin.network.client
+        if client and client.sending:
+            self._eventsReady = True
+        else:
+            self.flush_events()
+
+    def notify_drained(self):
+        """
+        Called when the socket has written all its pending packets.
+        """
+        if self._journalSending:
+            # Older servers don't acknowledge the pages of the journal, so
+            # they are committed once written
+            if self._journalAcked is False:
+                self._journal.commit()
+                self._send_journal_page()
+            if self._journalSending:
+                return
+        if self._eventsReady:
+            self.flush_events()
+
+    def flush_events(self):
+        """
+        Send the queued events, wrapped into a batch if there are several.
+        While disconnected, or while the journal is being sent, they are
+        appended to the journal instead so that their order is preserved.
+        """
+        self._batchTimer.stop()
+        self._eventsReady = False
+        self._compactor = Compactor()
+        if not self._events:
+            return
+        events = list(self._events.values())
+        self._events.clear()
+
+        journal = self.journal
+        if journal and (not self._plugin.network.connected
+                        or self._journalSending or journal.pending):
+            journal.append(event.build_packet() for event in events)
+            logger.debug("Journaled %d events" % len(events))
+            return
+        self._send_events(events)
+
+    def _send_events(self, events):
+        """
+        Send some events to the server. They are wrapped into a batch if the
+        server knows about batches, since version 3 of the protocol, as it
+        then sends their events one by one to the older clients.
+
+        :param events: the events or their dictionaries
+        """
+        client = self._plugin.network.client
+        if len(events) > 1 and client.protocol >= PROTOCOL_V3:
+            self._plugin.network.send_packet(EventBatch(events))
+            return
+        for event in events:
+            if isinstance(event, dict):
+                event = Packet.parse_packet(event)
+            self._plugin.network.send_packet(event)
+
+    @property
+    def journal(self):
+        """
+        Get the journal of the current database, if it is being shared.
+
+        :return: the journal or None
+        """
+        if not self._repo or not self._branch:
+            return None
+        if self._journal is None:
+            idbPath = ida_loader.get_path(ida_loader.PATH_TYPE_IDB)
+            if not idbPath:
+                return None
+            self._journal = Journal(idbPath + Core.JOURNAL_SUFFIX)
+        return self._journal
+
+    def send_journal(self):
+        """
+        Start sending the events recorded into the journal, if any. The
+        server is asked for its protocol version first, to know if it can
+        acknowledge the pages once their events have been committed.
+        """
+        journal = self.journal
+        if self._journalSending or not journal or not journal.pending:
+            return
+        logger.info("Sending the events recorded while disconnected")
+        self._journalSending = True
+        self._journalAcked = None
+        d = self._plugin.network.send_packet(GetRepositories.Query())
+        d.add_callback(self._journal_protocol_received)
+        d.add_errback(logger.exception)
+
+    def _journal_protocol_received(self, reply):
+        """
+        Called when the server has replied with its protocol version.
+
+        :param reply: the reply from the server
+        """
+        if not self._journalSending:
+            return  # The connection was lost meanwhile
+        self._journalAcked = reply.protocol >= PROTOCOL_V3
+        self._send_journal_page()
+
+    def _send_journal_page(self):
+        """
+        Send the next page of the journal, or stop once it is empty. The
+        next page is sent once the server has acknowledged this one, or once
+        it has been written for older servers.
+        """
+        dcts = self._journal.read(Core.BATCH_MAX_SIZE)
+        if not dcts:
+            self._journal.clear()
+            self._journalSending = False
+            return
+        self._send_events(dcts)
+        if self._journalAcked:
+            d = self._plugin.network.send_packet(FlushEvents.Query())
+            d.add_callback(self._journal_page_committed)
+            d.add_errback(logger.exception)
+
+    def _journal_page_committed(self, reply):
+        """
+        Called when the server has committed the events of a page.
+
+        :param reply: the reply from the server
+        """
+        if not self._journalSending:
+            return  # The connection was lost meanwhile
+        if reply.committed:
+            self._journal.commit()
+        else:
+            logger.warning("Server could not commit the events, resending")
+            self._journal.rewind()
+        self._send_journal_page()
+        if not self._journalSending and self._eventsReady:
+            self.flush_events()
+
     @property
     def repo(self):
         """
@@ -186,12 +423,13 @@ class Core(Module):
     @tick.setter
     def tick(self, tick):
         """
-        Set the current tick.
+        Set the current tick. It is saved to the netnode after a delay.
 
         :param tick: the tick
         """
         self._tick = tick
-        self.save_netnode()
+        if not self._tickTimer.isActive():
+            self._tickTimer.start()
 
     def load_netnode(self):
         """
@@ -209,6 +447,7 @@ class Core(Module):
         """
         Save members to the custom netnode.
         """
+        self._tickTimer.stop()
         node = ida_netnode.netnode(Core.NETNODE_NAME, 0, True)
         if self._repo:
             node.hashset('repo', str(self._repo))
@@ -224,6 +463,16 @@ class Core(Module):
         if self._repo and self._branch:
             color = self._plugin.interface.painter.color
             name = self._plugin.interface.painter.name
+            serializer = self._plugin.config["serializer"]
             self._plugin.network.send_packet(
-                Subscribe(self._repo, self._branch, self._tick, color, name))
+                Subscribe(self._repo, self._branch, self._tick, color, name,
+                          serializer))
             self.hook_all()
+            self.send_journal()
+
+    def notify_disconnected(self):
+        # The page being sent might not have reached the server
+        if self._journalSending:
+            self._journal.rewind()
+            self._journalSending = False
+            self._journalAcked = None
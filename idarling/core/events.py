@@ -27,7 +27,9 @@ import ida_struct
 import ida_typeinf
 import ida_ua
 
-from ..shared.packets import DefaultEvent
+from PyQt5.QtCore import QTimer
+
+from ..shared.packets import DefaultEvent, Packet
 
 logger = logging.getLogger('IDArling.Core')
 
@@ -89,6 +91,29 @@ class Event(DefaultEvent):
         raise NotImplementedError("__call__() not implemented")
 
 
+class EventBatch(Event):
+    """
+    An envelope holding a sequence of events that were coalesced on the
+    client. It is stored and forwarded by the server as a single event.
+    The events can also be given as dictionaries, as read from the journal.
+    """
+    __event__ = 'event_batch'
+
+    def __init__(self, events):
+        super(EventBatch, self).__init__()
+        self.events = [event if isinstance(event, dict)
+                       else event.build_packet() for event in events]
+
+    def __call__(self):
+        for dct in self.events:
+            event = Packet.parse_packet(dct)
+            try:
+                event()
+            except Exception as e:
+                logger.warning("Error while calling batched event")
+                logger.exception(e)
+
+
 class MakeCodeEvent(Event):
     __event__ = 'make_code'
 
@@ -781,19 +806,77 @@ class BytePatchedEvent(Event):
 
 
 class HexRaysEvent(Event):
+    # The pseudocode views are not refreshed by the events themselves, but
+    # once control returns to the event loop. This way, a batch of events
+    # affecting the same function only refreshes its views once.
+    PSEUDOCODE_VIEWS = ['Pseudocode-%c' % chr(ord('A') + i)
+                        for i in range(26)]
+    _pending_funcs = set()
+
+    # The functions whose user data was set by these events. The Hex-Rays
+    # hooks forget their digests, so that the next printing of such a
+    # function is not taken for a change made by the user. Past
+    # APPLIED_FUNCS_SIZE functions, they forget all of them instead.
+    APPLIED_FUNCS_SIZE = 256
+    applied_funcs = set()
+    applied_all = False
+
+    @staticmethod
+    def refresh_pseudocode_view(ea):
+        """
+        Schedule the refresh of the pseudocode views showing a function.
+
+        :param ea: the start address of the function
+        """
+        if not HexRaysEvent.applied_all:
+            HexRaysEvent.applied_funcs.add(ea)
+            if len(HexRaysEvent.applied_funcs) > \
+                    HexRaysEvent.APPLIED_FUNCS_SIZE:
+                HexRaysEvent.applied_funcs.clear()
+                HexRaysEvent.applied_all = True
+        if not HexRaysEvent._pending_funcs:
+            QTimer.singleShot(0, HexRaysEvent._refresh_pseudocode_views)
+        HexRaysEvent._pending_funcs.add(ea)
 
     @staticmethod
-    def refresh_pseudocode_view():
+    def _refresh_pseudocode_views(funcs=None):
         """
-        Refresh the pseudocode view in IDA.
+        Refresh the pseudocode views showing one of the given functions, or
+        one of the pending functions if none are given. The pending user
+        iflags are set first.
+
+        :param funcs: the start addresses of the functions
         """
-        names = ['Pseudocode-%c' % chr(ord('A') + i) for i in range(5)]
-        for name in names:
+        if funcs is None:
+            funcs = set(HexRaysEvent._pending_funcs)
+            HexRaysEvent._pending_funcs.clear()
+            UserIflagsEvent.save_pending_iflags()
+        for name in HexRaysEvent.PSEUDOCODE_VIEWS:
             widget = ida_kernwin.find_widget(name)
-            if widget:
-                vu = ida_hexrays.get_widget_vdui(widget)
+            if not widget:
+                continue
+            vu = ida_hexrays.get_widget_vdui(widget)
+            if vu and vu.cfunc and vu.cfunc.entry_ea in funcs:
                 vu.refresh_view(True)
 
+    @staticmethod
+    def decompile(ea):
+        """
+        Decompile a function, without using the cached decompilation.
+
+        :param ea: the start address of the function
+        :return: the decompiled function
+        """
+        if hasattr(ida_hexrays, 'mark_cfunc_dirty'):
+            ida_hexrays.mark_cfunc_dirty(ea)
+        elif hasattr(ida_hexrays, 'DECOMP_NO_CACHE'):
+            return ida_hexrays.decompile(ea, None,
+                                         ida_hexrays.DECOMP_NO_CACHE)
+        else:
+            # The views showing the function decompile it again
+            HexRaysEvent._refresh_pseudocode_views({ea})
+        return ida_hexrays.decompile(ea)
+
 
 class UserLabelsEvent(HexRaysEvent):
     __event__ = 'user_labels'
@@ -809,7 +892,7 @@ class UserLabelsEvent(HexRaysEvent):
             name = Event.encode(name)
             ida_hexrays.user_labels_insert(labels, org_label, name)
         ida_hexrays.save_user_labels(self.ea, labels)
-        HexRaysEvent.refresh_pseudocode_view()
+        HexRaysEvent.refresh_pseudocode_view(self.ea)
 
 
 class UserCmtsEvent(HexRaysEvent):
@@ -828,11 +911,12 @@ class UserCmtsEvent(HexRaysEvent):
             tl.itp = tl_itp
             cmts.insert(tl, ida_hexrays.citem_cmt_t(Event.encode(cmt)))
         ida_hexrays.save_user_cmts(self.ea, cmts)
-        HexRaysEvent.refresh_pseudocode_view()
+        HexRaysEvent.refresh_pseudocode_view(self.ea)
 
 
 class UserIflagsEvent(HexRaysEvent):
     __event__ = 'user_iflags'
+    _pending_iflags = {}
 
     def __init__(self, ea, iflags):
         super(UserIflagsEvent, self).__init__()
@@ -840,22 +924,34 @@ class UserIflagsEvent(HexRaysEvent):
         self.iflags = iflags
 
     def __call__(self):
-        # FIXME: Hey-Rays bindings are broken
-        # iflags = ida_hexrays.user_iflags_new()
-        # for (cl_ea, cl_op), f in self.iflags:
-        #     cl = ida_hexrays.citem_locator_t(cl_ea, cl_op)
-        #     iflags.insert(cl, f)
-        # ida_hexrays.save_user_iflags(self.ea, iflags)
-
-        ida_hexrays.save_user_iflags(self.ea, ida_hexrays.user_iflags_new())
-        HexRaysEvent.refresh_pseudocode_view()
+        # The flags are set through a decompilation of the function, so
+        # they are only set once for all the events of the function
+        UserIflagsEvent._pending_iflags[self.ea] = self.iflags
+        HexRaysEvent.refresh_pseudocode_view(self.ea)
 
-        cfunc = ida_hexrays.decompile(self.ea)
-        for (cl_ea, cl_op), f in self.iflags:
-            cl = ida_hexrays.citem_locator_t(cl_ea, cl_op)
-            cfunc.set_user_iflags(cl, f)
-        cfunc.save_user_iflags()
-        HexRaysEvent.refresh_pseudocode_view()
+    @staticmethod
+    def save_pending_iflags():
+        """
+        Set the last user iflags received for every function.
+        """
+        pending = UserIflagsEvent._pending_iflags
+        UserIflagsEvent._pending_iflags = {}
+        for ea, iflags in pending.items():
+            # FIXME: Hey-Rays bindings are broken
+            # user_iflags = ida_hexrays.user_iflags_new()
+            # for (cl_ea, cl_op), f in iflags:
+            #     cl = ida_hexrays.citem_locator_t(cl_ea, cl_op)
+            #     user_iflags.insert(cl, f)
+            # ida_hexrays.save_user_iflags(ea, user_iflags)
+
+            # The decompilation must not be the cached one holding the
+            # previous flags
+            ida_hexrays.save_user_iflags(ea, ida_hexrays.user_iflags_new())
+            cfunc = HexRaysEvent.decompile(ea)
+            for (cl_ea, cl_op), f in iflags:
+                cl = ida_hexrays.citem_locator_t(cl_ea, cl_op)
+                cfunc.set_user_iflags(cl, f)
+            cfunc.save_user_iflags()
 
 
 class UserLvarSettingsEvent(HexRaysEvent):
@@ -884,7 +980,7 @@ class UserLvarSettingsEvent(HexRaysEvent):
         lvinf.stkoff_delta = self.lvar_settings['stkoff_delta']
         lvinf.ulv_flags = self.lvar_settings['ulv_flags']
         ida_hexrays.save_user_lvar_settings(self.ea, lvinf)
-        HexRaysEvent.refresh_pseudocode_view()
+        HexRaysEvent.refresh_pseudocode_view(self.ea)
 
     @staticmethod
     def _get_lvar_saved_info(dct):
@@ -958,4 +1054,4 @@ class UserNumformsEvent(HexRaysEvent):
             nf.type_name = Event.encode(_nf['type_name'])
             ida_hexrays.user_numforms_insert(numforms, ol, nf)
         ida_hexrays.save_user_numforms(self.ea, numforms)
-        HexRaysEvent.refresh_pseudocode_view()
+        HexRaysEvent.refresh_pseudocode_view(self.ea)
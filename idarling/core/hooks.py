@@ -10,13 +10,15 @@
 
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
+import collections
+import hashlib
+import json
 import logging
 
 import ida_bytes
 import ida_enum
 import ida_funcs
 import ida_hexrays
-import ida_idaapi
 import ida_idp
 import ida_kernwin
 import ida_nalt
@@ -25,6 +27,8 @@ import ida_segment
 import ida_struct
 import ida_typeinf
 
+from PyQt5.QtCore import QTimer
+
 from .events import *
 from ..shared.commands import UpdateCursors
 
@@ -46,11 +50,12 @@ class Hooks(object):
 
     def _send_event(self, event):
         """
-        Send an event to the other clients through the server.
+        Send an event to the other clients through the server. The event is
+        queued by the core module, so that bursts of events are batched.
 
         :param event: the event to send
         """
-        self._plugin.network.send_packet(event)
+        self._plugin.core.send_event(event)
 
 
 class IDBHooks(Hooks, ida_idp.IDB_Hooks):
@@ -61,7 +66,7 @@ class IDBHooks(Hooks, ida_idp.IDB_Hooks):
     def __init__(self, plugin):
         ida_idp.IDB_Hooks.__init__(self)
         Hooks.__init__(self, plugin)
-        self.last_local_type = None
+        self._local_types = None  # Digests of the types, by ordinal
 
     def make_code(self, insn):
         self._send_event(MakeCodeEvent(insn.ea))
@@ -124,50 +129,79 @@ class IDBHooks(Hooks, ida_idp.IDB_Hooks):
         return 0
 
     def local_types_changed(self):
-        local_types = []
-        for ordinal in range(1, ida_typeinf.get_ordinal_qty(None)):
+        # Only the raw types are compared, using their digests, so that the
+        # cost of a notification is low even with many local types. Only
+        # the types that changed are deserialized and serialized again.
+        first = self._local_types is None
+        if first:
+            self._local_types = []
+        digests = self._local_types
+
+        count = max(ida_typeinf.get_ordinal_qty(None) - 1, 0)
+        del digests[count:]
+        sent_types = []
+        for ordinal in range(1, count + 1):
             ret = ida_typeinf.idc_get_local_type_raw(ordinal)
             if ret is not None:
-                type_str, fields_str = ret
                 type_name = ida_typeinf.get_numbered_type_name(
                                 ida_typeinf.cvar.idati, ordinal)
-                cur_ti = ida_typeinf.tinfo_t()
-                cur_ti.deserialize(ida_typeinf.cvar.idati, type_str,
-                                   fields_str)
-                type_serialized = cur_ti.serialize()
-                local_types.append((ordinal, type_serialized[0],
-                                    type_serialized[1],
-                                    type_name))
+                type_digest = IDBHooks._type_digest(ret, type_name)
             else:
-                local_types.append(None)
-        sent_types = []
-        if self.last_local_type is None:
-            self.last_local_type = local_types
-            sent_types = local_types
-        else:
-            def differ_local_types(types1, types2):
-                # [(i, types1, types2), ...]
-                ret_types = []
-                for i in range(max([len(types1), len(types2)])):
-                    if i >= len(types1):
-                        ret_types.append((i, None, types2[i]))
-                    elif i >= len(types2):
-                        ret_types.append((i, types1[i], None))
-                    else:
-                        if types1[i] != types2[i]:
-                            ret_types.append((i, types1[i], types2[i]))
-                return ret_types
-            diff = differ_local_types(self.last_local_type, local_types)
-            self.last_local_type = local_types
-            if len(diff) == 1 and diff[0][2] is None:
-                return 0
-            elif len(diff) == 0:
-                return 0
-            sent_types = [t[2] for t in diff]
-
-        self._send_event(LocalTypesChangedEvent(sent_types))
+                type_digest = None
+
+            if ordinal > len(digests):
+                digests.append(type_digest)
+            elif digests[ordinal - 1] != type_digest or first:
+                digests[ordinal - 1] = type_digest
+            else:
+                continue
+
+            # Deleted types are not sent
+            if ret is not None:
+                sent_types.append(self._serialize_local_type(ordinal, ret,
+                                                             type_name))
+
+        if sent_types:
+            self._send_event(LocalTypesChangedEvent(sent_types))
         return 0
 
+    @staticmethod
+    def _type_digest(ret, type_name):
+        """
+        Compute the digest of a local type. Each string is prefixed by its
+        length, so that different types are never digested the same way.
+
+        :param ret: the raw type and fields strings
+        :param type_name: the name of the type
+        :return: the digest
+        """
+        digest = hashlib.sha1()
+        for part in (ret[0], ret[1], type_name):
+            if part is None:
+                digest.update(b'-')
+                continue
+            if not isinstance(part, bytes):
+                part = part.encode('utf-8')
+            digest.update(('%d:' % len(part)).encode('ascii'))
+            digest.update(part)
+        return digest.digest()
+
+    @staticmethod
+    def _serialize_local_type(ordinal, ret, type_name):
+        """
+        Serialize a local type into the format expected by the event.
+
+        :param ordinal: the ordinal of the type
+        :param ret: the raw type and fields strings
+        :param type_name: the name of the type
+        :return: the serialized type
+        """
+        type_str, fields_str = ret
+        cur_ti = ida_typeinf.tinfo_t()
+        cur_ti.deserialize(ida_typeinf.cvar.idati, type_str, fields_str)
+        type_serialized = cur_ti.serialize()
+        return ordinal, type_serialized[0], type_serialized[1], type_name
+
     def op_type_changed(self, ea, n):
         def gather_enum_info(ea, n):
             id = ida_bytes.get_enum_id(ea, n)[0]
@@ -444,17 +478,23 @@ class HexRaysHooks(Hooks):
     """
     The concrete class for Hex-Rays-related events.
     """
+    CACHE_SIZE = 1024
 
     def __init__(self, plugin):
         super(HexRaysHooks, self).__init__(plugin)
         self._available = None
         self._installed = False
-        self._funcEA = ida_idaapi.BADADDR
-        self._labels = {}
-        self._cmts = {}
-        self._iflags = {}
-        self._lvar_settings = {}
-        self._numforms = {}
+        # Digests of the user data of the last printed functions, by start
+        # address, in least recently printed order
+        self._funcs = collections.OrderedDict()
+        self._user_data = [
+            ('labels', HexRaysHooks._get_user_labels, UserLabelsEvent),
+            ('cmts', HexRaysHooks._get_user_cmts, UserCmtsEvent),
+            ('iflags', HexRaysHooks._get_user_iflags, UserIflagsEvent),
+            ('lvar_settings', HexRaysHooks._get_user_lvar_settings,
+             UserLvarSettingsEvent),
+            ('numforms', HexRaysHooks._get_user_numforms, UserNumformsEvent),
+        ]
 
     def hook(self):
         if self._available is None:
@@ -477,26 +517,65 @@ class HexRaysHooks(Hooks):
             return 0
 
         if event == ida_hexrays.hxe_func_printed:
+            self._forget_applied_funcs()
             ea = ida_kernwin.get_screen_ea()
             func = ida_funcs.get_func(ea)
             if func is None:
                 return
 
-            if self._funcEA != func.startEA:
-                self._funcEA = func.startEA
-                self._labels = HexRaysHooks._get_user_labels(self._funcEA)
-                self._cmts = HexRaysHooks._get_user_cmts(self._funcEA)
-                self._iflags = HexRaysHooks._get_user_iflags(self._funcEA)
-                self._lvar_settings = \
-                    HexRaysHooks._get_user_lvar_settings(self._funcEA)
-                self._numforms = HexRaysHooks._get_user_numforms(self._funcEA)
-            self._send_user_labels(func.startEA)
-            self._send_user_cmts(func.startEA)
-            self._send_user_iflags(func.startEA)
-            self._send_user_lvar_settings(func.startEA)
-            self._send_user_numforms(func.startEA)
+            self._send_user_data(func.startEA)
         return 0
 
+    def _send_user_data(self, ea):
+        """
+        Send the categories of user data of a function that changed since
+        it was last printed. The first time a function is printed, its
+        state is only recorded.
+
+        :param ea: the start address of the function
+        """
+        digests = self._funcs.pop(ea, None)
+        first = digests is None
+        if first:
+            digests = {}
+        for category, get_user_data, event_cls in self._user_data:
+            data = get_user_data(ea)
+            digest = HexRaysHooks._digest(data)
+            if not first and digests.get(category) != digest:
+                self._send_event(event_cls(ea, data))
+            digests[category] = digest
+
+        # Insert the function back as the most recently printed one
+        self._funcs[ea] = digests
+        while len(self._funcs) > HexRaysHooks.CACHE_SIZE:
+            self._funcs.popitem(last=False)
+
+    def _forget_applied_funcs(self):
+        """
+        Forget the digests of the functions whose user data was set by
+        remote events. Their user data is only recorded the next time they
+        are printed, like the first time, so that it isn't sent back.
+        """
+        if HexRaysEvent.applied_all:
+            self._funcs.clear()
+            HexRaysEvent.applied_all = False
+        for ea in HexRaysEvent.applied_funcs:
+            self._funcs.pop(ea, None)
+        HexRaysEvent.applied_funcs.clear()
+
+    @staticmethod
+    def _digest(data):
+        """
+        Compute the digest of some user data.
+
+        :param data: the user data
+        :return: the digest
+        """
+        dump = json.dumps(data, sort_keys=True)
+        if not isinstance(dump, bytes):
+            dump = dump.encode('utf-8')
+        return hashlib.sha1(dump).digest()
+
     @staticmethod
     def _get_user_labels(ea):
         user_labels = ida_hexrays.restore_user_labels(ea)
@@ -512,12 +591,6 @@ class HexRaysHooks(Hooks):
         ida_hexrays.user_labels_free(user_labels)
         return labels
 
-    def _send_user_labels(self, ea):
-        labels = HexRaysHooks._get_user_labels(ea)
-        if labels != self._labels:
-            self._send_event(UserLabelsEvent(ea, labels))
-            self._labels = labels
-
     @staticmethod
     def _get_user_cmts(ea):
         user_cmts = ida_hexrays.restore_user_cmts(ea)
@@ -533,12 +606,6 @@ class HexRaysHooks(Hooks):
         ida_hexrays.user_cmts_free(user_cmts)
         return cmts
 
-    def _send_user_cmts(self, ea):
-        cmts = HexRaysHooks._get_user_cmts(ea)
-        if cmts != self._cmts:
-            self._send_event(UserCmtsEvent(ea, cmts))
-            self._cmts = cmts
-
     @staticmethod
     def _get_user_iflags(ea):
         user_iflags = ida_hexrays.restore_user_iflags(ea)
@@ -562,12 +629,6 @@ class HexRaysHooks(Hooks):
         ida_hexrays.user_iflags_free(user_iflags)
         return iflags
 
-    def _send_user_iflags(self, ea):
-        iflags = HexRaysHooks._get_user_iflags(ea)
-        if iflags != self._iflags:
-            self._send_event(UserIflagsEvent(ea, iflags))
-            self._iflags = iflags
-
     @staticmethod
     def _get_user_lvar_settings(ea):
         dct = {}
@@ -629,12 +690,6 @@ class HexRaysHooks(Hooks):
             'ea': location.get_ea()
         }
 
-    def _send_user_lvar_settings(self, ea):
-        lvar_settings = HexRaysHooks._get_user_lvar_settings(ea)
-        if lvar_settings != self._lvar_settings:
-            self._send_event(UserLvarSettingsEvent(ea, lvar_settings))
-            self._lvar_settings = lvar_settings
-
     @staticmethod
     def _get_user_numforms(ea):
         user_numforms = ida_hexrays.restore_user_numforms(ea)
@@ -669,12 +724,6 @@ class HexRaysHooks(Hooks):
             'type_name': nf.type_name,
         }
 
-    def _send_user_numforms(self, ea):
-        numforms = HexRaysHooks._get_user_numforms(ea)
-        if numforms != self._numforms:
-            self._send_event(UserNumformsEvent(ea, numforms))
-            self._numforms = numforms
-
 
 class ViewHooks(Hooks, ida_kernwin.View_Hooks):
     """
@@ -685,11 +734,34 @@ class ViewHooks(Hooks, ida_kernwin.View_Hooks):
         ida_kernwin.View_Hooks.__init__(self)
         Hooks.__init__(self, plugin)
 
+        # The cursor is sent at most "cursor_rate" times per second, only
+        # its last address is sent when it moves faster than that
+        self._cursor = None
+        self._cursorSent = None
+        self._cursorTimer = QTimer()
+        self._cursorTimer.setSingleShot(True)
+        self._cursorTimer.timeout.connect(self._send_cursor)
+
     def view_loc_changed(self, view, now, was):
         if now.plce.toea() != was.plce.toea():
-            name = self._plugin.interface.painter.name
-            self._plugin.network.send_packet(UpdateCursors(now.plce.toea(),
-                                                           name))
+            self._cursor = now.plce.toea()
+            if not self._cursorTimer.isActive():
+                self._send_cursor()
+
+    def _send_cursor(self):
+        """
+        Send the last address of the cursor, then wait before sending the
+        next one.
+        """
+        if self._cursor is None or self._cursor == self._cursorSent:
+            return
+        name = self._plugin.interface.painter.name
+        self._plugin.network.send_packet(UpdateCursors(self._cursor, name))
+        self._cursorSent = self._cursor
+        self._cursor = None
+        rate = self._plugin.config["cursor_rate"]
+        if rate > 0:
+            self._cursorTimer.start(1000 // rate)
 
 
 class UIHooks(Hooks, ida_kernwin.UI_Hooks):
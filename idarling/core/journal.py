@@ -0,0 +1,156 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+import json
+import logging
+import os
+
+from ..shared.storage import replace_file
+
+logger = logging.getLogger('IDArling.Core')
+
+
+class Journal(object):
+    """
+    An append-only file recording the events produced while disconnected,
+    one JSON dictionary per line. It is read back in pages on reconnection,
+    so the memory used does not depend on the number of recorded events.
+    A page is only committed once the server has acknowledged it, or once
+    it has been written to the socket for older servers, and the file is
+    truncated once all the pages have been committed. The offset of the
+    first uncommitted event is kept in a file next to it, so that the events
+    committed before IDA was closed are not sent again.
+    """
+    OFFSET_SUFFIX = '.offset'
+
+    def __init__(self, path):
+        """
+        Initialize the journal.
+
+        :param path: the path of the journal file
+        """
+        super(Journal, self).__init__()
+        self._path = path
+        self._offset = 0  # Offset of the first uncommitted event
+        self._readOffset = 0  # Offset of the first unread event
+
+        try:
+            with open(path + Journal.OFFSET_SUFFIX, 'r') as inputFile:
+                offset = int(inputFile.read())
+        except (IOError, ValueError):
+            offset = 0
+        # The offset is only valid for the journal it was saved with
+        try:
+            if 0 < offset <= os.path.getsize(path):
+                self._offset = self._readOffset = offset
+        except OSError:
+            pass
+
+    @property
+    def path(self):
+        """
+        Get the path of the journal file.
+
+        :return: the path
+        """
+        return self._path
+
+    @property
+    def pending(self):
+        """
+        Return if the journal contains events that were not committed.
+
+        :return: if there are pending events
+        """
+        try:
+            return os.path.getsize(self._path) > self._offset
+        except OSError:
+            return False
+
+    def append(self, dcts):
+        """
+        Append some events to the end of the journal. The file is flushed so
+        that the events survive a crash of IDA.
+
+        :param dcts: the events dictionaries
+        """
+        lines = []
+        for dct in dcts:
+            line = json.dumps(dct)
+            if not isinstance(line, bytes):
+                line = line.encode('utf-8')
+            lines.append(line + b'\n')
+        with open(self._path, 'ab') as outputFile:
+            outputFile.write(b''.join(lines))
+            outputFile.flush()
+            os.fsync(outputFile.fileno())
+
+    def read(self, limit):
+        """
+        Read the next page of events, starting after the last one read.
+
+        :param limit: the maximum number of events
+        :return: the events dictionaries
+        """
+        dcts = []
+        try:
+            inputFile = open(self._path, 'rb')
+        except IOError:
+            return dcts
+        with inputFile:
+            inputFile.seek(self._readOffset)
+            while len(dcts) < limit:
+                line = inputFile.readline()
+                # An incomplete last line was interrupted while being written
+                if not line.endswith(b'\n'):
+                    break
+                self._readOffset += len(line)
+                try:
+                    dcts.append(json.loads(line.decode('utf-8')))
+                except ValueError:
+                    logger.warning("Skipping invalid journal entry")
+        return dcts
+
+    def commit(self):
+        """
+        Mark the events read so far as sent. The file is truncated once they
+        all have been, so that it never grows across sessions, otherwise the
+        offset of the next event is saved.
+        """
+        self._offset = self._readOffset
+        if not self.pending:
+            self.clear()
+            return
+
+        offsetPath = self._path + Journal.OFFSET_SUFFIX
+        partPath = offsetPath + '.part'
+        with open(partPath, 'w') as outputFile:
+            outputFile.write(str(self._offset))
+            outputFile.flush()
+            os.fsync(outputFile.fileno())
+        replace_file(partPath, offsetPath)
+
+    def rewind(self):
+        """
+        Forget the events read since the last commit, so that they are read
+        again. This is used when the connection is lost while sending them.
+        """
+        self._readOffset = self._offset
+
+    def clear(self):
+        """
+        Remove all the events from the journal.
+        """
+        for path in (self._path, self._path + Journal.OFFSET_SUFFIX):
+            if os.path.exists(path):
+                os.remove(path)
+        self._offset = self._readOffset = 0
@@ -10,12 +10,14 @@
 
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
+import collections
 import ctypes
 import logging
 import shutil
 import tempfile
 import os
 import sys
+import time
 from functools import partial
 
 import ida_diskio
@@ -23,12 +25,17 @@ import ida_idaapi
 import ida_loader
 import ida_kernwin
 
-from PyQt5.QtCore import Qt, QCoreApplication, QFileInfo
+from PyQt5.QtCore import Qt, QCoreApplication, QFileInfo, QTimer
 from PyQt5.QtGui import QIcon
 from PyQt5.QtWidgets import QProgressDialog, QMessageBox
 
 from ..utilities.misc import local_resource
-from ..shared.commands import DownloadDatabase, UploadDatabase, Subscribe
+from ..shared.commands import (DownloadDatabase, UploadDatabase, Subscribe,
+                               CHUNK_SIZE, GetMissingChunks, UploadChunk,
+                               UploadManifest)
+from ..shared.compression import ZLIB, compress, Decompressor
+from ..shared.framing import PROTOCOL_V3
+from ..shared.storage import chunk_file, replace_file
 from .dialogs import OpenDialog, SaveDialog
 
 logger = logging.getLogger('IDArling.Interface')
@@ -215,41 +222,97 @@ class OpenActionHandler(ActionHandler):
         iconPath = self._plugin.resource('download.png')
         progress.setWindowIcon(QIcon(iconPath))
 
-        # Send a packet to download the database
-        packet = DownloadDatabase.Query(repo.name, branch.name)
-        callback = partial(self._on_progress, progress)
+        # Download the database in chunks, starting with the first one
+        self._download_chunk(repo, branch, progress, 0, Decompressor())
+        progress.show()
+
+    @staticmethod
+    def _database_path(branch):
+        """
+        Get the path where the database of a branch is saved.
+
+        :param branch: the branch
+        :return: the path
+        """
+        appPath = QCoreApplication.applicationFilePath()
+        appName = QFileInfo(appPath).fileName()
+        fileExt = 'i64' if '64' in appName else 'idb'
+        fileName = '%s_%s.%s' % (branch.repo, branch.name, fileExt)
+        return local_resource('files', fileName)
+
+    def _download_chunk(self, repo, branch, progress, offset, dec):
+        """
+        Send a packet to download the chunk of the database at some offset.
+
+        :param repo: the repository
+        :param branch: the branch
+        :param progress: the progress dialog
+        :param offset: the offset of the chunk
+        :param dec: the decompressor of the database
+        """
+        packet = DownloadDatabase.Query(repo.name, branch.name,
+                                        offset, CHUNK_SIZE, ZLIB)
 
         def setDownloadCallback(reply):
-            reply.downback = callback
+            total = getattr(reply, 'total', reply.size)
+            reply.downback = lambda count, _: self._on_progress(
+                progress, offset + count, total)
 
         d = self._plugin.network.send_packet(packet)
         d.add_initback(setDownloadCallback)
-        d.add_callback(partial(self._database_downloaded, branch, progress))
+        d.add_callback(partial(self._chunk_downloaded, repo, branch,
+                               progress, offset, dec))
         d.add_errback(logger.exception)
-        progress.show()
 
-    def _database_downloaded(self, branch, progress, reply):
+    def _chunk_downloaded(self, repo, branch, progress, offset, dec, reply):
         """
-        Called when the file has been downloaded.
+        Called when a chunk of the file has been downloaded.
 
+        :param repo: the repository
         :param branch: the branch
         :param progress: the progress dialog
+        :param offset: the offset of the chunk
+        :param dec: the decompressor of the database
         :param reply: the reply from the server
         """
+        filePath = self._database_path(branch)
+        partPath = filePath + '.part'
+
+        # Decompress the chunk, unless the file isn't stored compressed
+        compressed = getattr(reply, 'compression', None) == ZLIB
+        data = dec.decompress(reply.content) if compressed else reply.content
+
+        # Append the chunk to the partial file
+        with open(partPath, 'ab' if offset else 'wb') as outputFile:
+            outputFile.write(data)
+            offset += len(reply.content)
+
+            # Older servers send the whole file at once
+            total = getattr(reply, 'total', offset)
+            if reply.content and offset < total:
+                self._download_chunk(repo, branch, progress, offset, dec)
+                return
+            if compressed:
+                outputFile.write(dec.flush())
+
+        replace_file(partPath, filePath)
+        logger.info("Saved file %s" % os.path.basename(filePath))
+        self._database_downloaded(branch, progress)
+
+    def _database_downloaded(self, branch, progress):
+        """
+        Called when the file has been downloaded.
+
+        :param branch: the branch
+        :param progress: the progress dialog
+        """
         # Close the progress dialog
         progress.close()
 
         # Get the absolute path of the file
         appPath = QCoreApplication.applicationFilePath()
         appName = QFileInfo(appPath).fileName()
-        fileExt = 'i64' if '64' in appName else 'idb'
-        fileName = '%s_%s.%s' % (branch.repo, branch.name, fileExt)
-        filePath = local_resource('files', fileName)
-
-        # Write the packet content to disk
-        with open(filePath, 'wb') as outputFile:
-            outputFile.write(reply.content)
-        logger.info("Saved file %s" % fileName)
+        filePath = self._database_path(branch)
 
         # Save the old database
         database = ida_loader.get_path(ida_loader.PATH_TYPE_IDB)
@@ -333,6 +396,10 @@ class SaveActionHandler(ActionHandler):
     The action handler for the save action.
     """
     _DIALOG = SaveDialog
+    _UPLOAD_WINDOW = 8
+    # The database is split for this long at most before yielding to IDA
+    _CHUNK_SLICE = 0.05
+    _DIGESTS_BATCH = 256
 
     def update(self, ctx):
         if not ida_loader.get_path(ida_loader.PATH_TYPE_IDB):
@@ -349,11 +416,6 @@ class SaveActionHandler(ActionHandler):
         inputPath = ida_loader.get_path(ida_loader.PATH_TYPE_IDB)
         ida_loader.save_database(inputPath, 0)
 
-        # Create the packet that will hold the database
-        packet = UploadDatabase.Query(repo.name, branch.name)
-        with open(inputPath, 'rb') as inputFile:
-            packet.content = inputFile.read()
-
         # Create the progress dialog
         text = "Uploading database to server, please wait..."
         progress = QProgressDialog(text, "Cancel", 0, 1)
@@ -365,15 +427,180 @@ class SaveActionHandler(ActionHandler):
         iconPath = self._plugin.resource('upload.png')
         progress.setWindowIcon(QIcon(iconPath))
 
-        # Send the packet to upload the file
+        # Older servers would store each chunk as if it was the whole file
+        if dialog.protocol < PROTOCOL_V3:
+            self._upload_database(repo, branch, progress, inputPath)
+            progress.show()
+            return
+
+        # The database is split into chunks a slice of time at a time, so
+        # that IDA stays responsive, and the server is asked which of them
+        # it lacks as they are found, so the upload starts right away
+        state = {
+            'chunker': chunk_file(inputPath),
+            'chunks': [],
+            'queries': 0,
+            'queued': set(),
+            'queue': collections.deque(),
+            'pending': 0,
+            'sent': 0,
+            'total': 0,
+        }
+        self._chunk_database(repo, branch, progress, inputPath, state)
+        progress.show()
+
+    def _upload_database(self, repo, branch, progress, path):
+        """
+        Send the whole database at once, like older servers expect it.
+
+        :param repo: the repository
+        :param branch: the branch
+        :param progress: the progress dialog
+        :param path: the path of the database
+        """
+        packet = UploadDatabase.Query(repo.name, branch.name)
+        with open(path, 'rb') as inputFile:
+            packet.content = inputFile.read()
         packet.upback = partial(self._on_progress, progress)
+
         d = self._plugin.network.send_packet(packet)
-        d.add_callback(partial(self._database_uploaded,
-                               repo, branch, progress))
+        d.add_callback(lambda _: self._database_uploaded(repo, branch,
+                                                         progress))
         d.add_errback(logger.exception)
-        progress.show()
 
-    def _database_uploaded(self, repo, branch, progress, _):
+    def _chunk_database(self, repo, branch, progress, path, state):
+        """
+        Split the next part of the database into chunks, then ask the server
+        which of them it lacks. It is called again from the event loop until
+        the whole database has been split.
+
+        :param repo: the repository
+        :param branch: the branch
+        :param progress: the progress dialog
+        :param path: the path of the database
+        :param state: the state of the upload
+        """
+        chunks = []
+        deadline = time.time() + SaveActionHandler._CHUNK_SLICE
+        for chunk in state['chunker']:
+            chunks.append(chunk)
+            if len(chunks) >= SaveActionHandler._DIGESTS_BATCH \
+                    or time.time() >= deadline:
+                break
+        else:
+            state['chunker'] = None  # The whole database has been split
+
+        if chunks:
+            state['chunks'].extend(chunks)
+            state['queries'] += 1
+            packet = GetMissingChunks.Query(repo.name,
+                                            [chunk[0] for chunk in chunks])
+            d = self._plugin.network.send_packet(packet)
+            d.add_callback(partial(self._missing_chunks_received, repo,
+                                   branch, progress, path, state, chunks))
+            d.add_errback(logger.exception)
+
+        if state['chunker'] is not None:
+            QTimer.singleShot(0, partial(self._chunk_database, repo, branch,
+                                         progress, path, state))
+        else:
+            self._upload_chunks(repo, branch, progress, path, state)
+
+    def _missing_chunks_received(self, repo, branch, progress, path, state,
+                                 chunks, reply):
+        """
+        Called when the server has replied with the chunks it lacks.
+
+        :param repo: the repository
+        :param branch: the branch
+        :param progress: the progress dialog
+        :param path: the path of the database
+        :param state: the state of the upload
+        :param chunks: the chunks the server was asked about
+        :param reply: the reply from the server
+        """
+        # Only upload once the chunks that appear several times
+        missing = set(reply.digests)
+        for chunk in chunks:
+            if chunk[0] in missing and chunk[0] not in state['queued']:
+                state['queued'].add(chunk[0])
+                state['queue'].append(chunk)
+                state['total'] += chunk[2]
+        state['queries'] -= 1
+        self._upload_chunks(repo, branch, progress, path, state)
+
+    def _upload_chunks(self, repo, branch, progress, path, state):
+        """
+        Send the missing chunks, keeping a few of them in flight to not wait
+        for the server after each one, then send the manifest once the whole
+        database has been split and uploaded.
+
+        :param repo: the repository
+        :param branch: the branch
+        :param progress: the progress dialog
+        :param path: the path of the database
+        :param state: the state of the upload
+        """
+        queue = state['queue']
+        while queue and state['pending'] < SaveActionHandler._UPLOAD_WINDOW:
+            digest, offset, size = queue.popleft()
+            state['pending'] += 1
+
+            packet = UploadChunk.Query(repo.name, digest, ZLIB)
+            with open(path, 'rb') as inputFile:
+                inputFile.seek(offset)
+                packet.content = compress(inputFile.read(size))
+            d = self._plugin.network.send_packet(packet)
+            d.add_callback(partial(self._chunk_uploaded, repo, branch,
+                                   progress, path, state, size))
+            d.add_errback(logger.exception)
+
+        if state['chunker'] is None and not state['queries'] \
+                and not queue and not state['pending']:
+            packet = UploadManifest.Query(repo.name, branch.name,
+                                          [[digest, size] for digest, _, size
+                                           in state['chunks']])
+            d = self._plugin.network.send_packet(packet)
+            d.add_callback(partial(self._manifest_uploaded,
+                                   repo, branch, progress))
+            d.add_errback(logger.exception)
+
+    def _chunk_uploaded(self, repo, branch, progress, path, state, size,
+                        reply):
+        """
+        Called when a chunk of the file has been uploaded.
+
+        :param repo: the repository
+        :param branch: the branch
+        :param progress: the progress dialog
+        :param path: the path of the database
+        :param state: the state of the upload
+        :param size: the size of the chunk
+        :param reply: the reply from the server
+        """
+        if not reply.stored:
+            logger.warning("Chunk was not stored by the server")
+        state['pending'] -= 1
+        state['sent'] += size
+        self._on_progress(progress, state['sent'], state['total'])
+        self._upload_chunks(repo, branch, progress, path, state)
+
+    def _manifest_uploaded(self, repo, branch, progress, reply):
+        """
+        Called when the manifest of the file has been uploaded.
+
+        :param repo: the repository
+        :param branch: the branch
+        :param progress: the progress dialog
+        :param reply: the reply from the server
+        """
+        if reply.missing:
+            progress.close()
+            logger.error("Server is missing %d chunks" % len(reply.missing))
+            return
+        self._database_uploaded(repo, branch, progress)
+
+    def _database_uploaded(self, repo, branch, progress):
         # Close the progress dialog
         progress.close()
 
@@ -390,7 +617,8 @@ class SaveActionHandler(ActionHandler):
         # Subscribe to the new events stream
         color = self._plugin.interface.painter.color
         name = self._plugin.interface.painter.name
+        serializer = self._plugin.config["serializer"]
         self._plugin.network.send_packet(Subscribe(repo.name, branch.name,
                                                    self._plugin.core.tick,
-                                                   color, name))
+                                                   color, name, serializer))
         self._plugin.core.hook_all()
@@ -28,6 +28,7 @@ from PyQt5.QtWidgets import (QDialog, QHBoxLayout, QVBoxLayout, QGridLayout,
 
 from ..shared.commands import GetRepositories, GetBranches, \
     NewRepository, NewBranch
+from ..shared.framing import PROTOCOL_V1
 from ..shared.models import Repository, Branch
 
 logger = logging.getLogger('IDArling.Interface')
@@ -48,6 +49,7 @@ class OpenDialog(QDialog):
         self._plugin = plugin
         self._repos = None
         self._branches = None
+        self._protocol = PROTOCOL_V1
 
         # General setup of the dialog
         logger.debug("Showing the database selection dialog")
@@ -133,6 +135,7 @@ class OpenDialog(QDialog):
         :param reply: the reply from the server
         """
         self._repos = reply.repos
+        self._protocol = reply.protocol
         self._refresh_repos()
 
     def _refresh_repos(self):
@@ -211,6 +214,16 @@ class OpenDialog(QDialog):
         repo = self._reposTable.selectedItems()[0].data(Qt.UserRole)
         return repo, self._branchesTable.selectedItems()[0].data(Qt.UserRole)
 
+    @property
+    def protocol(self):
+        """
+        Get the protocol version of the server, as told with the list of
+        repositories.
+
+        :return: the version
+        """
+        return self._protocol
+
 
 class SaveDialog(OpenDialog):
     """
@@ -543,6 +556,19 @@ class SettingsDialog(QDialog):
         debugLevelComboBox.activated.connect(debugLevelActivated)
         layout.addRow(debugLevelLabel, debugLevelComboBox)
 
+        cursorRateLabel = QLabel("Cursor Updates: ")
+        cursorRateSpinBox = QSpinBox()
+        cursorRateSpinBox.setRange(0, 100)
+        cursorRateSpinBox.setSpecialValueText("Unlimited")
+        cursorRateSpinBox.setSuffix(" per second")
+        cursorRateSpinBox.setValue(self._plugin.config["cursor_rate"])
+
+        def cursorRateSpinBoxChanged(rate):
+            self._plugin.config["cursor_rate"] = rate
+            self._plugin.save_config()
+        cursorRateSpinBox.valueChanged.connect(cursorRateSpinBoxChanged)
+        layout.addRow(cursorRateLabel, cursorRateSpinBox)
+
         layout.addItem(QSpacerItem(10, 10))
         self._acceptButton = QPushButton("OK")
         self._acceptButton.clicked.connect(self.accept)
@@ -118,6 +118,7 @@ class Interface(Module):
     def notify_disconnected(self):
         self._statusWidget.set_state(StatusWidget.STATE_DISCONNECTED)
         self._statusWidget.set_server(None)
+        self._statusWidget.set_pending(0)
         self._update_actions()
 
     def notify_connecting(self):
@@ -129,6 +130,15 @@ class Interface(Module):
         self._statusWidget.set_state(StatusWidget.STATE_CONNECTED)
         self._update_actions()
 
+    def notify_pending_events(self, pending):
+        """
+        Notify the interface of the number of received events that are
+        waiting to be applied.
+
+        :param pending: the number of events
+        """
+        self._statusWidget.set_pending(pending)
+
     @property
     def painter(self):
         return self._painter
@@ -43,6 +43,7 @@ class StatusWidget(QWidget):
 
         self._state = self.STATE_DISCONNECTED
         self._server = None
+        self._pending = 0
 
         # Create the sub-widgets
         self._textWidget = QLabel()
@@ -76,6 +77,8 @@ class StatusWidget(QWidget):
         else:
             logger.warning('Invalid server state')
             return
+        if self._pending:
+            text += ' (applying %d events)' % self._pending
 
         # Update the text of the widget
         if self._server is None:
@@ -241,3 +244,13 @@ class StatusWidget(QWidget):
         if server != self._server:
             self._server = server
             self.update_widget()
+
+    def set_pending(self, pending):
+        """
+        Set the number of received events waiting to be applied.
+
+        :param pending: the number of events
+        """
+        if pending != self._pending:
+            self._pending = pending
+            self.update_widget()
@@ -10,10 +10,13 @@
 
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
+import collections
 import logging
+import time
 
-from ..shared.commands import UpdateCursors, Unsubscribe, RenamedUser
-from ..shared.packets import Command, Event
+from ..shared.commands import (UpdateCursors, Unsubscribe, RenamedUser,
+                               UpgradeProtocol)
+from ..shared.packets import Command, Event, SerializerFactory
 from ..shared.sockets import ClientSocket
 
 logger = logging.getLogger('IDArling.Network')
@@ -23,6 +26,10 @@ class Client(ClientSocket):
     """
     The client (client-side) implementation.
     """
+    # The received packets are handled for at most SLICE_DURATION seconds
+    # per turn of the event loop, so that IDA stays responsive while a
+    # large number of events are being applied.
+    SLICE_DURATION = 0.05
 
     def __init__(self, plugin, parent=None):
         """
@@ -33,10 +40,14 @@ class Client(ClientSocket):
         ClientSocket.__init__(self, logger, parent)
         self._plugin = plugin
         self._users = {}
+        self._tick = None  # Tick of the events being applied
+        self._unhooked = False  # Were the hooks removed for this slice?
+        self._cursors = collections.OrderedDict()  # Cursors to be painted
         self._handlers = {
             UpdateCursors: self._handle_update_cursors,
             Unsubscribe: self._handle_unsubscribe,
             RenamedUser: self._handle_renamed_user,
+            UpgradeProtocol: self._handle_upgrade_protocol,
         }
 
     def disconnect(self, err=None):
@@ -46,24 +57,54 @@ class Client(ClientSocket):
         # Notify the plugin
         self._plugin.notify_disconnected()
 
+    def _dispatch(self):
+        # The tick is only saved after the last event of a slice. The hooks
+        # are only removed while a slice is applied, so that the changes made
+        # by the user between two slices are still sent. The pseudocode views
+        # refreshed afterwards don't send the events back, see applied_funcs.
+        self._dispatching = False
+        deadline = time.time() + Client.SLICE_DURATION
+        try:
+            while self._incoming:
+                self._dispatch_packet(self._incoming.popleft())
+                if time.time() >= deadline:
+                    break
+        finally:
+            if self._tick is not None:
+                self._plugin.core.tick = self._tick
+                self._tick = None
+            if self._unhooked:
+                self._unhooked = False
+                self._plugin.core.hook_all()
+
+        # Handle the remaining packets after the pending UI events
+        pending = len(self._incoming)
+        if pending:
+            self._schedule_dispatch()
+        self._plugin.interface.notify_pending_events(pending)
+
     def recv_packet(self, packet):
         if isinstance(packet, Command):
             # Call the corresponding handler
             self._handlers[packet.__class__](packet)
 
         elif isinstance(packet, Event):
+            if self._tick is None:
+                if not self._unhooked:
+                    self._plugin.core.unhook_all()
+                    self._unhooked = True
+                self._tick = self._plugin.core.tick
+
             # Call the event
-            self._plugin.core.unhook_all()
             try:
                 packet()
             except Exception as e:
                 self._logger.warning("Error while calling event")
                 self._logger.exception(e)
-            if self._plugin.core.tick >= packet.tick:
+            if self._tick >= packet.tick:
                 self._logger.warning("De-synchronization detected!")
-                packet.tick = self._plugin.core.tick
-            self._plugin.core.tick = packet.tick
-            self._plugin.core.hook_all()
+                packet.tick = self._tick
+            self._tick = packet.tick
         else:
             return False
         return True
@@ -74,18 +115,42 @@ class Client(ClientSocket):
             packet.tick = self._plugin.core.tick
         return ClientSocket.send_packet(self, packet)
 
+    def _outgoing_drained(self):
+        self._plugin.core.notify_drained()
+
     def _handle_update_cursors(self, packet):
-        self._plugin.interface.painter.paint(packet.color,
-                                             packet.name,
-                                             packet.ea)
+        # Only the last cursor of each user is painted, once all the packets
+        # received together have been handled
+        if not self._cursors:
+            self._loop.call_soon(self._paint_cursors)
+        self._cursors[packet.name] = (packet.color, packet.ea)
+
+    def _paint_cursors(self):
+        """
+        Paint the cursors received since the last time.
+        """
+        painter = self._plugin.interface.painter
+        while self._cursors:
+            name, (color, ea) = self._cursors.popitem(last=False)
+            painter.paint(color, name, ea)
 
     def _handle_unsubscribe(self, packet):
+        self._cursors.pop(packet.name, None)
         self._plugin.interface.painter.unpaint(packet.name)
 
     def _handle_renamed_user(self, packet):
+        if packet.old_name in self._cursors:
+            self._cursors[packet.new_name] = \
+                self._cursors.pop(packet.old_name)
         users_positions = self._plugin.interface.painter.users_positions
         users_positions[packet.new_name] = users_positions.pop(packet.old_name)
 
+    def _handle_upgrade_protocol(self, packet):
+        logger.debug("Upgrading to protocol version %d using %s"
+                     % (packet.version, packet.serializer))
+        self.protocol = packet.version
+        self.serializer = SerializerFactory.get_class(packet.serializer)
+
     @property
     def users(self):
         return self._users
@@ -80,6 +80,8 @@ class Plugin(ida_idaapi.plugin_t):
         self._config = {
             "level": logging.INFO,
             "servers": [],
+            "serializer": "json",
+            "cursor_rate": 10,
             "keep": {
                 "cnt": 4,
                 "intvl": 15,
@@ -206,6 +208,9 @@ class Plugin(ida_idaapi.plugin_t):
             0 - Disabled
             1 - Enabled with customized path
             2 - Enabled with OS PKI
+        serializer:
+            json - Faster to encode and decode (default)
+            msgpack - Smaller packets, for slow connections
         """
         configPath = local_resource('files', 'config.json')
         if not os.path.isfile(configPath):
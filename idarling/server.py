@@ -12,14 +12,90 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 import argparse
 import logging
+import multiprocessing
 import os
+import re
 import signal
+import socket
 import sys
-import traceback
-
-from PyQt5.QtCore import QCoreApplication, QTimer
+from multiprocessing import reduction
 
+from idarling.shared.database import Database
+from idarling.shared.loop import AsyncioLoop, Timer, set_loop
 from idarling.shared.server import Server
+from idarling.shared.sharding import (FrontServer, shard_database,
+                                      shard_index)
+
+
+def start_logging():
+    """
+    Configure the logger of the server, with a log file for each process.
+
+    :return: the logger
+    """
+    logger = logging.getLogger('IDArling.Server')
+
+    # Get path to the log file
+    logDir = os.path.join(os.path.dirname(__file__), 'logs')
+    logDir = os.path.abspath(logDir)
+    if not os.path.exists(logDir):
+        os.makedirs(logDir)
+    logPath = os.path.join(logDir, 'idarling.%s.log' % os.getpid())
+
+    # Configure the logger
+    logFormat = '[%(asctime)s][%(levelname)s] %(message)s'
+    formatter = logging.Formatter(fmt=logFormat, datefmt='%H:%M:%S')
+
+    # Log to the console
+    streamHandler = logging.StreamHandler()
+    streamHandler.setFormatter(formatter)
+    logger.addHandler(streamHandler)
+
+    # Log to the log file
+    fileHandler = logging.FileHandler(logPath)
+    fileHandler.setFormatter(formatter)
+    logger.addHandler(fileHandler)
+
+    return logger
+
+
+def local_file(filename):
+    """
+    Get the path of a file of the dedicated server.
+
+    :param filename: the file name
+    :return: the path
+    """
+    filesDir = os.path.join(os.path.dirname(__file__), 'files')
+    filesDir = os.path.abspath(filesDir)
+    if not os.path.exists(filesDir):
+        os.makedirs(filesDir)
+    return os.path.join(filesDir, filename)
+
+
+def shard_databases(count):
+    """
+    Move the repositories to the database of the process handling them, so
+    that the number of workers can change from one run to the other. With
+    no workers, they are all moved back to the main database.
+
+    :param count: the number of workers
+    """
+    filesDir = os.path.dirname(local_file('database.db'))
+    for filename in sorted(os.listdir(filesDir)):
+        if not re.match(r'^database(\.\d+)?\.db$', filename):
+            continue
+        database = Database(local_file(filename))
+        database.initialize()
+        moves = {}
+        for repo in database.select_repos():
+            index = shard_index(repo.name, count) if count else None
+            target = shard_database(index)
+            if target != filename:
+                moves.setdefault(target, []).append(repo.name)
+        for target, names in moves.items():
+            database.move_repos(local_file(target), names)
+        database.close()
 
 
 class DedicatedServer(Server):
@@ -27,52 +103,142 @@ class DedicatedServer(Server):
     The dedicated server implementation.
     """
 
-    def __init__(self, ssl, level, parent=None):
-        logger = self.start_logging()
+    def __init__(self, ssl, level, synchronous, parent=None,
+                 database='database.db'):
+        logger = start_logging()
         logger.setLevel(getattr(logging, level))
-        Server.__init__(self, logger, ssl, parent)
+        Server.__init__(self, logger, ssl, parent, synchronous, database)
 
     def local_file(self, filename):
-        filesDir = os.path.join(os.path.dirname(__file__), 'files')
-        filesDir = os.path.abspath(filesDir)
-        if not os.path.exists(filesDir):
-            os.makedirs(filesDir)
-        return os.path.join(filesDir, filename)
+        return local_file(filename)
+
+
+class ShardedServer(FrontServer):
+    """
+    The front server of the dedicated server, in sharded mode.
+    """
+
+    def __init__(self, ssl, level, workers):
+        logger = start_logging()
+        logger.setLevel(getattr(logging, level))
+        FrontServer.__init__(self, logger, ssl, workers)
+
+
+def run_worker(index, conn, args):
+    """
+    The entry point of a worker process, in sharded mode. It runs a server
+    that doesn't listen, to which the front process passes the connections
+    through the control connection. It receives None when it should stop.
+
+    :param index: the index of the worker
+    :param conn: the control connection
+    :param args: the command line arguments
+    """
+    # The worker is stopped by the front process, even on Ctrl-C
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    loop = AsyncioLoop()
+    set_loop(loop)
+    server = DedicatedServer(None, args.level, args.synchronous,
+                             database=shard_database(index))
+
+    def accept_client():
+        try:
+            address = conn.recv()
+        except EOFError:
+            address = None  # The front process has exited
+        if address is None:
+            loop.remove_reader(conn.fileno())
+            server.stop()
+            loop.stop()
+            return
+        fd = reduction.recv_handle(conn)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM, fileno=fd)
+        server.accept_client(sock, address)
+
+    loop.add_reader(conn.fileno(), accept_client)
+    server.start_cleanup()
+
+    # Every worker compacts the events of its own database
+    if args.compact_interval:
+        compactTimer = Timer(args.compact_interval * 60 * 1000,
+                             server.compact_events)
+        compactTimer.start()
+    loop.run()
+
+
+def start_sharded(args, ssl_args):
+    """
+    Start the server in sharded mode: the repositories are spread across
+    several worker processes, while this process accepts the connections
+    and forwards the packets of each client to the right workers.
+
+    :param args: the command line arguments
+    :param ssl_args: the SSL configuration
+    """
+    # The workers are started by a clean process, so that the ones started
+    # again later don't inherit the sockets of this one
+    context = multiprocessing.get_context('forkserver')
+
+    def start_worker(index):
+        conn, childConn = context.Pipe()
+        process = context.Process(target=run_worker,
+                                  args=(index, childConn, args))
+        process.start()
+        childConn.close()
+        return process, conn
 
-    def start_logging(self):
-        logger = logging.getLogger('IDArling.Server')
+    workers = [start_worker(index) for index in range(args.workers)]
+
+    loop = AsyncioLoop()
+    set_loop(loop)
+    server = ShardedServer(ssl_args, args.level,
+                           [(process.pid, conn) for process, conn in workers])
+    server.start(args.host, args.port)
 
-        # Get path to the log file
-        logDir = os.path.join(os.path.dirname(__file__), 'logs')
-        logDir = os.path.abspath(logDir)
-        if not os.path.exists(logDir):
-            os.makedirs(logDir)
-        logPath = os.path.join(logDir, 'idarling.%s.log' % os.getpid())
+    # A worker that exits unexpectedly is started again. Its clients are
+    # disconnected by the end of their links, and connect again.
+    def watch_worker(index):
+        process, conn = workers[index]
 
-        # Configure the logger
-        logFormat = '[%(asctime)s][%(levelname)s] %(message)s'
-        formatter = logging.Formatter(fmt=logFormat, datefmt='%H:%M:%S')
+        def worker_exited():
+            loop.forget(process.sentinel)
+            process.join()
+            conn.close()
+            logger = logging.getLogger('IDArling.Server')
+            logger.error("Worker %d exited with code %s, restarting it"
+                         % (index, process.exitcode))
+            workers[index] = start_worker(index)
+            server.replace_worker(index, workers[index][0].pid,
+                                  workers[index][1])
+            watch_worker(index)
 
-        # Log to the console
-        streamHandler = logging.StreamHandler()
-        streamHandler.setFormatter(formatter)
-        logger.addHandler(streamHandler)
+        loop.add_reader(process.sentinel, worker_exited)
 
-        # Log to the log file
-        fileHandler = logging.FileHandler(logPath)
-        fileHandler.setFormatter(formatter)
-        logger.addHandler(fileHandler)
+    for index in range(len(workers)):
+        watch_worker(index)
+
+    # Allow the use of Ctrl-C to stop the server
+    def sigint_handler():
+        server.stop()
+        loop.stop()
 
-        return logger
+    loop.add_signal_handler(signal.SIGINT, sigint_handler)
+    loop.run()
+
+    # Stop the workers, which commit their pending events
+    for process, conn in workers:
+        loop.forget(process.sentinel)
+        conn.send(None)
+        conn.close()
+    for process, conn in workers:
+        process.join()
+    return 0
 
 
 def start(args):
     """
     The entry point of a Python program.
     """
-    app = QCoreApplication(sys.argv)
-    sys.excepthook = traceback.print_exception
-
     if (not args.no_client_ssl) and args.no_server_ssl:
         raise ValueError("You should use server-side SSL"
                          "if you want to use client-side SSL")
@@ -95,27 +261,32 @@ def start(args):
         "client_ssl_cert_path": client_ssl_cert_path
     }
 
-    server = DedicatedServer(ssl_args, args.level)
+    # Each worker has its own database, with the repositories it handles
+    shard_databases(args.workers)
+    if args.workers:
+        return start_sharded(args, ssl_args)
+
+    # The dedicated server runs on an asyncio loop, instead of Qt's
+    loop = AsyncioLoop()
+    set_loop(loop)
+
+    server = DedicatedServer(ssl_args, args.level, args.synchronous)
     server.start(args.host, args.port)
 
     # Allow the use of Ctrl-C to stop the server
-    def sigint_handler(signum, frame):
+    def sigint_handler():
         server.stop()
-        app.exit(0)
-
-    signal.signal(signal.SIGINT, sigint_handler)
-
-    def safe_timer(timeout, func, *args, **kwargs):
-        def timer_event():
-            try:
-                func(*args, **kwargs)
-            finally:
-                QTimer.singleShot(timeout, timer_event)
+        loop.stop()
 
-        QTimer.singleShot(timeout, timer_event)
+    loop.add_signal_handler(signal.SIGINT, sigint_handler)
 
-    safe_timer(50, lambda: None)
-    return app.exec_()
+    # Compact the events periodically
+    if args.compact_interval:
+        compactTimer = Timer(args.compact_interval * 60 * 1000,
+                             server.compact_events)
+        compactTimer.start()
+    loop.run()
+    return 0
 
 
 def main():
@@ -144,5 +315,18 @@ def main():
     levels = ["CRITICAL", "ERROR", "WARNING", "INFO", "DEBUG"]
     parser.add_argument('-l', '--level', type=str, choices=levels,
                         default="INFO", help='the log level')
+    parser.add_argument('-s', '--synchronous', type=str,
+                        choices=Database.SYNCHRONOUS_LEVELS, default='normal',
+                        help='the synchronous level of the database')
+    parser.add_argument('-c', '--compact-interval', type=int, default=0,
+                        metavar='MINUTES',
+                        help='the interval between events compactions, '
+                             'or 0 to disable them')
+    parser.add_argument('-w', '--workers', type=int, default=0,
+                        help='the number of worker processes the repositories '
+                             'are spread across, or 0 to use a single process')
 
-    start(parser.parse_args())
+    args = parser.parse_args()
+    if args.workers and sys.platform == 'win32':
+        parser.error("worker processes are not supported on Windows")
+    start(args)
@@ -0,0 +1,228 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+A pure-Python implementation of the subset of MessagePack needed to encode
+packets: nil, booleans, integers, floats, strings, binaries, arrays and maps.
+
+Like JSON, Python 2 byte strings are considered to be UTF-8 text, tuples are
+decoded as lists and strings are always decoded as unicode strings.
+"""
+import struct
+
+try:
+    _TEXT_TYPES = (unicode, str)
+    _BINARY_TYPES = (bytearray,)
+    _INTEGER_TYPES = (int, long)
+except NameError:
+    _TEXT_TYPES = (str,)
+    _BINARY_TYPES = (bytes, bytearray)
+    _INTEGER_TYPES = (int,)
+
+_UINT8 = struct.Struct('>BB')
+_UINT16 = struct.Struct('>BH')
+_UINT32 = struct.Struct('>BI')
+_UINT64 = struct.Struct('>BQ')
+_INT8 = struct.Struct('>Bb')
+_INT16 = struct.Struct('>Bh')
+_INT32 = struct.Struct('>Bi')
+_INT64 = struct.Struct('>Bq')
+_FLOAT64 = struct.Struct('>Bd')
+
+# Single-byte encodings, indexed by their value
+_BYTES = [bytes(bytearray((i,))) for i in range(256)]
+
+# Decoding table for the fixed-size values: (format, length)
+_FIXED = {
+    0xca: (struct.Struct('>f'), 4),
+    0xcb: (struct.Struct('>d'), 8),
+    0xcc: (struct.Struct('>B'), 1),
+    0xcd: (struct.Struct('>H'), 2),
+    0xce: (struct.Struct('>I'), 4),
+    0xcf: (struct.Struct('>Q'), 8),
+    0xd0: (struct.Struct('>b'), 1),
+    0xd1: (struct.Struct('>h'), 2),
+    0xd2: (struct.Struct('>i'), 4),
+    0xd3: (struct.Struct('>q'), 8),
+}
+
+# Decoding table for the lengths of strings, binaries, arrays and maps
+_LENGTHS = {
+    0xc4: (struct.Struct('>B'), 1, 'bin'),
+    0xc5: (struct.Struct('>H'), 2, 'bin'),
+    0xc6: (struct.Struct('>I'), 4, 'bin'),
+    0xd9: (struct.Struct('>B'), 1, 'str'),
+    0xda: (struct.Struct('>H'), 2, 'str'),
+    0xdb: (struct.Struct('>I'), 4, 'str'),
+    0xdc: (struct.Struct('>H'), 2, 'array'),
+    0xdd: (struct.Struct('>I'), 4, 'array'),
+    0xde: (struct.Struct('>H'), 2, 'map'),
+    0xdf: (struct.Struct('>I'), 4, 'map'),
+}
+
+
+def _pack_header(n, fix, fixmax, code8, code16, code32, out):
+    """
+    Append the header of a string, binary, array or map of length n.
+    """
+    if n <= fixmax:
+        out.append(_BYTES[fix | n])
+    elif code8 is not None and n <= 0xff:
+        out.append(_UINT8.pack(code8, n))
+    elif n <= 0xffff:
+        out.append(_UINT16.pack(code16, n))
+    else:
+        out.append(_UINT32.pack(code32, n))
+
+
+def _pack_integer(obj, out):
+    """
+    Append an integer using its most compact representation.
+    """
+    if 0 <= obj < 0x80:
+        out.append(_BYTES[obj])
+    elif -0x20 <= obj < 0:
+        out.append(_BYTES[obj & 0xff])
+    elif obj > 0:
+        if obj <= 0xff:
+            out.append(_UINT8.pack(0xcc, obj))
+        elif obj <= 0xffff:
+            out.append(_UINT16.pack(0xcd, obj))
+        elif obj <= 0xffffffff:
+            out.append(_UINT32.pack(0xce, obj))
+        else:
+            out.append(_UINT64.pack(0xcf, obj))
+    elif obj >= -0x80:
+        out.append(_INT8.pack(0xd0, obj))
+    elif obj >= -0x8000:
+        out.append(_INT16.pack(0xd1, obj))
+    elif obj >= -0x80000000:
+        out.append(_INT32.pack(0xd2, obj))
+    else:
+        out.append(_INT64.pack(0xd3, obj))
+
+
+def _pack(obj, out):
+    """
+    Append the encoding of an object to a list of byte strings.
+    """
+    if obj is None:
+        out.append(b'\xc0')
+    elif obj is True:
+        out.append(b'\xc3')
+    elif obj is False:
+        out.append(b'\xc2')
+    elif isinstance(obj, _INTEGER_TYPES):
+        _pack_integer(obj, out)
+    elif isinstance(obj, _TEXT_TYPES):
+        if not isinstance(obj, bytes):
+            obj = obj.encode('utf-8')
+        _pack_header(len(obj), 0xa0, 31, 0xd9, 0xda, 0xdb, out)
+        out.append(obj)
+    elif isinstance(obj, _BINARY_TYPES):
+        _pack_header(len(obj), 0xc4, -1, 0xc4, 0xc5, 0xc6, out)
+        out.append(bytes(obj))
+    elif isinstance(obj, float):
+        out.append(_FLOAT64.pack(0xcb, obj))
+    elif isinstance(obj, (list, tuple)):
+        _pack_header(len(obj), 0x90, 15, None, 0xdc, 0xdd, out)
+        for val in obj:
+            _pack(val, out)
+    elif isinstance(obj, dict):
+        _pack_header(len(obj), 0x80, 15, None, 0xde, 0xdf, out)
+        for key, val in obj.items():
+            _pack(key, out)
+            _pack(val, out)
+    else:
+        raise TypeError("Cannot serialize object of type %s" % type(obj))
+
+
+def _unpack(data, pos):
+    """
+    Decode the object starting at the given position.
+
+    :return: the object and the position following it
+    """
+    code = data[pos]
+    pos += 1
+    if code < 0x80:
+        return code, pos
+    if code >= 0xe0:
+        return code - 0x100, pos
+    if code == 0xc0:
+        return None, pos
+    if code == 0xc2:
+        return False, pos
+    if code == 0xc3:
+        return True, pos
+    if code in _FIXED:
+        fmt, size = _FIXED[code]
+        return fmt.unpack_from(data, pos)[0], pos + size
+
+    if code <= 0x8f:
+        kind, n = 'map', code & 0x0f
+    elif code <= 0x9f:
+        kind, n = 'array', code & 0x0f
+    elif code <= 0xbf:
+        kind, n = 'str', code & 0x1f
+    elif code in _LENGTHS:
+        fmt, size, kind = _LENGTHS[code]
+        n = fmt.unpack_from(data, pos)[0]
+        pos += size
+    else:
+        raise ValueError("Unsupported type code: %#x" % code)
+
+    if kind == 'str':
+        if pos + n > len(data):
+            raise ValueError("Truncated data")
+        return data[pos:pos + n].decode('utf-8'), pos + n
+    if kind == 'bin':
+        if pos + n > len(data):
+            raise ValueError("Truncated data")
+        return bytes(data[pos:pos + n]), pos + n
+    if kind == 'array':
+        lst = []
+        for _ in range(n):
+            val, pos = _unpack(data, pos)
+            lst.append(val)
+        return lst, pos
+    dct = {}
+    for _ in range(n):
+        key, pos = _unpack(data, pos)
+        dct[key], pos = _unpack(data, pos)
+    return dct, pos
+
+
+def pack(obj):
+    """
+    Encode an object into bytes.
+
+    :param obj: the object
+    :return: the bytes
+    """
+    out = []
+    _pack(obj, out)
+    return b''.join(out)
+
+
+def unpack(data):
+    """
+    Decode an object from bytes.
+
+    :param data: the bytes
+    :return: the object
+    """
+    data = bytearray(data)
+    obj, pos = _unpack(data, 0)
+    if pos != len(data):
+        raise ValueError("Extra data after object")
+    return obj
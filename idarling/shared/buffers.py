@@ -0,0 +1,141 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+class ReadBuffer(object):
+    """
+    A receive buffer that socket data is read into directly. The consumed
+    bytes are tracked using a read offset and are only reclaimed when the
+    buffer is compacted, so extracting a packet never copies the rest of the
+    pending data. The newline search is also incremental: bytes that have
+    already been scanned are never scanned again.
+    """
+    MIN_CAPACITY = 65536
+
+    def __init__(self, capacity=MIN_CAPACITY):
+        """
+        Initialize the read buffer.
+
+        :param capacity: the initial capacity
+        """
+        super(ReadBuffer, self).__init__()
+        self._buffer = bytearray(capacity)
+        self._start = 0  # Offset of the first unconsumed byte
+        self._end = 0  # Offset of the last received byte
+        self._scan = 0  # Offset up to which no newline was found
+
+    def __len__(self):
+        """
+        Get the number of bytes available for reading.
+
+        :return: the number of bytes
+        """
+        return self._end - self._start
+
+    def recv_from(self, sock, size):
+        """
+        Receive at most size bytes from the socket into the buffer.
+
+        :param sock: the socket
+        :param size: the maximum number of bytes
+        :return: the number of bytes received
+        """
+        self._reserve(size)
+        view = memoryview(self._buffer)
+        try:
+            count = sock.recv_into(view[self._end:self._end + size], size)
+        finally:
+            del view  # The buffer cannot be resized while a view exists
+        self._end += count
+        return count
+
+    def extend(self, data):
+        """
+        Append some data to the end of the buffer.
+
+        :param data: the data
+        """
+        self._reserve(len(data))
+        self._buffer[self._end:self._end + len(data)] = data
+        self._end += len(data)
+
+    def peek(self):
+        """
+        Get the first available byte without consuming it.
+
+        :return: the byte value or None
+        """
+        if self._start == self._end:
+            return None
+        return self._buffer[self._start]
+
+    def readline(self):
+        """
+        Consume a line terminated by a newline character.
+
+        :return: the line without the newline, or None if incomplete
+        """
+        pos = self._buffer.find(b'\n', max(self._scan, self._start),
+                                self._end)
+        if pos < 0:
+            self._scan = self._end
+            return None
+        line = bytes(self._buffer[self._start:pos])
+        self._consume(pos + 1 - self._start)
+        return line
+
+    def read(self, size):
+        """
+        Consume exactly size bytes from the buffer.
+
+        :param size: the number of bytes
+        :return: the bytes, or None if not enough are available
+        """
+        if len(self) < size:
+            return None
+        data = bytes(self._buffer[self._start:self._start + size])
+        self._consume(size)
+        return data
+
+    def _consume(self, size):
+        """
+        Mark some bytes as read, rewinding the offsets once empty.
+
+        :param size: the number of bytes
+        """
+        self._start += size
+        if self._start == self._end:
+            self._start = self._end = self._scan = 0
+
+    def _reserve(self, size):
+        """
+        Make sure there is room for size more bytes at the end of the buffer,
+        compacting the unconsumed bytes to the front or growing it as needed.
+
+        :param size: the number of bytes
+        """
+        if self._end + size <= len(self._buffer):
+            return
+
+        # Move the unconsumed bytes to the front of the buffer
+        avail = len(self)
+        if self._start:
+            self._buffer[:avail] = self._buffer[self._start:self._end]
+            self._scan = max(self._scan - self._start, 0)
+            self._start, self._end = 0, avail
+
+        # Grow geometrically so that appending stays amortized linear
+        capacity = len(self._buffer)
+        if avail + size > capacity:
+            capacity = max(capacity * 2, avail + size)
+            self._buffer.extend(bytearray(capacity - len(self._buffer)))
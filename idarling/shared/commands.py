@@ -10,10 +10,14 @@
 
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
+from .framing import PROTOCOL_V1, PROTOCOL_VERSION
 from .models import Repository, Branch
 from .packets import (Command, DefaultCommand, ParentCommand,
                       Query as IQuery, Reply as IReply, Container)
 
+# The databases are transferred in chunks of this size
+CHUNK_SIZE = 1024 * 1024
+
 
 class GetRepositories(ParentCommand):
     __command__ = 'get_repos'
@@ -23,15 +27,19 @@ class GetRepositories(ParentCommand):
 
     class Reply(IReply, Command):
 
-        def __init__(self, query, repos):
+        def __init__(self, query, repos, protocol=PROTOCOL_VERSION):
             super(GetRepositories.Reply, self).__init__(query)
             self.repos = repos
+            self.protocol = protocol
 
         def build_command(self, dct):
             dct['repos'] = [repo.build(dict()) for repo in self.repos]
+            dct['protocol'] = self.protocol
 
         def parse_command(self, dct):
             self.repos = [Repository.new(repo) for repo in dct['repos']]
+            # Older servers don't tell their protocol version
+            self.protocol = dct.get('protocol', PROTOCOL_V1)
 
 
 class GetBranches(ParentCommand):
@@ -99,13 +107,23 @@ class UploadDatabase(ParentCommand):
 
     class Query(IQuery, Container, DefaultCommand):
 
-        def __init__(self, repo, branch):
+        def __init__(self, repo, branch, offset=0, total=None,
+                     compression=None, upload=None):
             super(UploadDatabase.Query, self).__init__()
             self.repo = repo
             self.branch = branch
+            self.offset = offset
+            self.total = total
+            self.compression = compression
+            # The identifier of the upload, chosen by the client, so that it
+            # can be resumed from another connection
+            self.upload = upload
 
-    class Reply(IReply, Command):
-        pass
+    class Reply(IReply, DefaultCommand):
+
+        def __init__(self, query, offset):
+            super(UploadDatabase.Reply, self).__init__(query)
+            self.offset = offset
 
 
 class DownloadDatabase(ParentCommand):
@@ -113,25 +131,112 @@ class DownloadDatabase(ParentCommand):
 
     class Query(IQuery, DefaultCommand):
 
-        def __init__(self, repo, branch):
+        def __init__(self, repo, branch, offset=0, size=None,
+                     compression=None):
             super(DownloadDatabase.Query, self).__init__()
             self.repo = repo
             self.branch = branch
+            self.offset = offset
+            self.size = size
+            self.compression = compression
+
+    class Reply(IReply, Container, DefaultCommand):
+
+        def __init__(self, query, offset, total, compression=None):
+            super(DownloadDatabase.Reply, self).__init__(query)
+            self.offset = offset
+            self.total = total
+            self.compression = compression
+
+
+class GetMissingChunks(ParentCommand):
+    __command__ = 'get_missing_chunks'
+
+    class Query(IQuery, DefaultCommand):
+
+        def __init__(self, repo, digests):
+            super(GetMissingChunks.Query, self).__init__()
+            self.repo = repo
+            self.digests = digests
+
+    class Reply(IReply, DefaultCommand):
+
+        def __init__(self, query, digests):
+            super(GetMissingChunks.Reply, self).__init__(query)
+            self.digests = digests
+
+
+class UploadChunk(ParentCommand):
+    __command__ = 'upload_chunk'
+
+    class Query(IQuery, Container, DefaultCommand):
+
+        def __init__(self, repo, digest, compression=None):
+            super(UploadChunk.Query, self).__init__()
+            self.repo = repo
+            self.digest = digest
+            self.compression = compression
 
-    class Reply(IReply, Container, Command):
+    class Reply(IReply, DefaultCommand):
+
+        def __init__(self, query, stored):
+            super(UploadChunk.Reply, self).__init__(query)
+            self.stored = stored
+
+
+class UploadManifest(ParentCommand):
+    __command__ = 'upload_manifest'
+
+    class Query(IQuery, DefaultCommand):
+
+        def __init__(self, repo, branch, chunks):
+            super(UploadManifest.Query, self).__init__()
+            self.repo = repo
+            self.branch = branch
+            self.chunks = chunks
+
+    class Reply(IReply, DefaultCommand):
+
+        def __init__(self, query, missing):
+            super(UploadManifest.Reply, self).__init__(query)
+            self.missing = missing
+
+
+class FlushEvents(ParentCommand):
+    __command__ = 'flush_events'
+
+    class Query(IQuery, DefaultCommand):
         pass
 
+    class Reply(IReply, DefaultCommand):
+
+        def __init__(self, query, committed):
+            super(FlushEvents.Reply, self).__init__(query)
+            self.committed = committed
+
 
 class Subscribe(DefaultCommand):
     __command__ = 'subscribe'
 
-    def __init__(self, repo, branch, tick, color, name):
+    def __init__(self, repo, branch, tick, color, name,
+                 serializer='json', protocol=PROTOCOL_VERSION):
         super(Subscribe, self).__init__()
         self.repo = repo
         self.branch = branch
         self.tick = tick
         self.color = color
         self.name = name
+        self.serializer = serializer
+        self.protocol = protocol
+
+
+class UpgradeProtocol(DefaultCommand):
+    __command__ = 'upgrade_protocol'
+
+    def __init__(self, version, serializer):
+        super(UpgradeProtocol, self).__init__()
+        self.version = version
+        self.serializer = serializer
 
 
 class Unsubscribe(DefaultCommand):
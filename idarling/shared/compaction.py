@@ -0,0 +1,98 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# The events that set the whole state of what they target, independently of
+# its previous state. The key of such an event is made of its type and of
+# the values of these attributes, and the last event with a given key
+# supersedes all the previous ones. The extra comments are not part of them:
+# applying their event deletes the line then appends the new text at the
+# first free line, which is not always the same one, so they only lead to
+# the same state when all of them are applied in order.
+SUPERSEDING_EVENTS = {
+    'renamed': ('ea',),
+    'cmt_changed': ('ea', 'rptble'),
+    'range_cmt_changed': ('kind', 'start_ea', 'rptble'),
+    'ti_changed': ('ea',),
+    'op_type_changed': ('ea', 'n'),
+    'byte_patched': ('ea',),
+    'user_labels': ('ea',),
+    'user_cmts': ('ea',),
+    'user_iflags': ('ea',),
+    'user_lvar_settings': ('ea',),
+    'user_numforms': ('ea',),
+}
+
+# Names are unique, so dropping a rename could make a later rename of
+# another address fail. A rename only supersedes the previous one with the
+# same address if no other rename happened in between.
+ORDERED_EVENTS = {'renamed'}
+
+
+def is_noop(dct):
+    """
+    Check whether applying an event does nothing. Such an event doesn't set
+    the state of what it targets, so it must not supersede the previous one.
+
+    :param dct: the dictionary of the event
+    :return: whether it does nothing
+    """
+    if dct.get('event_type') == 'ti_changed':
+        # The type is only applied if its type and fields strings are known
+        return len(dct.get('py_type') or ()) < 2
+    return False
+
+
+def event_key(dct):
+    """
+    Get the key of an event that can be superseded.
+
+    :param dct: the dictionary of the event
+    :return: the key, or None if it can't be superseded
+    """
+    fields = SUPERSEDING_EVENTS.get(dct.get('event_type'))
+    if fields is None or is_noop(dct):
+        return None
+    return (dct['event_type'],) + tuple(dct.get(field) for field in fields)
+
+
+class Compactor(object):
+    """
+    An object finding the events superseded by later ones in a sequence of
+    events. The events that remain, applied in the same order, lead to the
+    same state as the whole sequence.
+    """
+
+    def __init__(self):
+        super(Compactor, self).__init__()
+        self._last = {}
+        self._lastOrdered = None
+
+    def add(self, dct, ident):
+        """
+        Add the next event of the sequence.
+
+        :param dct: the dictionary of the event
+        :param ident: the identifier of the event
+        :return: the identifier of the event it supersedes, or None
+        """
+        key = event_key(dct)
+        superseded = None
+        if key is not None:
+            superseded = self._last.get(key)
+            self._last[key] = ident
+
+        if dct.get('event_type') in ORDERED_EVENTS:
+            if self._lastOrdered != key:
+                superseded = None
+            self._lastOrdered = key
+        return superseded
@@ -0,0 +1,82 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+import zlib
+
+from .commands import CHUNK_SIZE
+
+# The databases are compressed using zlib, at the level that favors speed
+# the most: it is far cheaper and only compresses slightly less.
+ZLIB = 'zlib'
+ZLIB_LEVEL = 1
+
+
+def compress(data):
+    """
+    Compress some data in one go.
+
+    :param data: the data
+    :return: the compressed data
+    """
+    return zlib.compress(data, ZLIB_LEVEL)
+
+
+def compress_file(inputPath, outputPath):
+    """
+    Compress a file into another one, one chunk at a time.
+
+    :param inputPath: the path of the file to compress
+    :param outputPath: the path of the compressed file
+    """
+    compressor = zlib.compressobj(ZLIB_LEVEL)
+    with open(inputPath, 'rb') as inputFile, \
+            open(outputPath, 'wb') as outputFile:
+        while True:
+            data = inputFile.read(CHUNK_SIZE)
+            if not data:
+                break
+            outputFile.write(compressor.compress(data))
+        outputFile.write(compressor.flush())
+
+
+class Decompressor(object):
+    """
+    An object decompressing a file one chunk at a time. The file can be made
+    of several zlib streams, as the databases stored as chunks are.
+    """
+
+    def __init__(self):
+        super(Decompressor, self).__init__()
+        self._decompressor = zlib.decompressobj()
+
+    def decompress(self, data):
+        """
+        Decompress some more data.
+
+        :param data: the compressed data
+        :return: the decompressed data
+        """
+        output = []
+        while data:
+            output.append(self._decompressor.decompress(data))
+            data = self._decompressor.unused_data
+            if data:  # The stream has ended, a new one starts
+                self._decompressor = zlib.decompressobj()
+        return b''.join(output)
+
+    def flush(self):
+        """
+        Decompress the data that is still buffered.
+
+        :return: the decompressed data
+        """
+        return self._decompressor.flush()
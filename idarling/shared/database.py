@@ -14,24 +14,39 @@ import json
 import sqlite3
 
 from .models import Repository, Branch
-from .packets import Default, DefaultEvent
+from .packets import Default, DefaultEvent, JSONSerializer
 
 
 class Database(object):
     """
     An utility object used by the server, that be used to query
     asynchronously the underling SQL database.
+
+    The database uses write-ahead logging. The events are inserted within a
+    transaction that stays open until commit() is called, so that the server
+    can group the insertions made during a short period of time. The server
+    only forwards the events once they have been committed, so the events
+    lost if it crashes meanwhile have not been applied by any other client.
     """
+    SYNCHRONOUS_LEVELS = ['off', 'normal', 'full', 'extra']
 
-    def __init__(self, dbpath):
+    def __init__(self, dbpath, synchronous='normal'):
         """
         Initialize the database wrapper.
 
         :param dbpath: the database path
+        :param synchronous: the synchronous level of SQLite
         """
-        self._conn = sqlite3.connect(dbpath, check_same_thread=False)
+        if synchronous not in Database.SYNCHRONOUS_LEVELS:
+            raise ValueError("Invalid synchronous level: %s" % synchronous)
+        self._conn = sqlite3.connect(dbpath, check_same_thread=False,
+                                     cached_statements=256)
         self._conn.isolation_level = None
         self._conn.row_factory = sqlite3.Row
+        self._conn.execute('pragma journal_mode = wal;')
+        self._conn.execute('pragma synchronous = {};'.format(synchronous))
+        self._transaction = False
+        self._statements = {}
 
     def initialize(self):
         """
@@ -69,6 +84,7 @@ class Database(object):
         :param repo: the repository
         """
         self._insert('repos', Default.attrs(repo.__dict__))
+        self.commit()
 
     def select_repo(self, name):
         """
@@ -100,6 +116,7 @@ class Database(object):
         attrs = Default.attrs(branch.__dict__)
         attrs.pop('tick')
         self._insert('branches', attrs)
+        self.commit()
 
     def select_branch(self, repo, name):
         """
@@ -124,34 +141,60 @@ class Database(object):
         results = self._select('branches', {'repo': repo, 'name': name}, limit)
         return [Branch(**result) for result in results]
 
-    def insert_event(self, client, event):
+    def insert_event(self, repo, branch, event):
         """
-        Inserts a new event into the database.
+        Inserts a new event into the database. The event will only be
+        written to the disk once commit() is called.
 
-        :param client: the client
+        :param repo: the repo name
+        :param branch: the branch name
         :param event: the event
         """
-        dct = DefaultEvent.attrs(event.__dict__)
-        self._insert('events', {
-            'repo': client.repo,
-            'branch': client.branch,
-            'tick': event.tick,
-            'dict': json.dumps(dct)
-        })
-
-    def select_events(self, repo, branch, tick):
+        # Reuse the payload if the event was received as JSON. It might
+        # contain an outdated tick, but the one of the row takes precedence.
+        _, payload = event.payloads.get(JSONSerializer, (None, None))
+        if payload is not None:
+            dct = payload.decode('utf-8')
+        else:
+            dct = json.dumps(DefaultEvent.attrs(event.__dict__))
+
+        # A failed insertion is rolled back without the other ones
+        self._begin()
+        self._conn.execute('savepoint event;')
+        try:
+            self._insert('events', {
+                'repo': repo,
+                'branch': branch,
+                'tick': event.tick,
+                'dict': dct
+            })
+        except sqlite3.Error:
+            self._conn.execute('rollback to event;')
+            raise
+        finally:
+            self._conn.execute('release event;')
+
+    def select_events(self, repo, branch, tick, limit=-1, until=None):
         """
-        Get all events sent after the given ticks count.
+        Get the events sent after the given ticks count. The results can be
+        paged by passing the tick of the last event of the previous page.
 
         :param repo: the repository name
         :param branch: the branch name
         :param tick: the ticks count
+        :param limit: the number of results, or -1 if all
+        :param until: the tick of the last event to select, or None if all
         :return: a list of events
         """
         c = self._conn.cursor()
-        sql = 'select * from events where repo = ? and branch = ? ' \
-              'and tick > ? order by tick asc;'
-        c.execute(sql, [repo, branch, tick])
+        if until is None:
+            sql = 'select * from events where repo = ? and branch = ? ' \
+                  'and tick > ? order by tick asc limit ?;'
+            c.execute(sql, [repo, branch, tick, limit])
+        else:
+            sql = 'select * from events where repo = ? and branch = ? ' \
+                  'and tick > ? and tick <= ? order by tick asc limit ?;'
+            c.execute(sql, [repo, branch, tick, until, limit])
         events = []
         for result in c.fetchall():
             dct = json.loads(result['dict'])
@@ -174,6 +217,162 @@ class Database(object):
         result = c.fetchone()
         return result['tick'] if result else 0
 
+    def last_ticks(self):
+        """
+        Get the last tick of every branch that has events.
+
+        :return: a dictionary of the last ticks by (repo, branch)
+        """
+        c = self._conn.cursor()
+        sql = 'select repo, branch, max(tick) as tick from events ' \
+              'group by repo, branch;'
+        c.execute(sql)
+        return {(result['repo'], result['branch']): result['tick']
+                for result in c.fetchall()}
+
+    def find_superseded_events(self, repo, branch, compactor, tick, until,
+                               limit=-1):
+        """
+        Finds the events superseded by later ones, among the events added to
+        the compactor and a page of the following events. The events of a
+        batch are added one by one, so an event is identified by its tick
+        and its index in its batch, or None if it isn't part of one.
+
+        :param repo: the repository name
+        :param branch: the branch name
+        :param compactor: the compactor
+        :param tick: the tick of the last event of the previous page
+        :param until: the tick of the last event to compact
+        :param limit: the number of events of the page, or -1 if all
+        :return: the tick of the last event of the page, or None if it is the
+                 last page, and the superseded events
+        """
+        superseded = []
+        count = 0
+        c = self._conn.cursor()
+        sql = 'select tick, dict from events where repo = ? and branch = ? ' \
+              'and tick > ? and tick <= ? order by tick asc limit ?;'
+        for result in c.execute(sql, [repo, branch, tick, until, limit]):
+            tick = result['tick']
+            count += 1
+            dct = json.loads(result['dict'])
+            if dct.get('event_type') == 'event_batch':
+                events = enumerate(dct['events'])
+            else:
+                events = [(None, dct)]
+            for index, event in events:
+                ident = compactor.add(event, (tick, index))
+                if ident is not None:
+                    superseded.append(ident)
+        if limit < 0 or count < limit:
+            tick = None
+        return tick, superseded
+
+    def delete_events(self, repo, branch, events):
+        """
+        Deletes some events, as identified by find_superseded_events(). The
+        batches are written again without them, or deleted if they become
+        empty. The remaining events keep their tick, so that the clients can
+        continue to replay from their own.
+
+        :param repo: the repository name
+        :param branch: the branch name
+        :param events: the events
+        """
+        indexes = {}
+        for tick, index in events:
+            indexes.setdefault(tick, set()).add(index)
+
+        self._check_committed()
+        self._begin()
+        c = self._conn.cursor()
+        for tick, batchIndexes in indexes.items():
+            dct = None
+            if None not in batchIndexes:
+                sql = 'select dict from events where repo = ? ' \
+                      'and branch = ? and tick = ?;'
+                result = c.execute(sql, [repo, branch, tick]).fetchone()
+                if result is None:
+                    continue
+                dct = json.loads(result['dict'])
+                dct['events'] = [event for index, event
+                                 in enumerate(dct['events'])
+                                 if index not in batchIndexes]
+            if dct and dct['events']:
+                sql = 'update events set dict = ? where repo = ? ' \
+                      'and branch = ? and tick = ?;'
+                c.execute(sql, [json.dumps(dct), repo, branch, tick])
+            else:
+                sql = 'delete from events where repo = ? and branch = ? ' \
+                      'and tick = ?;'
+                c.execute(sql, [repo, branch, tick])
+        self.commit()
+
+    def move_repos(self, dbpath, names):
+        """
+        Moves some repositories, with their branches and events, to another
+        database. The rows already found there are kept, so a move that was
+        interrupted can be run again.
+
+        :param dbpath: the path of the other database
+        :param names: the names of the repositories
+        """
+        target = Database(dbpath)
+        target.initialize()
+        target.close()
+
+        self._check_committed()
+        self._conn.execute('attach database ? as target;', [dbpath])
+        try:
+            self._begin()
+            c = self._conn.cursor()
+            tables = [('repos', 'name'), ('branches', 'repo'),
+                      ('events', 'repo')]
+            for table, col in tables:
+                sql = 'insert or ignore into target.{0} ' \
+                      'select * from main.{0} where {1} = ?;'
+                c.executemany(sql.format(table, col),
+                              [(name,) for name in names])
+            for table, col in reversed(tables):
+                sql = 'delete from main.{} where {} = ?;'
+                c.executemany(sql.format(table, col),
+                              [(name,) for name in names])
+            self.commit()
+        finally:
+            self.rollback()
+            self._conn.execute('detach database target;')
+
+    def close(self):
+        """
+        Closes the database, rolling back the pending transaction if any.
+        """
+        self.rollback()
+        self._conn.close()
+
+    def commit(self):
+        """
+        Commits the pending transaction, if any. It is rolled back if the
+        commit fails.
+        """
+        if self._transaction:
+            try:
+                self._conn.execute('commit;')
+            except sqlite3.Error:
+                self.rollback()
+                raise
+            self._transaction = False
+
+    def rollback(self):
+        """
+        Rolls back the pending transaction, if any.
+        """
+        if self._transaction:
+            self._transaction = False
+            try:
+                self._conn.execute('rollback;')
+            except sqlite3.Error:
+                pass  # SQLite has already rolled it back after an I/O error
+
     def _create(self, table, cols):
         """
         Creates a table with the given name and columns.
@@ -195,13 +394,17 @@ class Database(object):
         :return: the selected rows
         """
         c = self._conn.cursor()
-        sql = 'select * from {}'.format(table)
         fields = {key: val for key, val in fields.items() if val}
-        if len(fields):
-            cols = ['{} = ?'.format(col) for col in fields.keys()]
-            sql = (sql + ' where {}').format(' and '.join(cols))
-        sql += ' limit {};'.format(limit) if limit else ';'
-        c.execute(sql, list(fields.values()))
+        cols = tuple(fields.keys())
+        sql = self._statements.get(('select', table, cols, limit))
+        if sql is None:
+            sql = 'select * from {}'.format(table)
+            if len(cols):
+                where = ['{} = ?'.format(col) for col in cols]
+                sql = (sql + ' where {}').format(' and '.join(where))
+            sql += ' limit {};'.format(limit) if limit else ';'
+            self._statements[('select', table, cols, limit)] = sql
+        c.execute(sql, [fields[col] for col in cols])
         return c.fetchall()
 
     def _insert(self, table, fields):
@@ -211,8 +414,30 @@ class Database(object):
         :param table: the table name
         :param fields: the field and values
         """
+        cols = tuple(fields.keys())
+        sql = self._statements.get(('insert', table, cols))
+        if sql is None:
+            sql = 'insert into {} ({}) values ({});'.format(
+                table, ', '.join(cols), ', '.join(['?'] * len(cols)))
+            self._statements[('insert', table, cols)] = sql
+
+        self._begin()
         c = self._conn.cursor()
-        sql = 'insert into {} ({}) values ({});'
-        keys = ', '.join(fields.keys())
-        vals = ', '.join(['?'] * len(fields))
-        c.execute(sql.format(table, keys, vals), list(fields.values()))
+        c.execute(sql, [fields[col] for col in cols])
+
+    def _check_committed(self):
+        """
+        Checks that no transaction is open, before an operation that commits
+        its own. The events inserted must have been committed first, as
+        committing them along with it would be unknown to the server.
+        """
+        if self._transaction:
+            raise RuntimeError("Inserted events are waiting to be committed")
+
+    def _begin(self):
+        """
+        Opens a transaction that will be committed later, if none is open.
+        """
+        if not self._transaction:
+            self._conn.execute('begin;')
+            self._transaction = True
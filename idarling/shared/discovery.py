@@ -12,26 +12,24 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 import socket
 
-from PyQt5.QtCore import QObject, QSocketNotifier, QTimer
+from .loop import get_loop, Timer
 
 
 DISCOVERY_REQUEST = "IDARLING_DISCOVERY_REQUEST"
 DISCOVERY_REPLY = "IDARLING_DISCOVERY_REPLY"
 
 
-class ClientsDiscovery(QObject):
-    def __init__(self, logger, parent=None):
-        super(ClientsDiscovery, self).__init__(parent)
+class ClientsDiscovery(object):
+    def __init__(self, logger):
+        super(ClientsDiscovery, self).__init__()
         self._logger = logger
         self._info = None
 
         self._socket = None
-        self._read_notifier = None
+        self._fileno = None
         self._started = False
 
-        self._timer = QTimer()
-        self._timer.setInterval(10000)
-        self._timer.timeout.connect(self._send_request)
+        self._timer = Timer(10000, self._send_request)
 
     @property
     def started(self):
@@ -47,18 +45,15 @@ class ClientsDiscovery(QObject):
         self._socket.settimeout(0)
         self._socket.setblocking(0)
 
-        self._read_notifier = QSocketNotifier(
-            self._socket.fileno(), QSocketNotifier.Read, self
-        )
-        self._read_notifier.activated.connect(self._notify_read)
-        self._read_notifier.setEnabled(True)
+        self._fileno = self._socket.fileno()
+        get_loop().add_reader(self._fileno, self._notify_read)
         self._started = True
         self._timer.start()
         self._send_request()
 
     def stop(self):
         self._logger.debug("Stopping clients discovery...")
-        self._read_notifier.setEnabled(False)
+        get_loop().forget(self._fileno)
         try:
             self._socket.close()
         except socket.error:
@@ -85,20 +80,18 @@ class ClientsDiscovery(QObject):
             self._logger.debug("Received discovery reply from %s:%d" % address)
 
 
-class ServersDiscovery(QObject):
-    def __init__(self, logger, parent=None):
-        super(ServersDiscovery, self).__init__(parent)
+class ServersDiscovery(object):
+    def __init__(self, logger):
+        super(ServersDiscovery, self).__init__()
         self._logger = logger
         self._active = []
         self._servers = []
 
         self._socket = None
-        self._read_notifier = None
+        self._fileno = None
         self._started = False
 
-        self._timer = QTimer()
-        self._timer.setInterval(10000)
-        self._timer.timeout.connect(self._trim_replies)
+        self._timer = Timer(10000, self._trim_replies)
 
     @property
     def servers(self):
@@ -116,17 +109,14 @@ class ServersDiscovery(QObject):
         self._socket.settimeout(0)
         self._socket.setblocking(0)
 
-        self._read_notifier = QSocketNotifier(
-            self._socket.fileno(), QSocketNotifier.Read, self
-        )
-        self._read_notifier.activated.connect(self._notify_read)
-        self._read_notifier.setEnabled(True)
+        self._fileno = self._socket.fileno()
+        get_loop().add_reader(self._fileno, self._notify_read)
         self._started = True
         self._timer.start()
 
     def stop(self):
         self._logger.debug("Stopping servers discovery...")
-        self._read_notifier.setEnabled(False)
+        get_loop().forget(self._fileno)
         try:
             self._socket.close()
         except socket.errno:
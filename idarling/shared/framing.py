@@ -0,0 +1,70 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+import collections
+import struct
+
+# Version 1 sends every packet as a line of JSON terminated by a newline.
+# Version 2 prefixes every packet with a fixed-size binary header, so the
+# receiver knows the length and kind of a packet before decoding it.
+# Version 3 has the same framing, and adds the transfer of the databases in
+# chunks, that older servers would store as if each was the whole database,
+# and the flush_events command, that older servers don't know.
+PROTOCOL_V1 = 1
+PROTOCOL_V2 = 2
+PROTOCOL_V3 = 3
+PROTOCOL_VERSION = PROTOCOL_V3
+
+# The magic byte can never start a line of JSON (it is not valid UTF-8),
+# which allows both framings to be told apart on a per-packet basis.
+FRAME_MAGIC = 0xff
+
+# magic, kind, flags, serializer, payload length, event tick
+FRAME_HEADER = struct.Struct('!BBBBIq')
+
+FRAME_COMMAND = 1
+FRAME_EVENT = 2
+
+FLAG_CONTAINER = 0x01
+
+FrameHeader = collections.namedtuple('FrameHeader', ['kind', 'flags',
+                                                     'serializer', 'length',
+                                                     'tick'])
+
+
+def build_frame(kind, flags, serializer, tick, payload):
+    """
+    Build a version 2 frame from its header fields and payload.
+
+    :param kind: the kind of packet
+    :param flags: the frame flags
+    :param serializer: the identifier of the serializer of the payload
+    :param tick: the tick of the event, or 0 for a command
+    :param payload: the encoded packet
+    :return: the frame bytes
+    """
+    header = FRAME_HEADER.pack(FRAME_MAGIC, kind, flags, serializer,
+                               len(payload), tick)
+    return header + payload
+
+
+def parse_header(data):
+    """
+    Parse the header of a version 2 frame.
+
+    :param data: the header bytes
+    :return: the frame header
+    """
+    magic, kind, flags, serializer, length, tick = FRAME_HEADER.unpack(data)
+    if magic != FRAME_MAGIC:
+        raise ValueError("Invalid frame magic: %#x" % magic)
+    return FrameHeader(kind, flags, serializer, length, tick)
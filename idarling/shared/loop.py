@@ -0,0 +1,418 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+import functools
+import signal
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue  # Python 2
+
+
+class Loop(object):
+    """
+    The interface of the event loop that the sockets and the timers of the
+    shared modules are integrated into. Within IDA, this is the Qt event
+    loop. The dedicated server uses an asyncio event loop instead, so that
+    it doesn't depend on PyQt5. All the delays are in milliseconds.
+    """
+
+    def add_reader(self, fd, callback):
+        """
+        Call a function when a file descriptor is ready for reading.
+
+        :param fd: the file descriptor
+        :param callback: the function
+        """
+        raise NotImplementedError("add_reader() not implemented")
+
+    def remove_reader(self, fd):
+        """
+        Stop watching a file descriptor for reading.
+
+        :param fd: the file descriptor
+        """
+        raise NotImplementedError("remove_reader() not implemented")
+
+    def add_writer(self, fd, callback):
+        """
+        Call a function when a file descriptor is ready for writing.
+
+        :param fd: the file descriptor
+        :param callback: the function
+        """
+        raise NotImplementedError("add_writer() not implemented")
+
+    def remove_writer(self, fd):
+        """
+        Stop watching a file descriptor for writing.
+
+        :param fd: the file descriptor
+        """
+        raise NotImplementedError("remove_writer() not implemented")
+
+    def forget(self, fd):
+        """
+        Stop watching a file descriptor that is about to be closed, and free
+        what was allocated to watch it.
+
+        :param fd: the file descriptor
+        """
+        raise NotImplementedError("forget() not implemented")
+
+    def call_soon(self, callback):
+        """
+        Call a function once control returns to the event loop.
+
+        :param callback: the function
+        """
+        raise NotImplementedError("call_soon() not implemented")
+
+    def call_soon_threadsafe(self, callback):
+        """
+        Call a function once control returns to the event loop, from any
+        thread.
+
+        :param callback: the function
+        """
+        raise NotImplementedError("call_soon_threadsafe() not implemented")
+
+    def call_later(self, delay, callback):
+        """
+        Call a function after a delay.
+
+        :param delay: the delay
+        :param callback: the function
+        :return: a handle with a cancel() method
+        """
+        raise NotImplementedError("call_later() not implemented")
+
+
+class QtLoop(Loop):
+    """
+    The implementation of the loop using the Qt event loop.
+    """
+
+    def __init__(self):
+        super(QtLoop, self).__init__()
+        from PyQt5.QtCore import (QObject, QSocketNotifier, QTimer, Qt,
+                                  pyqtSignal)
+        self._QSocketNotifier = QSocketNotifier
+        self._QTimer = QTimer
+
+        # The signals emitted from other threads are queued to this one
+        class Invoker(QObject):
+            invoked = pyqtSignal(object)
+
+        self._invoker = Invoker()
+        self._invoker.invoked.connect(lambda callback: callback(),
+                                      Qt.QueuedConnection)
+
+        # The notifiers are only disabled when removed, so they can be
+        # enabled again cheaply, like the write notifier of a socket is.
+        # They are deleted once their file descriptor is forgotten.
+        self._notifiers = {}
+        self._callbacks = {}
+
+    def _add_notifier(self, fd, kind, callback):
+        key = (fd, kind)
+        self._callbacks[key] = callback
+        notifier = self._notifiers.get(key)
+        if notifier is None:
+            # The parent owns it, so that it is only deleted by Qt
+            notifier = self._QSocketNotifier(fd, kind, self._invoker)
+            notifier.activated.connect(lambda *_: self._callbacks[key]())
+            self._notifiers[key] = notifier
+        notifier.setEnabled(True)
+
+    def _remove_notifier(self, fd, kind):
+        notifier = self._notifiers.get((fd, kind))
+        if notifier is not None:
+            notifier.setEnabled(False)
+
+    def add_reader(self, fd, callback):
+        self._add_notifier(fd, self._QSocketNotifier.Read, callback)
+
+    def remove_reader(self, fd):
+        self._remove_notifier(fd, self._QSocketNotifier.Read)
+
+    def add_writer(self, fd, callback):
+        self._add_notifier(fd, self._QSocketNotifier.Write, callback)
+
+    def remove_writer(self, fd):
+        self._remove_notifier(fd, self._QSocketNotifier.Write)
+
+    def forget(self, fd):
+        for kind in (self._QSocketNotifier.Read, self._QSocketNotifier.Write):
+            notifier = self._notifiers.pop((fd, kind), None)
+            self._callbacks.pop((fd, kind), None)
+            if notifier is not None:
+                # It might be the one being activated
+                notifier.setEnabled(False)
+                notifier.deleteLater()
+
+    def call_soon(self, callback):
+        self._QTimer.singleShot(0, callback)
+
+    def call_soon_threadsafe(self, callback):
+        self._invoker.invoked.emit(callback)
+
+    def call_later(self, delay, callback):
+        # The parent owns the timer, so that it isn't collected with the
+        # handle, it is deleted once it fired or was cancelled
+        timer = self._QTimer(self._invoker)
+        timer.setSingleShot(True)
+        handle = _QtHandle(timer)
+
+        def fire():
+            handle.cancel()
+            callback()
+        timer.timeout.connect(fire)
+        timer.start(delay)
+        return handle
+
+
+class _QtHandle(object):
+    """
+    A handle on a function called after a delay by the Qt loop.
+    """
+
+    def __init__(self, timer):
+        self._timer = timer
+
+    def cancel(self):
+        if self._timer is not None:
+            self._timer.stop()
+            self._timer.deleteLater()
+            self._timer = None
+
+
+class AsyncioLoop(Loop):
+    """
+    The implementation of the loop using an asyncio event loop, which relies
+    on the selectors module. It requires Python 3.
+    """
+
+    def __init__(self):
+        super(AsyncioLoop, self).__init__()
+        import asyncio
+        # The proactor loop of Windows cannot watch file descriptors
+        self._loop = asyncio.SelectorEventLoop()
+        asyncio.set_event_loop(self._loop)
+
+    def add_reader(self, fd, callback):
+        self._loop.add_reader(fd, callback)
+
+    def remove_reader(self, fd):
+        self._loop.remove_reader(fd)
+
+    def add_writer(self, fd, callback):
+        self._loop.add_writer(fd, callback)
+
+    def remove_writer(self, fd):
+        self._loop.remove_writer(fd)
+
+    def forget(self, fd):
+        self._loop.remove_reader(fd)
+        self._loop.remove_writer(fd)
+
+    def call_soon(self, callback):
+        self._loop.call_soon(callback)
+
+    def call_soon_threadsafe(self, callback):
+        self._loop.call_soon_threadsafe(callback)
+
+    def call_later(self, delay, callback):
+        return self._loop.call_later(delay / 1000.0, callback)
+
+    def add_signal_handler(self, signum, callback):
+        """
+        Call a function when a signal is received.
+
+        :param signum: the signal number
+        :param callback: the function
+        """
+        try:
+            self._loop.add_signal_handler(signum, callback)
+        except (NotImplementedError, RuntimeError):
+            # Windows has no support for it, the handler will run the next
+            # time the loop wakes up
+            signal.signal(signum, lambda *_: self._loop.call_soon_threadsafe(
+                callback))
+
+    def run(self):
+        """
+        Run the loop until it is stopped.
+        """
+        try:
+            self._loop.run_forever()
+        finally:
+            self._loop.close()
+
+    def stop(self):
+        """
+        Stop the loop after the current iteration.
+        """
+        self._loop.stop()
+
+
+class Timer(object):
+    """
+    A timer calling a function after an interval, either once or until it is
+    stopped, using the current loop.
+    """
+
+    def __init__(self, interval, callback, single_shot=False):
+        """
+        Initialize the timer.
+
+        :param interval: the interval
+        :param callback: the function
+        :param single_shot: call the function only once?
+        """
+        super(Timer, self).__init__()
+        self._interval = interval
+        self._callback = callback
+        self._single_shot = single_shot
+        self._handle = None
+
+    @property
+    def active(self):
+        """
+        Get if the timer is running.
+
+        :return: is running?
+        """
+        return self._handle is not None
+
+    def start(self):
+        """
+        Start the timer, or restart it if it is already running.
+        """
+        self.stop()
+        self._handle = get_loop().call_later(self._interval, self._timeout)
+
+    def stop(self):
+        """
+        Stop the timer.
+        """
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def _timeout(self):
+        # The next call is scheduled first, so that it happens even if this
+        # one raises an exception
+        self._handle = None
+        if not self._single_shot:
+            self.start()
+        self._callback()
+
+
+class ThreadPool(object):
+    """
+    A bounded pool of threads running the blocking functions, like the file
+    and database accesses, outside of the current loop. The results are
+    passed to callbacks, and the exceptions to errbacks, that are called
+    from the loop. A pool with a single thread runs the functions in the
+    order they were submitted.
+    """
+
+    def __init__(self, size, logger):
+        """
+        Initialize the pool and start its threads.
+
+        :param size: the number of threads
+        :param logger: the logger to use
+        """
+        super(ThreadPool, self).__init__()
+        self._logger = logger
+        self._loop = get_loop()
+        self._tasks = queue.Queue()
+        self._stopped = False
+        self._threads = []
+        for _ in range(size):
+            thread = threading.Thread(target=self._run)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, func, callback=None, errback=None):
+        """
+        Run a function on one of the threads.
+
+        :param func: the function, without arguments
+        :param callback: the function called from the loop with the result
+        :param errback: the function called from the loop with the exception
+                        raised by the function, otherwise it is only logged
+        """
+        self._tasks.put((func, callback, errback))
+
+    def shutdown(self):
+        """
+        Wait for the submitted functions to be run, then stop the threads.
+        The callbacks that haven't been called yet are dropped.
+        """
+        self._stopped = True
+        for _ in self._threads:
+            self._tasks.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def _run(self):
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                break
+            func, callback, errback = task
+            try:
+                result = func()
+            except Exception as e:
+                if errback is None:
+                    self._logger.exception(e)
+                    continue
+                callback, result = errback, e
+            if callback is not None:
+                self._loop.call_soon_threadsafe(
+                    functools.partial(self._complete, callback, result))
+
+    def _complete(self, callback, result):
+        if not self._stopped:
+            callback(result)
+
+
+_loop = None
+
+
+def get_loop():
+    """
+    Get the current loop, which is the Qt loop unless another one was set.
+
+    :return: the loop
+    """
+    global _loop
+    if _loop is None:
+        _loop = QtLoop()
+    return _loop
+
+
+def set_loop(loop):
+    """
+    Set the current loop. It must be done before any socket is created.
+
+    :param loop: the loop
+    """
+    global _loop
+    _loop = loop
@@ -12,6 +12,9 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 import collections
 import itertools
+import json
+
+from . import binary
 
 
 def with_metaclass(meta, *bases):
@@ -104,6 +107,112 @@ class Default(Serializable):
         self.__dict__.update(Default.attrs(dct))
 
 
+class SerializerFactory(type):
+    """
+    A factory class used to find the serializers by name or by identifier.
+    """
+    _NAMES = {}
+    _IDS = {}
+
+    @staticmethod
+    def __new__(mcs, name, bases, attrs):
+        """
+        Register a new serializer class in the factory.
+
+        :param name: the name of the new class
+        :param bases: the base classes of the new class
+        :param attrs: the attributes of the new class
+        :return: the newly created class
+        """
+        cls = super(SerializerFactory, mcs).__new__(mcs, name, bases, attrs)
+        if cls.__serializer__ is not None:
+            SerializerFactory._NAMES[cls.__serializer__] = cls
+            SerializerFactory._IDS[cls.__serializer_id__] = cls
+        return cls
+
+    @classmethod
+    def get_class(mcs, name):
+        """
+        Get the serializer class with the given name.
+
+        :param name: the name
+        :return: the serializer class or None
+        """
+        return SerializerFactory._NAMES.get(name)
+
+    @classmethod
+    def get_class_by_id(mcs, id):
+        """
+        Get the serializer class with the given identifier.
+
+        :param id: the identifier
+        :return: the serializer class
+        """
+        return SerializerFactory._IDS[id]
+
+
+class Serializer(with_metaclass(SerializerFactory, object)):
+    """
+    The base class for the backends used to encode the dictionaries built by
+    the packets into bytes. The backend to use is selected per connection.
+    """
+    __serializer__ = None
+    __serializer_id__ = None
+
+    @staticmethod
+    def dumps(dct):
+        """
+        Encode a dictionary into bytes.
+
+        :param dct: the dictionary
+        :return: the bytes
+        """
+        raise NotImplementedError("dumps() not implemented")
+
+    @staticmethod
+    def loads(data):
+        """
+        Decode a dictionary from bytes.
+
+        :param data: the bytes
+        :return: the dictionary
+        """
+        raise NotImplementedError("loads() not implemented")
+
+
+class JSONSerializer(Serializer):
+    """
+    The default serializer, it is understood by every version of the protocol.
+    """
+    __serializer__ = 'json'
+    __serializer_id__ = 0
+
+    @staticmethod
+    def dumps(dct):
+        return json.dumps(dct).encode('utf-8')
+
+    @staticmethod
+    def loads(data):
+        return json.loads(data.decode('utf-8'))
+
+
+class BinarySerializer(Serializer):
+    """
+    A compact MessagePack serializer, implemented in pure Python. It produces
+    smaller packets than JSON at the expense of more CPU time.
+    """
+    __serializer__ = 'msgpack'
+    __serializer_id__ = 1
+
+    @staticmethod
+    def dumps(dct):
+        return binary.pack(dct)
+
+    @staticmethod
+    def loads(data):
+        return binary.unpack(data)
+
+
 class PacketFactory(type):
     """
     A factory class used to instantiate packets as they come from the network.
@@ -156,17 +265,18 @@ class Packet(with_metaclass(PacketFactory, Serializable)):
         assert self.__type__ is not None, "__type__ not implemented"
 
     @staticmethod
-    def parse_packet(dct, server=False):
+    def parse_packet(dct, server=False, initback=True):
         """
         Parse a packet from a dictionary.
 
         :param dct: the dictionary
         :param server: server client?
+        :param initback: trigger the initback of a reply?
         :return: the packet
         """
         cls = PacketFactory.get_class(dct, server)
         packet = cls.new(dct)
-        if isinstance(packet, Reply):
+        if initback and isinstance(packet, Reply):
             packet.trigger_initback()
         return packet
 
@@ -331,6 +441,7 @@ class Event(with_metaclass(EventFactory, Packet)):
         super(Event, self).__init__()
         assert self.__event__ is not None, "__event__ not implemented"
         self._tick = 0
+        self._payloads = {}
 
     def build(self, dct):
         dct['type'] = self.__type__
@@ -341,6 +452,7 @@ class Event(with_metaclass(EventFactory, Packet)):
 
     def parse(self, dct):
         self._tick = dct.pop('tick')
+        self._payloads = {}
         self.parse_event(dct)
         return self
 
@@ -378,6 +490,17 @@ class Event(with_metaclass(EventFactory, Packet)):
         """
         self._tick = tick
 
+    @property
+    def payloads(self):
+        """
+        Get the encoded forms of the event, indexed by serializer. Each entry
+        is a tuple of the tick that was encoded and of the payload bytes. This
+        allows the server to forward an event without encoding it again.
+
+        :return: the payloads
+        """
+        return self._payloads
+
 
 class DefaultEvent(Default, Event):
     """
@@ -10,26 +10,91 @@
 
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
+import collections
 import logging
 import os
+import re
 import socket
 import ssl
+import threading
+import time
+from functools import partial
 
+from .compaction import Compactor
+from .compression import ZLIB, compress_file, Decompressor
 from .database import Database
 from .discovery import ClientsDiscovery
 from .commands import (GetRepositories, GetBranches,
                        NewRepository, NewBranch,
                        UploadDatabase, DownloadDatabase,
-                       Subscribe, Unsubscribe,
-                       UpdateCursors, RenamedUser)
-from .packets import Command, Event
+                       GetMissingChunks, UploadChunk, UploadManifest,
+                       FlushEvents, Subscribe, Unsubscribe, UpgradeProtocol,
+                       UpdateCursors, RenamedUser, CHUNK_SIZE)
+from .framing import PROTOCOL_V1, PROTOCOL_V2, PROTOCOL_V3, PROTOCOL_VERSION
+from .loop import ThreadPool, Timer
+from .packets import (Command, Event, Packet, SerializerFactory,
+                      JSONSerializer)
 from .sockets import ClientSocket, ServerSocket
+from .storage import ChunkStore, Manifest, replace_file
+
+# The identifiers of the uploads are part of the names of their files
+UPLOAD_ID = re.compile(r'[0-9A-Za-z_-]{1,64}\Z')
+
+
+def create_ssl_context(sslcfg, logger):
+    """
+    Create the SSL context of a server from its configuration.
+
+    :param sslcfg: the SSL configuration
+    :param logger: the logger to use
+    :return: the SSL context
+    """
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    # First check if we should have a context setup
+    if sslcfg["server_ssl_mode"]:
+        context.load_cert_chain(certfile=sslcfg["server_ssl_cert_path"])
+        logger.info("Load_cert_chain %s" % (sslcfg["server_ssl_cert_path"]))
+    if sslcfg["client_ssl_mode"]:
+        context.verify_mode |= ssl.CERT_REQUIRED
+        context.load_verify_locations(cafile=sslcfg["client_ssl_cert_path"])
+        logger.info("Load_verify_locations %s" %
+                    (sslcfg["client_ssl_cert_path"]))
+    logger.info(context.cert_store_stats())
+    return context
+
+
+def listen_socket(host, port, logger):
+    """
+    Create a non-blocking socket listening on the specified host and port.
+
+    :param host: the host
+    :param port: the port
+    :param logger: the logger to use
+    :return: the socket, or None if it failed
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    try:
+        sock.bind((host, port))
+    except socket.error as e:
+        logger.warning("Could not start server")
+        logger.exception(e)
+        return None
+    sock.settimeout(0)
+    sock.setblocking(0)
+    sock.listen(5)
+    return sock
 
 
 class ServerClient(ClientSocket):
     """
     The client (server-side) implementation.
     """
+    REPLAY_PAGE_SIZE = 256
+
+    # The cursor of a client is forwarded at most once every CURSOR_INTERVAL
+    # milliseconds, the updates received meanwhile replace each other
+    CURSOR_INTERVAL = 50
 
     def __init__(self, logger, parent=None):
         ClientSocket.__init__(self, logger, parent)
@@ -38,12 +103,19 @@ class ServerClient(ClientSocket):
         self._color = None
         self._name = None
         self._handlers = {}
+        self._replayTick = None
+        self._replayRequest = None
+        self._syncTick = 0
+        self._manifest = None
+        self._cursor = None
+        self._cursorTimer = Timer(ServerClient.CURSOR_INTERVAL,
+                                  self._forward_cursor, single_shot=True)
 
-    def connect(self, sock):
+    def connect(self, sock, address=None):
         ClientSocket.connect(self, sock)
 
         # Add host and port as a prefix to our logger
-        prefix = '%s:%d' % sock.getpeername()
+        prefix = '%s:%d' % tuple(address or sock.getpeername())
 
         class CustomAdapter(logging.LoggerAdapter):
             def process(self, msg, kwargs):
@@ -60,6 +132,10 @@ class ServerClient(ClientSocket):
             NewBranch.Query: self._handle_new_branch,
             UploadDatabase.Query: self._handle_upload_database,
             DownloadDatabase.Query: self._handle_download_database,
+            GetMissingChunks.Query: self._handle_get_missing_chunks,
+            UploadChunk.Query: self._handle_upload_chunk,
+            UploadManifest.Query: self._handle_upload_manifest,
+            FlushEvents.Query: self._handle_flush_events,
             Subscribe: self._handle_subscribe,
             Unsubscribe: self._handle_unsubscribe,
             UpdateCursors: self._handle_update_cursors,
@@ -84,7 +160,19 @@ class ServerClient(ClientSocket):
         """
         return self._branch
 
+    @property
+    def replaying(self):
+        """
+        Get if the client is still being sent the events it missed.
+
+        :return: is it replaying
+        """
+        return self._replayTick is not None
+
     def disconnect(self, err=None):
+        self._replayTick = None
+        self._cursor = None
+        self._cursorTimer.stop()
         ClientSocket.disconnect(self, err)
         self.parent().unregister_client(self)
         self._logger.info("Disconnected")
@@ -101,66 +189,412 @@ class ServerClient(ClientSocket):
                 return True
 
             # Check for de-synchronization
-            tick = self.parent().database.last_tick(self.repo, self.branch)
+            tick = self.parent().last_tick(self.repo, self.branch)
             if tick >= packet.tick:
                 self._logger.warning("De-synchronization detected!")
                 packet.tick = tick + 1
 
-            # Save the event into the database
-            self.parent().database.insert_event(self, packet)
-
-            # Forward the event to the other clients
-            for client in self.parent().find_clients(self._should_forward):
-                client.send_packet(packet)
+            # Save the event into the database, the other clients will be
+            # sent it once it has been committed
+            self.parent().save_event(self, packet)
         else:
             return False
         return True
 
+    def forward_event(self, event):
+        """
+        Send an event received from another client, once it has been
+        committed. The events received before the end of the replay were
+        read from the database by the replay instead.
+
+        :param event: the event
+        """
+        if not self.replaying and event.tick > self._syncTick:
+            self._send_event(event)
+
+    def _send_event(self, event):
+        """
+        Send an event to the client. The batches of events are only known
+        since version 3 of the protocol, so older clients are sent the
+        events of a batch one by one, all with the tick of the batch.
+
+        :param event: the event
+        """
+        if getattr(event, 'event_type', None) != 'event_batch' \
+                or self.protocol >= PROTOCOL_V3:
+            self.send_packet(event)
+            return
+
+        # The events are only created once for all the older clients
+        events = getattr(event, '_events', None)
+        if events is None:
+            events = [Packet.parse_packet(dict(dct, tick=event.tick), True)
+                      for dct in event.events]
+            event._events = events
+        for packet in events:
+            self.send_packet(packet)
+
+    def _outgoing_drained(self):
+        if self.replaying:
+            self._replay_events()
+
+    def _replay_events(self):
+        """
+        Read the next page of missed events. The next page is only read from
+        the database once this one has been written to the socket, so that
+        the memory used does not depend on the number of missed events.
+        """
+        request = (self._repo, self._branch, self._replayTick)
+        if request == self._replayRequest:
+            return  # The page is already being read
+        self._replayRequest = request
+        # Like the forwarded events, only the committed ones are sent
+        select = partial(self.parent().database.select_events,
+                         *(request + (ServerClient.REPLAY_PAGE_SIZE,
+                                      self.parent().committed_tick(
+                                          self._repo, self._branch))))
+        self.parent().run_database(select,
+                                   partial(self._send_missed_events, request),
+                                   self._replay_failed)
+
+    def _replay_failed(self, e):
+        """
+        Called when a page of missed events couldn't be read.
+
+        :param e: the exception
+        """
+        self._replayRequest = None
+        self._replayTick = None
+        self._access_failed(e)
+
+    def _send_missed_events(self, request, events):
+        """
+        Send a page of missed events, once it has been read.
+
+        :param request: the repo, branch and tick the page was read from
+        :param events: the events
+        """
+        self._replayRequest = None
+        if request != (self._repo, self._branch, self._replayTick):
+            # The client has unsubscribed, or subscribed again, meanwhile
+            if self.replaying:
+                self._replay_events()
+            return
+
+        self._logger.debug('Sending %d missed events' % len(events))
+        for event in events:
+            self._send_event(event)
+        if events:
+            self._replayTick = events[-1].tick
+
+        # The events committed while the page was being read were not
+        # forwarded, they will be read with the next page
+        tick = self.parent().committed_tick(self._repo, self._branch)
+        if len(events) < ServerClient.REPLAY_PAGE_SIZE \
+                and self._replayTick >= tick:
+            self._replayTick = None
+            self._syncTick = tick
+        elif not events:
+            self._replay_events()
+
     def _handle_get_repositories(self, query):
-        repos = self.parent().database.select_repos()
-        self.send_packet(GetRepositories.Reply(query, repos))
+        def send_reply(repos):
+            self.send_packet(GetRepositories.Reply(query, repos))
+
+        self.parent().run_database(self.parent().database.select_repos,
+                                   send_reply, self._access_failed)
 
     def _handle_get_branches(self, query):
-        branches = self.parent().database.select_branches(query.repo)
-        for branch in branches:
-            branchInfo = branch.repo, branch.name
-            fileName = '%s_%s.idb' % branchInfo
-            filePath = self.parent().local_file(fileName)
-            if os.path.isfile(filePath):
-                branch.tick = self.parent().database.last_tick(*branchInfo)
-            else:
-                branch.tick = -1
-        self.send_packet(GetBranches.Reply(query, branches))
+        def send_reply(branches):
+            for branch in branches:
+                branchInfo = branch.repo, branch.name
+                filePath, _ = self._database_file(branch)
+                if os.path.isfile(filePath):
+                    branch.tick = self.parent().last_tick(*branchInfo)
+                else:
+                    branch.tick = -1
+            self.send_packet(GetBranches.Reply(query, branches))
+
+        self.parent().run_database(
+            partial(self.parent().database.select_branches, query.repo),
+            send_reply, self._access_failed)
 
     def _handle_new_repository(self, query):
-        self.parent().database.insert_repo(query.repo)
-        self.send_packet(NewRepository.Reply(query))
+        self.parent().run_database(
+            partial(self.parent().database.insert_repo, query.repo),
+            lambda _: self.send_packet(NewRepository.Reply(query)),
+            self._access_failed)
 
     def _handle_new_branch(self, query):
-        self.parent().database.insert_branch(query.branch)
-        self.send_packet(NewBranch.Reply(query))
+        self.parent().run_database(
+            partial(self.parent().database.insert_branch, query.branch),
+            lambda _: self.send_packet(NewBranch.Reply(query)),
+            self._access_failed)
 
     def _handle_upload_database(self, query):
-        branch = self.parent().database.select_branch(query.repo, query.branch)
+        def write_chunk(branch):
+            self.parent().run_files(partial(self._write_database, branch,
+                                            query), send_reply,
+                                    self._access_failed)
+
+        def send_reply(offset):
+            self.send_packet(UploadDatabase.Reply(query, offset))
+            # The manifest the database replaced might have been the last
+            # one referencing some chunks
+            total = getattr(query, 'total', None)
+            if total is None or offset >= total:
+                self.parent().run_files(partial(self.parent().collect_chunks,
+                                                query.repo))
+
+        self.parent().run_database(
+            partial(self.parent().database.select_branch, query.repo,
+                    query.branch), write_chunk, self._access_failed)
+
+    def _write_database(self, branch, query):
+        """
+        Write a chunk of a database being uploaded. It is run on a files
+        thread.
+
+        :param branch: the branch
+        :param query: the upload query
+        :return: the offset the client should continue from
+        """
         fileName = '%s_%s.idb' % (branch.repo, branch.name)
         filePath = self.parent().local_file(fileName)
+        # Several clients can upload the same database at the same time, so
+        # each upload has its own partial file. Without identifier, it can
+        # only be resumed from the same connection.
+        upload = getattr(query, 'upload', None)
+        if upload is not None and UPLOAD_ID.match(u'%s' % upload):
+            partPath = '%s.u%s.part' % (filePath, upload)
+        else:
+            partPath = '%s.c%x.part' % (filePath, id(self))
+
+        # Older clients send the whole file at once
+        offset = getattr(query, 'offset', 0)
+        total = getattr(query, 'total', None)
+        if total is None:
+            total = offset + len(query.content)
 
-        # Write the file received to disk
-        with open(filePath, 'wb') as outputFile:
+        # The chunks must be contiguous, the client resumes from our offset
+        received = 0
+        if offset and os.path.isfile(partPath):
+            received = os.path.getsize(partPath)
+        if offset > received:
+            self._logger.warning("Received chunk at %d, expected %d"
+                                 % (offset, received))
+            return received
+
+        # Write the chunk received to the partial file
+        with open(partPath, 'r+b' if offset else 'wb') as outputFile:
+            outputFile.seek(offset)
             outputFile.write(query.content)
-        self._logger.info("Saved file %s" % fileName)
-        self.send_packet(UploadDatabase.Reply(query))
+            outputFile.truncate()
+        offset += len(query.content)
+
+        # Replace the file once it has been entirely received
+        if offset >= total:
+            if getattr(query, 'compression', None) != ZLIB:
+                compress_file(partPath, partPath + '.zlib')
+                os.remove(partPath)
+                partPath += '.zlib'
+            replace_file(partPath, filePath + '.zlib')
+            # The manifest takes precedence, so it is only removed afterwards
+            for path in (filePath, filePath + '.manifest'):
+                if os.path.exists(path):
+                    os.remove(path)
+            self._logger.info("Saved file %s" % fileName)
+        return offset
 
     def _handle_download_database(self, query):
-        branch = self.parent().database.select_branch(query.repo, query.branch)
+        def read_chunk(branch):
+            self.parent().run_files(partial(self._read_database_reply,
+                                            branch, query), self.send_packet,
+                                    self._access_failed)
+
+        self.parent().run_database(
+            partial(self.parent().database.select_branch, query.repo,
+                    query.branch), read_chunk, self._access_failed)
+
+    def _read_database_reply(self, branch, query):
+        """
+        Read a chunk of a database being downloaded. It is run on a files
+        thread.
+
+        :param branch: the branch
+        :param query: the download query
+        :return: the reply containing the chunk
+        """
+        filePath, compression = self._database_file(branch)
+
+        # Older clients ask for the whole file at once
+        offset = getattr(query, 'offset', 0)
+        size = getattr(query, 'size', None)
+
+        # Older clients don't support compression, so they are sent a
+        # decompressed copy of the file
+        if compression == ZLIB and getattr(query, 'compression', None) != ZLIB:
+            content, total = self.parent().read_decompressed_file(
+                filePath, partial(self._read_database, branch, filePath),
+                offset, size)
+            reply = DownloadDatabase.Reply(query, offset, total)
+            reply.content = content
+            return reply
+
+        # Read the chunk from disk
+        reply = DownloadDatabase.Reply(query, offset, 0, compression)
+        reply.content = self._read_database(branch, filePath, offset, size)
+        if filePath.endswith('.manifest'):
+            reply.total = self._load_manifest(branch, filePath).stored_size
+        else:
+            reply.total = os.path.getsize(filePath)
+        return reply
+
+    def _handle_get_missing_chunks(self, query):
+        def find_missing(store):
+            return [digest for digest in query.digests
+                    if store is None or not store.keep_chunk(digest)]
+
+        self._run_chunks(query.repo, find_missing, lambda digests:
+                         self.send_packet(GetMissingChunks.Reply(query,
+                                                                 digests)))
+
+    def _handle_upload_chunk(self, query):
+        def put_chunk(store):
+            if store is None:
+                return False
+            return store.put_chunk(query.digest, query.content,
+                                   query.compression)
+
+        def send_reply(stored):
+            if not stored:
+                self._logger.warning("Could not store chunk %s"
+                                     % query.digest)
+            self.send_packet(UploadChunk.Reply(query, stored))
+
+        self._run_chunks(query.repo, put_chunk, send_reply)
+
+    def _run_chunks(self, name, func, callback):
+        """
+        Run a function accessing the chunk store of a repository on a files
+        thread. It is passed None instead if the repository doesn't exist or
+        if its name is invalid, so that a client can never access the files
+        outside of the chunk stores.
+
+        :param name: the repo name
+        :param func: the function, taking the chunk store
+        :param callback: the function called with the result
+        """
+        def repo_selected(repo):
+            store = None
+            if repo is not None and repo.name == name:
+                try:
+                    store = self.parent().chunk_store(name)
+                except ValueError as e:
+                    self._logger.warning(str(e))
+            self.parent().run_files(partial(func, store), callback,
+                                    self._access_failed)
+
+        self.parent().run_database(
+            partial(self.parent().database.select_repo, name),
+            repo_selected, self._access_failed)
+
+    def _handle_upload_manifest(self, query):
+        def save_manifest(branch):
+            self.parent().run_files(partial(self._save_manifest, branch,
+                                            query), send_reply,
+                                    self._access_failed)
+
+        def send_reply(missing):
+            self.send_packet(UploadManifest.Reply(query, missing))
+            if not missing:
+                self.parent().run_files(partial(self.parent().collect_chunks,
+                                                query.repo))
+
+        self.parent().run_database(
+            partial(self.parent().database.select_branch, query.repo,
+                    query.branch), save_manifest, self._access_failed)
+
+    def _save_manifest(self, branch, query):
+        """
+        Save the manifest of a database uploaded as chunks. It is run on a
+        files thread.
+
+        :param branch: the branch
+        :param query: the upload query
+        :return: the digests of the chunks that are missing
+        """
+        fileName = '%s_%s.idb' % (branch.repo, branch.name)
+        filePath = self.parent().local_file(fileName)
+
+        # All the chunks must have been uploaded first
+        store = self.parent().chunk_store(branch.repo)
+        missing = [digest for digest, _ in query.chunks
+                   if not store.has_chunk(digest)]
+        if not missing:
+            chunks = [(digest, size,
+                       os.path.getsize(store.chunk_path(digest)))
+                      for digest, size in query.chunks]
+            Manifest(store, chunks).save(filePath + '.manifest')
+            for path in (filePath, filePath + '.zlib'):
+                if os.path.exists(path):
+                    os.remove(path)
+            self._logger.info("Saved manifest %s" % fileName)
+        return missing
+
+    def _database_file(self, branch):
+        """
+        Get the file storing the database of a branch. Databases are stored
+        as chunks or compressed, except those uploaded before compression
+        was supported.
+
+        :param branch: the branch
+        :return: the path of the file and its compression
+        """
         fileName = '%s_%s.idb' % (branch.repo, branch.name)
         filePath = self.parent().local_file(fileName)
+        if os.path.isfile(filePath + '.manifest'):
+            return filePath + '.manifest', ZLIB
+        if os.path.isfile(filePath + '.zlib'):
+            return filePath + '.zlib', ZLIB
+        return filePath, None
+
+    def _load_manifest(self, branch, filePath):
+        """
+        Load a manifest, reusing the last one loaded if it hasn't changed.
+
+        :param branch: the branch
+        :param filePath: the path of the manifest
+        :return: the manifest
+        """
+        key = filePath, os.path.getmtime(filePath)
+        if self._manifest is None or self._manifest[0] != key:
+            store = self.parent().chunk_store(branch.repo)
+            self._manifest = key, Manifest.load(store, filePath)
+        return self._manifest[1]
+
+    def _read_database(self, branch, filePath, offset, size):
+        """
+        Read a range of the stored form of a database.
 
-        # Read file from disk and sent it
-        reply = DownloadDatabase.Reply(query)
+        :param branch: the branch
+        :param filePath: the path of the file storing the database
+        :param offset: the offset of the range
+        :param size: the size of the range, or None until the end
+        :return: the data
+        """
+        if filePath.endswith('.manifest'):
+            return self._load_manifest(branch, filePath).read(offset, size)
         with open(filePath, 'rb') as inputFile:
-            reply.content = inputFile.read()
-        self.send_packet(reply)
+            inputFile.seek(offset)
+            return inputFile.read(-1 if size is None else size)
+
+    def _handle_flush_events(self, query):
+        # The client is told once the events it sent before are committed
+        def send_reply(committed):
+            self.send_packet(FlushEvents.Reply(query, committed))
+
+        self.parent().wait_commit(send_reply)
 
     def _handle_subscribe(self, packet):
         self._repo = packet.repo
@@ -169,22 +603,35 @@ class ServerClient(ClientSocket):
         self._name = packet.name
         self.parent().register_client(self)
 
-        # Send all missed events
-        events = self.parent().database.select_events(self._repo, self._branch,
-                                                      packet.tick)
-        self._logger.debug('Sending %d missed events' % len(events))
-        for event in events:
-            self.send_packet(event)
+        # Use the highest protocol version supported by both parties
+        version = min(getattr(packet, 'protocol', PROTOCOL_V1),
+                      PROTOCOL_VERSION)
+        serializer = JSONSerializer
+        if version >= PROTOCOL_V2:
+            name = getattr(packet, 'serializer', None)
+            serializer = SerializerFactory.get_class(name) or JSONSerializer
+        if version != self.protocol or serializer != self.serializer:
+            self.send_packet(UpgradeProtocol(version,
+                                             serializer.__serializer__))
+            self.protocol = version
+            self.serializer = serializer
+
+        # Start sending the missed events
+        self._replayTick = packet.tick
+        self._replay_events()
 
     def _handle_unsubscribe(self, packet):
         self.parent().unregister_client(self)
         packet.color = self._color
-        for client in self.parent().find_clients(self._should_forward):
+        for client in self._peers():
             client.send_packet(packet)
         self._repo = None
         self._branch = None
         self._name = None
         self._color = None
+        self._replayTick = None
+        self._cursor = None
+        self._cursorTimer.stop()
 
     def _handle_update_cursors(self, packet):
         self._ea = packet.ea
@@ -194,29 +641,111 @@ class ServerClient(ClientSocket):
         # Need an UpdateNameUser packet and UpdateColorUser packet
         self._name = packet.name
 
-        # Forward the event to the other clients
-        for client in self.parent().find_clients(self._should_forward):
-            client.send_packet(packet)
+        # Forward the update to the other clients, unless one was forwarded
+        # recently, in which case only the last one is forwarded later
+        self._cursor = packet
+        if not self._cursorTimer.active:
+            self._forward_cursor()
+
+    def _forward_cursor(self):
+        """
+        Forward the last cursor update to the other clients, then wait before
+        forwarding the next one.
+        """
+        if self._cursor is None:
+            return
+        for client in self._peers():
+            client.send_packet(self._cursor)
+        self._cursor = None
+        self._cursorTimer.start()
 
     def _handle_renamed_user(self, packet):
-        for client in self.parent().find_clients(self._should_forward):
+        if self._cursor is not None:
+            self._cursor.name = packet.new_name
+        for client in self._peers():
             client.send_packet(packet)
 
-    def _should_forward(self, client):
-        return client.repo == self._repo \
-                and client.branch == self._branch and client != self
+    def _access_failed(self, e):
+        """
+        Called when accessing the database or the files failed while
+        handling a packet. The client is disconnected, since it would
+        otherwise wait for the reply forever.
+
+        :param e: the exception
+        """
+        self._logger.warning("Could not handle packet")
+        self._logger.exception(e)
+        if self.connected:
+            self.disconnect()
+
+    def _peers(self):
+        """
+        Get the other clients subscribed to the same branch.
+
+        :return: the clients
+        """
+        return (client for client in self.parent().subscribers(
+            self._repo, self._branch) if client is not self)
 
 
 class Server(ServerSocket):
     """
     The server implementation used by dedicated and integrated.
     """
+    # The events are forwarded once committed, so this delay is kept short
+    COMMIT_DELAY = 20
+
+    # The files are accessed from a few threads, while the database is only
+    # accessed from one, so that the queries are run in order
+    FILES_THREADS = 4
+
+    # The decompressed copies of the databases are removed past this total
+    # size, the least recently used first
+    COPIES_MAX_SIZE = 1 << 30
 
-    def __init__(self, logger, ssl, parent=None):
+    # The partial files of the uploads that weren't resumed for this long,
+    # in seconds, are removed
+    PART_TIMEOUT = 60 * 60
+
+    # The events are compacted by pages, each read by its own call on the
+    # database thread, so that the commits are not delayed meanwhile
+    COMPACT_PAGE = 1000
+
+    def __init__(self, logger, ssl, parent=None, synchronous='normal',
+                 database='database.db'):
         ServerSocket.__init__(self, logger, parent)
-        self._clients = []
-        self._database = Database(self.local_file('database.db'))
+        # The branch of every subscribed client, and the subscribed clients
+        # of every branch, so that the peers of a client are found directly
+        self._clients = {}
+        self._subscriptions = {}
+        self._database = Database(self.local_file(database), synchronous)
         self._database.initialize()
+
+        # The last tick of every branch, loaded once from the database, and
+        # the tick of the last committed event
+        self._ticks = self._database.last_ticks()
+        self._committedTicks = dict(self._ticks)
+
+        # The blocking operations are run outside of the loop
+        self._databasePool = ThreadPool(1, logger)
+        self._filesPool = ThreadPool(Server.FILES_THREADS, logger)
+
+        # The events are committed to the database in groups, the inserted
+        # ones wait for the commit before being forwarded
+        self._uncommitted = []
+        self._commitWaiters = []
+        self._commitTimer = Timer(Server.COMMIT_DELAY, self._commit_events,
+                                  single_shot=True)
+        self._compacting = False
+        self._partsTimer = Timer(Server.PART_TIMEOUT * 1000,
+                                 self._remove_stale_files)
+        # The decompressed copies of the databases, in least recently used
+        # order, with the version of the file they were made from and their
+        # size. Each one is made under its own lock.
+        self._copies = collections.OrderedDict()
+        self._copiesLocks = {}
+        self._copiesLock = threading.Lock()
+
         self._ssl = ssl
         self._discovery = ClientsDiscovery(logger)
 
@@ -230,35 +759,14 @@ class Server(ServerSocket):
         """
         self._logger.info("Starting server on %s:%d" % (host, port))
         if self._ssl:
-            sslcfg = self._ssl
-            self._ssl = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
-            # First check if we should have a context setup
-            if sslcfg["server_ssl_mode"]:
-                self._ssl.load_cert_chain(
-                    certfile=sslcfg["server_ssl_cert_path"])
-                self._logger.info("Load_cert_chain %s" %
-                                  (sslcfg["server_ssl_cert_path"]))
-            if sslcfg["client_ssl_mode"]:
-                self._ssl.verify_mode |= ssl.CERT_REQUIRED
-                self._ssl.load_verify_locations(
-                    cafile=sslcfg["client_ssl_cert_path"])
-                self._logger.info("Load_verify_locations %s" %
-                                  (sslcfg["client_ssl_cert_path"]))
-            self._logger.info(self._ssl.cert_store_stats())
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        try:
-            sock.bind((host, port))
-        except socket.error as e:
-            self._logger.warning("Could not start server")
-            self._logger.exception(e)
+            self._ssl = create_ssl_context(self._ssl, self._logger)
+        sock = listen_socket(host, port, self._logger)
+        if sock is None:
             return False
-        sock.settimeout(0)
-        sock.setblocking(0)
-        sock.listen(5)
         self.connect(sock)
         host, port = sock.getsockname()
         self._discovery.start(host, port, self._ssl)
+        self.start_cleanup()
         return True
 
     def stop(self):
@@ -268,10 +776,16 @@ class Server(ServerSocket):
         :return: did the operation succeed?
         """
         self._logger.info("Shutting down server")
-        for client in self._clients:
+        for client in list(self._clients):
             client.disconnect()
         self.disconnect()
-        self._discovery.stop()
+        self._commitTimer.stop()
+        self._partsTimer.stop()
+        self._filesPool.shutdown()
+        self._databasePool.submit(self._database.commit)
+        self._databasePool.shutdown()
+        if self._discovery.started:
+            self._discovery.stop()
         return True
 
     @property
@@ -292,12 +806,23 @@ class Server(ServerSocket):
         return self._socket.getsockname()[1]
 
     def _accept(self, sock):
-        client = ServerClient(self._logger, self)
         if self._ssl:
             sock = self._ssl.wrap_socket(sock, server_side=True)
+        self.accept_client(sock)
+
+    def accept_client(self, sock, address=None):
+        """
+        Handle a client connection. In sharded mode, it was accepted by the
+        front process and is received through a local socket, so the address
+        of the client must be given.
+
+        :param sock: the socket
+        :param address: the address of the client, if not the socket's peer
+        """
+        client = ServerClient(self._logger, self)
         sock.settimeout(0)
         sock.setblocking(0)
-        client.connect(sock)
+        client.connect(sock, address)
 
     def local_file(self, filename):
         """
@@ -308,32 +833,385 @@ class Server(ServerSocket):
         """
         raise NotImplementedError("local_file() not implemented")
 
-    def find_clients(self, func):
+    def subscribers(self, repo, branch):
         """
-        Find all the clients matching the specified criterion.
+        Get the clients subscribed to a branch.
 
-        :param func: the filtering function
-        :return: the matching clients
+        :param repo: the repo name
+        :param branch: the branch name
+        :return: the clients
         """
-        return filter(func, self._clients)
+        return self._subscriptions.get((repo, branch), ())
 
     def register_client(self, client):
         """
-        Add a client to the list of connected clients.
+        Add a client to the subscribers of its current branch, removing it
+        from the subscribers of its previous one.
 
         :param client: the client
         """
-        if client not in self._clients:
-            self._clients.append(client)
+        self.unregister_client(client)
+        key = client.repo, client.branch
+        self._clients[client] = key
+        self._subscriptions.setdefault(key, set()).add(client)
 
     def unregister_client(self, client):
         """
-        Remove a client to the list of connected clients.
+        Remove a client from the subscribers of its branch.
 
         :param client: the client
         """
-        if client in self._clients:
-            self._clients.remove(client)
+        key = self._clients.pop(client, None)
+        if key is not None:
+            clients = self._subscriptions[key]
+            clients.discard(client)
+            if not clients:
+                del self._subscriptions[key]
+
+    def last_tick(self, repo, branch):
+        """
+        Get the last tick of a branch.
+
+        :param repo: the repo name
+        :param branch: the branch name
+        :return: the last tick
+        """
+        return self._ticks.get((repo, branch), 0)
+
+    def set_last_tick(self, repo, branch, tick):
+        """
+        Set the last tick of a branch, after an event has been inserted.
+
+        :param repo: the repo name
+        :param branch: the branch name
+        :param tick: the last tick
+        """
+        self._ticks[(repo, branch)] = tick
+
+    def committed_tick(self, repo, branch):
+        """
+        Get the tick of the last committed event of a branch. The events up
+        to it have all been forwarded.
+
+        :param repo: the repo name
+        :param branch: the branch name
+        :return: the tick
+        """
+        return self._committedTicks.get((repo, branch), 0)
+
+    def chunk_store(self, repo):
+        """
+        Get the store of the chunks of the databases of a repository.
+
+        :param repo: the repo name
+        :return: the chunk store
+        """
+        # The name must not lead outside of the directory of the stores
+        if not repo or repo in (os.curdir, os.pardir) or os.sep in repo \
+                or (os.altsep and os.altsep in repo):
+            raise ValueError("Invalid repository name: %s" % repo)
+        return ChunkStore(self.local_file(os.path.join('chunks', repo)))
+
+    def collect_chunks(self, repo):
+        """
+        Remove the chunks of a repository that are no longer referenced by
+        the manifests of its branches. It is run on a files thread.
+
+        :param repo: the repository name
+        """
+        # The manifests of other repositories whose name starts the same
+        # are included too, which only keeps more chunks
+        prefix = '%s_' % repo
+        filesDir = self.local_file('')
+        digests = set()
+        store = self.chunk_store(repo)
+        for fileName in os.listdir(filesDir):
+            if fileName.startswith(prefix) \
+                    and fileName.endswith('.idb.manifest'):
+                path = os.path.join(filesDir, fileName)
+                try:
+                    digests.update(Manifest.load(store, path).digests)
+                except (IOError, OSError):
+                    if os.path.exists(path):
+                        raise  # Only the removed manifests are ignored
+        deadline = time.time() - Server.PART_TIMEOUT
+        count = store.collect_chunks(digests, deadline)
+        if count:
+            self._logger.info("Removed %d chunks of %s" % (count, repo))
+
+    def read_decompressed_file(self, filePath, read, offset, size):
+        """
+        Read a range of a decompressed copy of a stored database, for the
+        clients that don't support compression. The copy is made once, then
+        reused until the database changes or it is evicted by more recently
+        used ones. It is run on a files thread.
+
+        :param filePath: the path of the file storing the database
+        :param read: the function reading a range of its stored form
+        :param offset: the offset of the range
+        :param size: the size of the range, or None until the end
+        :return: the data, and the size of the copy
+        """
+        copyPath = os.path.splitext(filePath)[0] + '.raw'
+        stat = os.stat(filePath)
+        version = stat.st_ino, stat.st_size, stat.st_mtime
+        with self._copy_lock(copyPath):
+            with self._copiesLock:
+                copy = self._copies.pop(copyPath, None)
+            if copy is None or copy[0] != version \
+                    or not os.path.isfile(copyPath):
+                decompressor = Decompressor()
+                with open(copyPath + '.part', 'wb') as outputFile:
+                    readOffset = 0
+                    while True:
+                        data = read(readOffset, CHUNK_SIZE)
+                        if not data:
+                            break
+                        outputFile.write(decompressor.decompress(data))
+                        readOffset += len(data)
+                    outputFile.write(decompressor.flush())
+                replace_file(copyPath + '.part', copyPath)
+                copy = version, os.path.getsize(copyPath)
+            with open(copyPath, 'rb') as inputFile:
+                inputFile.seek(offset)
+                data = inputFile.read(-1 if size is None else size)
+            with self._copiesLock:
+                self._copies[copyPath] = copy
+                evicted = []
+                total = sum(other[1] for other in self._copies.values())
+                while total > Server.COPIES_MAX_SIZE \
+                        and len(self._copies) > 1:
+                    path, other = self._copies.popitem(last=False)
+                    evicted.append(path)
+                    total -= other[1]
+
+        # The copies are only removed if they weren't made again meanwhile
+        for path in evicted:
+            with self._copy_lock(path):
+                with self._copiesLock:
+                    if path in self._copies:
+                        continue
+                self._remove_file(path)
+        return data, copy[1]
+
+    def _copy_lock(self, copyPath):
+        """
+        Get the lock of a decompressed copy of a database.
+
+        :param copyPath: the path of the copy
+        :return: the lock
+        """
+        with self._copiesLock:
+            return self._copiesLocks.setdefault(copyPath, threading.Lock())
+
+    def compact_events(self):
+        """
+        Compact the events of every branch, deleting the superseded ones.
+        """
+        if self._compacting:
+            return
+        self._compacting = True
+        self._compact_branches(list(self._ticks.items()))
+
+    def _compact_branches(self, branches):
+        """
+        Compact the events of some branches, one after the other.
+
+        :param branches: the last tick of the events of every branch
+        """
+        if not branches:
+            self._compacting = False
+            return
+        (repo, branch), until = branches[0]
+        compactor = Compactor()
+        superseded = []
+
+        def read_page(tick):
+            self.run_database(partial(self._database.find_superseded_events,
+                                      repo, branch, compactor, tick, until,
+                                      Server.COMPACT_PAGE),
+                              page_read, compact_failed)
+
+        def page_read(result):
+            tick, events = result
+            superseded.extend(events)
+            if tick is not None:
+                read_page(tick)
+            elif superseded:
+                # The events inserted must not be committed along with the
+                # deletions, as they wouldn't be forwarded
+                self._commitTimer.stop()
+                self._commit_events()
+                self.run_database(partial(self._database.delete_events,
+                                          repo, branch, superseded),
+                                  events_deleted, compact_failed)
+            else:
+                self._compact_branches(branches[1:])
+
+        def events_deleted(_):
+            self._logger.info("Compacted %d events of %s/%s"
+                              % (len(superseded), repo, branch))
+            self._compact_branches(branches[1:])
+
+        def compact_failed(e):
+            self._logger.warning("Could not compact the events of %s/%s"
+                                 % (repo, branch))
+            self._logger.exception(e)
+            self._compact_branches(branches[1:])
+
+        read_page(0)
+
+    def run_database(self, func, callback=None, errback=None):
+        """
+        Run a function accessing the database on the database thread. The
+        functions are run in order, so the events inserted are always read
+        by the queries submitted after them.
+
+        :param func: the function, without arguments
+        :param callback: the function called with the result, if any
+        :param errback: the function called with the exception, if any
+        """
+        self._databasePool.submit(func, callback, errback)
+
+    def start_cleanup(self):
+        """
+        Remove the stale partial files now, then periodically. It is called
+        by start(), or directly for the servers that don't listen.
+        """
+        self._remove_stale_files()
+        self._partsTimer.start()
+
+    def _remove_stale_files(self):
+        """
+        Remove the partial files that weren't written for PART_TIMEOUT
+        seconds, like the ones of the uploads that were never resumed, and
+        the decompressed copies this old that aren't known, like the ones
+        left by a previous run.
+        """
+        def remove_files(filesDir):
+            deadline = time.time() - Server.PART_TIMEOUT
+            for fileName in os.listdir(filesDir):
+                path = os.path.join(filesDir, fileName)
+                if fileName.endswith('.raw'):
+                    with self._copy_lock(path):
+                        with self._copiesLock:
+                            if path in self._copies:
+                                continue
+                        self._remove_file(path, deadline)
+                elif fileName.endswith('.part'):
+                    self._remove_file(path, deadline)
+
+        self.run_files(partial(remove_files, self.local_file('')))
+
+    def _remove_file(self, path, deadline=None):
+        """
+        Remove a file, if it exists and wasn't written since the deadline.
+
+        :param path: the path of the file
+        :param deadline: the time of the deadline, or None
+        """
+        try:
+            if deadline is None or os.path.getmtime(path) < deadline:
+                os.remove(path)
+                self._logger.info("Removed file %s" % os.path.basename(path))
+        except OSError:
+            pass  # Removed meanwhile, by another worker, or still open
+
+    def run_files(self, func, callback=None, errback=None):
+        """
+        Run a function accessing the files on one of the files threads.
+
+        :param func: the function, without arguments
+        :param callback: the function called with the result, if any
+        :param errback: the function called with the exception, if any
+        """
+        self._filesPool.submit(func, callback, errback)
+
+    def save_event(self, client, event):
+        """
+        Insert an event received from a client into the database. It is
+        forwarded to the other clients of its branch once committed, after
+        a short delay that groups the events received meanwhile.
+
+        :param client: the client
+        :param event: the event
+        """
+        key = client.repo, client.branch
+
+        def event_inserted(_):
+            self._uncommitted.append((client, key, event))
+
+        def insert_failed(e):
+            self._logger.warning("Could not save event %d" % event.tick)
+            self._logger.exception(e)
+
+        self.run_database(partial(self._database.insert_event,
+                                  client.repo, client.branch, event),
+                          event_inserted, insert_failed)
+        self.set_last_tick(client.repo, client.branch, event.tick)
+        if not self._commitTimer.active:
+            self._commitTimer.start()
+
+    def wait_commit(self, callback):
+        """
+        Call a function once the events received so far have been committed.
+        Their insertions are run first, so once they are done, the events
+        are either committed or waiting for the next commit.
+
+        :param callback: the function, called with whether they were
+        """
+        def events_inserted(_):
+            if self._uncommitted:
+                self._commitWaiters.append(callback)
+            else:
+                callback(True)
+
+        self.run_database(lambda: None, events_inserted,
+                          lambda _: callback(False))
+
+    def _commit_events(self):
+        """
+        Commit the events inserted since the last commit. The insertions are
+        run before the commit, so their callbacks are all called before its
+        own, which forwards the events.
+        """
+        def events_committed(_):
+            events, self._uncommitted = self._uncommitted, []
+            waiters, self._commitWaiters = self._commitWaiters, []
+            for sender, key, event in events:
+                self._committedTicks[key] = event.tick
+                for client in self.subscribers(*key):
+                    if client is not sender:
+                        client.forward_event(event)
+            for waiter in waiters:
+                waiter(True)
+
+        def commit_failed(e):
+            events, self._uncommitted = self._uncommitted, []
+            waiters, self._commitWaiters = self._commitWaiters, []
+            self._logger.error("Could not commit %d events, they are lost"
+                               % len(events))
+            self._logger.exception(e)
+
+            # The ticks of the lost events are given again, unless events
+            # were received since, which already have the following ticks
+            lastTicks = {}
+            for _, key, event in events:
+                lastTicks[key] = event.tick
+            for key, tick in lastTicks.items():
+                if self._ticks.get(key) == tick:
+                    self._ticks[key] = self._committedTicks.get(key, 0)
+
+            # The senders are disconnected, so that they know their events
+            # were lost, and the waiters are told
+            for sender in set(sender for sender, _, _ in events):
+                if sender.connected:
+                    sender.disconnect()
+            for waiter in waiters:
+                waiter(False)
+
+        self.run_database(self._database.commit, events_committed,
+                          commit_failed)
 
     @property
     def database(self):
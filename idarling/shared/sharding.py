@@ -0,0 +1,407 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+import socket
+import zlib
+from multiprocessing import reduction
+
+from .commands import (GetRepositories, Subscribe, Unsubscribe,
+                       UpgradeProtocol)
+from .discovery import ClientsDiscovery
+from .framing import PROTOCOL_V2, FRAME_EVENT
+from .packets import Event, Packet, SerializerFactory
+from .server import create_ssl_context, listen_socket
+from .sockets import ClientSocket, ServerSocket
+
+
+def shard_index(repo, count):
+    """
+    Get the index of the worker process handling a repository. All the
+    branches of a repository are handled by the same worker, so that its
+    clients, last ticks and chunks are all found in one process.
+
+    :param repo: the repo name, or None
+    :param count: the number of workers
+    :return: the index
+    """
+    if repo is None:
+        return 0
+    if not isinstance(repo, bytes):
+        repo = repo.encode('utf-8')
+    return (zlib.crc32(repo) & 0xffffffff) % count
+
+
+def shard_database(index):
+    """
+    Get the name of the database file of a worker process. Each worker has
+    its own, so that they never wait for each other to write.
+
+    :param index: the index of the worker, or None if not sharded
+    :return: the file name
+    """
+    if index is None:
+        return 'database.db'
+    return 'database.%d.db' % index
+
+
+def packet_repo(packet):
+    """
+    Get the name of the repository a command is about, if any.
+
+    :param packet: the command
+    :return: the repo name or None
+    """
+    repo = getattr(packet, 'repo', None)
+    if repo is None:
+        # The new branch command contains a branch model
+        repo = getattr(getattr(packet, 'branch', None), 'repo', None)
+    # The new repository command contains a repository model
+    return getattr(repo, 'name', repo)
+
+
+class RelayedEvent(Event):
+    """
+    An event that is forwarded by the front process without being decoded.
+    It keeps the payload as received, and is only decoded if it must be
+    encoded again for a client using another serializer or framing.
+    """
+
+    def __init__(self, serializer, tick, payload):
+        Packet.__init__(self)  # There is no event type to check
+        self._tick = tick
+        # The tick inside of the payload is not known without decoding it
+        self._payloads = {serializer: (None, payload)}
+
+    def build_packet(self):
+        serializer, (_, payload) = next(iter(self._payloads.items()))
+        dct = serializer.loads(payload)
+        dct['tick'] = self._tick
+        return dct
+
+
+class RelaySocket(ClientSocket):
+    """
+    A socket of the front process. The events it receives are only relayed,
+    so they are not decoded, as it would be done on a single thread for all
+    the clients of all the workers.
+    """
+
+    def _decode_packet(self, payload, header=None):
+        if header is None or header.kind != FRAME_EVENT:
+            return ClientSocket._decode_packet(self, payload, header)
+        serializer = SerializerFactory.get_class_by_id(header.serializer)
+        return RelayedEvent(serializer, header.tick, payload)
+
+
+class WorkerLink(RelaySocket):
+    """
+    The connection between the front process and a worker process, used to
+    forward the packets of a single client. The worker sees it as a regular
+    client connection.
+    """
+
+    def __init__(self, logger, parent, client):
+        RelaySocket.__init__(self, logger, parent)
+        self._client = client
+        self._proxy = True
+
+        # The payloads of the events are reused if the serializers match
+        self.protocol = PROTOCOL_V2
+        self.serializer = client.serializer
+
+    def disconnect(self, err=None):
+        RelaySocket.disconnect(self, err)
+        if self._client.connected:
+            self._client.disconnect(err)
+
+    def pause(self):
+        """
+        Stop reading the packets of the worker.
+        """
+        if self._socket:
+            self._loop.remove_reader(self._fileno)
+
+    def resume(self):
+        """
+        Start reading the packets of the worker again.
+        """
+        if self._socket:
+            self._loop.add_reader(self._fileno, self._notify_read)
+
+    def send_packet(self, packet):
+        # The queries are not registered, their replies are not for us
+        if not self._connected:
+            return None
+        self._outgoing.append(packet)
+        self._set_writing(True)
+        return None
+
+    def _dispatch_packet(self, packet):
+        # Everything is forwarded to the client, including the replies
+        self._client.forward_packet(packet)
+
+
+class FrontClient(RelaySocket):
+    """
+    The client (front-side) implementation. It forwards the packets of the
+    client to the worker handling the repository they are about, and the
+    packets of the workers back to the client.
+    """
+    # The workers are not read while this many packets are waiting to be
+    # written to the client, so that a slow client doesn't fill the memory
+    MAX_PENDING = 1024
+
+    def __init__(self, logger, parent):
+        RelaySocket.__init__(self, logger, parent)
+        self._address = None
+        self._links = {}
+        self._paused = False
+        self._repo = None
+        # The replies to the repositories queries, that every worker answers
+        # with its own repositories, waiting for the other workers
+        self._repos = {}
+
+    @property
+    def address(self):
+        """
+        Get the address of the client.
+
+        :return: the host and port
+        """
+        return self._address
+
+    def connect(self, sock):
+        RelaySocket.connect(self, sock)
+        self._address = sock.getpeername()
+        self._logger.debug("(%s:%d) Connected" % self._address)
+
+    def disconnect(self, err=None):
+        RelaySocket.disconnect(self, err)
+        for link in list(self._links.values()):
+            link.disconnect()
+        self._links.clear()
+        self.parent().unregister_client(self)
+
+    def recv_packet(self, packet):
+        if not self._connected:
+            return True
+        count = self.parent().worker_count
+        if isinstance(packet, GetRepositories.Query):
+            self._repos[packet.id] = (count, [])
+            for index in range(count):
+                self._link(index).send_packet(packet)
+            return True
+
+        if isinstance(packet, Event):
+            repo = self._repo
+        elif isinstance(packet, Subscribe):
+            # Leave the branch handled by the previous worker, if any
+            if self._repo is not None and shard_index(self._repo, count) \
+                    != shard_index(packet.repo, count):
+                link = self._link(shard_index(self._repo, count))
+                if link is None:
+                    return True
+                link.send_packet(Unsubscribe(packet.name))
+            repo = self._repo = packet.repo
+        else:
+            repo = packet_repo(packet)
+            if repo is None:
+                repo = self._repo
+            if isinstance(packet, Unsubscribe):
+                self._repo = None
+        link = self._link(shard_index(repo, count))
+        if link is not None:
+            link.send_packet(packet)
+        return True
+
+    def forward_packet(self, packet):
+        """
+        Send a packet received from a worker to the client.
+
+        :param packet: the packet
+        """
+        if isinstance(packet, UpgradeProtocol):
+            # Every worker negotiates the protocol, the client only once
+            serializer = SerializerFactory.get_class(packet.serializer)
+            if packet.version == self.protocol \
+                    and serializer == self.serializer:
+                return
+            self.send_packet(packet)
+            self.protocol = packet.version
+            self.serializer = serializer
+            for link in self._links.values():
+                link.serializer = serializer
+            return
+
+        if isinstance(packet, GetRepositories.Reply) \
+                and packet.id in self._repos:
+            count, repos = self._repos[packet.id]
+            repos.extend(packet.repos)
+            if count > 1:
+                self._repos[packet.id] = (count - 1, repos)
+                return
+            del self._repos[packet.id]
+            packet.repos = repos
+
+        self.send_packet(packet)
+        if not self._paused and len(self._outgoing) >= FrontClient.MAX_PENDING:
+            self._paused = True
+            for link in self._links.values():
+                link.pause()
+
+    def _outgoing_drained(self):
+        if self._paused:
+            self._paused = False
+            for link in self._links.values():
+                link.resume()
+
+    def _link(self, index):
+        """
+        Get the link to a worker, opening it if needed. The client is
+        disconnected if the worker cannot be reached.
+
+        :param index: the index of the worker
+        :return: the link, or None
+        """
+        link = self._links.get(index)
+        if link is None:
+            link = self.parent().open_link(self, index)
+            if link is None:
+                self.disconnect()
+                return None
+            if self._paused:
+                link.pause()
+            self._links[index] = link
+        return link
+
+
+class FrontServer(ServerSocket):
+    """
+    The server implementation of the front process, in sharded mode. It
+    accepts the connections and does the SSL, while the commands are handled
+    by worker processes. Each worker runs a regular server, to which the
+    front connects through a local socket for each client.
+    """
+
+    def __init__(self, logger, ssl, workers):
+        """
+        Initialize the front server.
+
+        :param logger: the logger to use
+        :param ssl: the SSL configuration
+        :param workers: the process identifier and control connection of
+                        each worker, that the sockets are passed through
+        """
+        ServerSocket.__init__(self, logger)
+        self._clients = []
+        self._workers = workers
+        self._ssl = ssl
+        self._discovery = ClientsDiscovery(logger)
+
+    @property
+    def worker_count(self):
+        """
+        Get the number of workers.
+
+        :return: the number
+        """
+        return len(self._workers)
+
+    def start(self, host, port=0):
+        """
+        Starts the server on the specified host and port.
+
+        :param host: the host
+        :param port: the port
+        :return: did the operation succeed?
+        """
+        self._logger.info("Starting server on %s:%d with %d workers"
+                          % (host, port, len(self._workers)))
+        if self._ssl:
+            self._ssl = create_ssl_context(self._ssl, self._logger)
+        sock = listen_socket(host, port, self._logger)
+        if sock is None:
+            return False
+        self.connect(sock)
+        host, port = sock.getsockname()
+        self._discovery.start(host, port, self._ssl)
+        return True
+
+    def stop(self):
+        """
+        Stops the server.
+
+        :return: did the operation succeed?
+        """
+        self._logger.info("Shutting down server")
+        for client in list(self._clients):
+            client.disconnect()
+        self.disconnect()
+        if self._discovery.started:
+            self._discovery.stop()
+        return True
+
+    def _accept(self, sock):
+        client = FrontClient(self._logger, self)
+        if self._ssl:
+            sock = self._ssl.wrap_socket(sock, server_side=True)
+        sock.settimeout(0)
+        sock.setblocking(0)
+        client.connect(sock)
+        self._clients.append(client)
+
+    def unregister_client(self, client):
+        """
+        Remove a client from the list of connected clients.
+
+        :param client: the client
+        """
+        if client in self._clients:
+            self._clients.remove(client)
+
+    def open_link(self, client, index):
+        """
+        Connect a client to a worker. The address of the client is passed to
+        the worker, followed by one end of a new socket pair.
+
+        :param client: the client
+        :param index: the index of the worker
+        :return: the link, or None if the worker has exited
+        """
+        pid, conn = self._workers[index]
+        front, back = socket.socketpair()
+        try:
+            conn.send(client.address)
+            reduction.send_handle(conn, back.fileno(), pid)
+        except (EOFError, IOError, OSError) as e:
+            self._logger.warning("Worker %d cannot be reached" % index)
+            self._logger.exception(e)
+            front.close()
+            return None
+        finally:
+            back.close()
+        front.settimeout(0)
+        front.setblocking(0)
+        link = WorkerLink(self._logger, self, client)
+        link.connect(front)
+        return link
+
+    def replace_worker(self, index, pid, conn):
+        """
+        Replace a worker that has exited by a new one. The next clients are
+        connected to the new worker.
+
+        :param index: the index of the worker
+        :param pid: the process identifier of the new worker
+        :param conn: the control connection of the new worker
+        """
+        self._workers[index] = (pid, conn)
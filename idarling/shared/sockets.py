@@ -12,34 +12,24 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 import collections
 import errno
-import json
 import socket
 import ssl
 import sys
 
-from PyQt5.QtCore import QCoreApplication, QEvent, QObject, QSocketNotifier
+from .buffers import ReadBuffer
+from .framing import (PROTOCOL_V1, PROTOCOL_V2, FRAME_MAGIC, FRAME_HEADER,
+                      FRAME_COMMAND, FRAME_EVENT, FLAG_CONTAINER,
+                      build_frame, parse_header)
+from .loop import get_loop
+from .packets import (Packet, PacketDeferred, Event, Query, Reply,
+                      Container, SerializerFactory, JSONSerializer)
 
-from .packets import Packet, PacketDeferred, Query, Reply, Container
 
-
-class PacketEvent(QEvent):
-    """
-    A Qt-event fired when a new packet is received by the client.
-    """
-
-    def __init__(self):
-        """
-        Initializes the new packet event.
-        """
-        evtype = QEvent.Type(QEvent.registerEventType())
-        super(PacketEvent, self).__init__(evtype)
-
-
-class ClientSocket(QObject):
+class ClientSocket(object):
     """
-    A class wrapping a Python socket and integrated into the Qt event loop.
+    A class wrapping a Python socket and integrated into the event loop.
     """
-    MAX_READ_SIZE = 4096
+    MAX_READ_SIZE = 65536
     MAX_WRITE_SIZE = 65535
 
     def __init__(self, logger, parent=None):
@@ -47,24 +37,41 @@ class ClientSocket(QObject):
         Initializes the client socket.
 
         :param logger: the logger to user
+        :param parent: the server socket that accepted it, if any
         """
-        QObject.__init__(self, parent)
+        super(ClientSocket, self).__init__()
+        self._parent = parent
         self._logger = logger
+        self._loop = get_loop()
         self._socket = None
+        self._fileno = None
         self._server = parent and isinstance(parent, ServerSocket)
+        # The replies received by a proxy are to queries it didn't send
+        self._proxy = False
 
-        self._read_buffer = bytearray()
-        self._read_notifier = None
+        self._read_buffer = ReadBuffer()
+        self._read_header = None
         self._read_packet = None
 
         self._write_buffer = bytearray()
-        self._write_notifier = None
+        self._writing = False
         self._write_packet = None
+        self._dispatching = False
 
         self._connected = False
+        self._protocol = PROTOCOL_V1
+        self._serializer = JSONSerializer
         self._outgoing = collections.deque()
         self._incoming = collections.deque()
 
+    def parent(self):
+        """
+        Get the server socket that accepted this socket, if any.
+
+        :return: the server socket
+        """
+        return self._parent
+
     @property
     def connected(self):
         """
@@ -74,21 +81,61 @@ class ClientSocket(QObject):
         """
         return self._connected
 
+    @property
+    def sending(self):
+        """
+        Get if some packets are waiting to be written.
+
+        :return: are packets waiting
+        """
+        return bool(self._outgoing or self._write_buffer)
+
+    @property
+    def protocol(self):
+        """
+        Get the protocol version used to send packets.
+
+        :return: the version
+        """
+        return self._protocol
+
+    @protocol.setter
+    def protocol(self, protocol):
+        """
+        Set the protocol version used to send packets. Both versions are
+        always accepted when receiving packets.
+
+        :param protocol: the version
+        """
+        self._protocol = protocol
+
+    @property
+    def serializer(self):
+        """
+        Get the serializer used to send packets.
+
+        :return: the serializer class
+        """
+        return self._serializer
+
+    @serializer.setter
+    def serializer(self, serializer):
+        """
+        Set the serializer used to send packets. It is only used by version 2
+        of the protocol, version 1 always uses JSON.
+
+        :param serializer: the serializer class
+        """
+        self._serializer = serializer
+
     def connect(self, sock):
         """
         Wraps the socket with the current object.
 
         :param sock: the socket
         """
-        self._read_notifier = QSocketNotifier(sock.fileno(),
-                                              QSocketNotifier.Read, self)
-        self._read_notifier.activated.connect(self._notify_read)
-        self._read_notifier.setEnabled(True)
-
-        self._write_notifier = QSocketNotifier(sock.fileno(),
-                                               QSocketNotifier.Write, self)
-        self._write_notifier.activated.connect(self._notify_write)
-        self._write_notifier.setEnabled(False)
+        self._fileno = sock.fileno()
+        self._loop.add_reader(self._fileno, self._notify_read)
 
         self._socket = sock
         self._connected = True
@@ -104,8 +151,8 @@ class ClientSocket(QObject):
         if err:
             self._logger.warning("Connection lost")
             self._logger.exception(err)
-        self._read_notifier.setEnabled(False)
-        self._write_notifier.setEnabled(False)
+        self._loop.forget(self._fileno)
+        self._writing = False
         try:
             self._socket.close()
         except socket.error:
@@ -151,8 +198,9 @@ class ClientSocket(QObject):
         # Read as much data as is available
         while True:
             try:
-                data = self._socket.recv(ClientSocket.MAX_READ_SIZE)
-                if not data:
+                count = self._read_buffer.recv_from(self._socket,
+                                                    ClientSocket.MAX_READ_SIZE)
+                if not count:
                     self.disconnect()
                     break
             except socket.error as e:
@@ -161,27 +209,37 @@ class ClientSocket(QObject):
                         and not isinstance(e, ssl.SSLWantWriteError):
                     self.disconnect(e)
                 break  # No more data available
-            self._read_buffer.extend(data)
 
         while True:
             if self._read_packet is None:
-                if b'\n' in self._read_buffer:
-                    pos = self._read_buffer.index(b'\n')
-                    line = self._read_buffer[:pos]
-                    self._read_buffer = self._read_buffer[pos + 1:]
-
-                    # Try to parse the line as a packet
-                    try:
-                        dct = json.loads(line.decode('utf-8'))
-                        self._read_packet = Packet.parse_packet(dct,
-                                                                self._server)
-                    except Exception as e:
-                        msg = "Invalid packet received: %s" % line
-                        self._logger.warning(msg)
-                        self._logger.exception(e)
-                        continue
+                # Version 2 frames start with a header, otherwise it's a line
+                if self._read_header is None \
+                        and self._read_buffer.peek() == FRAME_MAGIC:
+                    data = self._read_buffer.read(FRAME_HEADER.size)
+                    if data is None:
+                        break  # Not enough data for a header
+                    self._read_header = parse_header(data)
+
+                if self._read_header is not None:
+                    header = self._read_header
+                    payload = self._read_buffer.read(header.length)
+                    if payload is None:
+                        break  # Not enough data for a packet
+                    self._read_header = None
                 else:
-                    break  # Not enough data for a packet
+                    header = None
+                    payload = self._read_buffer.readline()
+                    if payload is None:
+                        break  # Not enough data for a packet
+
+                # Try to parse the payload as a packet
+                try:
+                    self._read_packet = self._decode_packet(payload, header)
+                except Exception as e:
+                    msg = "Invalid packet received: %s" % payload
+                    self._logger.warning(msg)
+                    self._logger.exception(e)
+                    continue
 
             else:
                 if isinstance(self._read_packet, Container):
@@ -193,17 +251,16 @@ class ClientSocket(QObject):
                         self._read_packet.downback(min(avail, total), total)
 
                     # Read the container's content
-                    if avail >= total:
-                        self._read_packet.content = self._read_buffer[:total]
-                        self._read_buffer = self._read_buffer[total:]
-                    else:
+                    content = self._read_buffer.read(total)
+                    if content is None:
                         break  # Not enough data for a packet
+                    self._read_packet.content = content
 
                 self._incoming.append(self._read_packet)
                 self._read_packet = None
 
         if self._incoming:
-            QCoreApplication.instance().postEvent(self, PacketEvent())
+            self._schedule_dispatch()
 
     def _notify_write(self):
         """
@@ -211,13 +268,14 @@ class ClientSocket(QObject):
         """
         while True:
             if not self._write_buffer:
+                if not self._outgoing:
+                    self._outgoing_drained()
                 if not self._outgoing:
                     break  # No more packets to send
                 self._write_packet = self._outgoing.popleft()
 
                 try:
-                    line = json.dumps(self._write_packet.build_packet())
-                    line = line.encode('utf-8') + b'\n'
+                    line = self._encode_packet(self._write_packet)
                 except Exception as e:
                     msg = "Invalid packet being sent: %s" % self._write_packet
                     self._logger.warning(msg)
@@ -236,7 +294,7 @@ class ClientSocket(QObject):
                 count = min(len(self._write_buffer),
                             ClientSocket.MAX_WRITE_SIZE)
                 sent = self._socket.send(self._write_buffer[:count])
-                self._write_buffer = self._write_buffer[sent:]
+                del self._write_buffer[:sent]
             except socket.error as e:
                 if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK) \
                         and not isinstance(e, ssl.SSLWantReadError) \
@@ -254,38 +312,116 @@ class ClientSocket(QObject):
                 break
 
         if not self._write_buffer:
-            self._write_notifier.setEnabled(False)
+            self._set_writing(False)
 
-    def event(self, event):
+    def _set_writing(self, writing):
         """
-        Callback called when a Qt event is fired.
+        Start or stop watching the socket for writing.
 
-        :param event: the event
-        :return: was the event handled?
+        :param writing: should the socket be watched?
         """
-        if isinstance(event, PacketEvent):
-            self._dispatch()
-            event.accept()
-            return True
+        if writing == self._writing:
+            return
+        if writing:
+            self._loop.add_writer(self._fileno, self._notify_write)
         else:
-            event.ignore()
-            return False
+            self._loop.remove_writer(self._fileno)
+        self._writing = writing
+
+    def _encode_packet(self, packet):
+        """
+        Encode a packet using the framing of the current protocol version.
+
+        :param packet: the packet
+        :return: the encoded bytes
+        """
+        if self._protocol < PROTOCOL_V2:
+            serializer = JSONSerializer
+        else:
+            serializer = self._serializer
+
+        if isinstance(packet, Event):
+            # Events are only encoded once per serializer, whatever the number
+            # of clients they are sent to. The tick can be changed afterwards
+            # because version 2 sends it in the frame header.
+            tick, payload = packet.payloads.get(serializer, (None, None))
+            if payload is None or (self._protocol < PROTOCOL_V2
+                                   and tick != packet.tick):
+                payload = serializer.dumps(packet.build_packet())
+                packet.payloads[serializer] = (packet.tick, payload)
+        else:
+            payload = serializer.dumps(packet.build_packet())
+
+        if self._protocol < PROTOCOL_V2:
+            return payload + b'\n'
+
+        if isinstance(packet, Event):
+            kind, tick = FRAME_EVENT, packet.tick
+        else:
+            kind, tick = FRAME_COMMAND, 0
+        flags = FLAG_CONTAINER if isinstance(packet, Container) else 0
+        return build_frame(kind, flags, serializer.__serializer_id__,
+                           tick, payload)
+
+    def _decode_packet(self, payload, header=None):
+        """
+        Decode a packet received with any of the protocol versions.
+
+        :param payload: the encoded packet
+        :param header: the frame header, or None if it was a line
+        :return: the packet
+        """
+        serializer = JSONSerializer
+        if header is not None:
+            serializer = SerializerFactory.get_class_by_id(header.serializer)
+        packet = Packet.parse_packet(serializer.loads(payload), self._server,
+                                     not self._proxy)
+        if isinstance(packet, Event):
+            # Keep the payload as received so it can be forwarded as is
+            packet.payloads[serializer] = (packet.tick, payload)
+            if header is not None:
+                packet.tick = header.tick  # The header is authoritative
+        return packet
+
+    def _schedule_dispatch(self):
+        """
+        Handle the received packets once control returns to the event loop,
+        unless it is already scheduled.
+        """
+        if not self._dispatching:
+            self._dispatching = True
+            self._loop.call_soon(self._dispatch)
+
+    def _outgoing_drained(self):
+        """
+        Callback called when all the outgoing packets have been written. It
+        can be overridden to produce packets only once the socket is ready.
+        """
+        pass
 
     def _dispatch(self):
         """
-        Callback called when a packet event is fired.
+        Callback called when the received packets should be handled.
         """
+        self._dispatching = False
         while self._incoming:
-            packet = self._incoming.popleft()
-            self._logger.debug("Received packet: %s" % packet)
+            self._dispatch_packet(self._incoming.popleft())
 
-            # Notify for replies
-            if isinstance(packet, Reply):
-                packet.trigger_callback()
+    def _dispatch_packet(self, packet):
+        """
+        Handle a single packet that was received.
+
+        :param packet: the packet
+        """
+        self._logger.debug("Received packet: %s" % packet)
+
+        # Notify for replies
+        if isinstance(packet, Reply):
+            packet.trigger_callback()
 
-            # Otherwise forward to the subclass
-            elif not self.recv_packet(packet):
-                self._logger.warning("Unhandled packet received: %s" % packet)
+        # Otherwise forward to the subclass
+        elif not self.recv_packet(packet):
+            self._logger.warning("Unhandled packet received: %s" % packet)
 
     def send_packet(self, packet):
         """
@@ -302,8 +438,7 @@ class ClientSocket(QObject):
 
         # Enqueue the packet
         self._outgoing.append(packet)
-        if not self._write_notifier.isEnabled():
-            self._write_notifier.setEnabled(True)
+        self._set_writing(True)
 
         # Queries return a packet deferred
         if isinstance(packet, Query):
@@ -322,9 +457,9 @@ class ClientSocket(QObject):
         raise NotImplementedError("recv_packet() not implemented")
 
 
-class ServerSocket(QObject):
+class ServerSocket(object):
     """
-    A class wrapping a server socket and integrated into the Qt event loop.
+    A class wrapping a server socket and integrated into the event loop.
     """
 
     def __init__(self, logger, parent=None):
@@ -332,12 +467,23 @@ class ServerSocket(QObject):
         Initialize the server socket.
 
         :param logger: the logger to use
+        :param parent: the parent object, if any
         """
-        QObject.__init__(self, parent)
+        super(ServerSocket, self).__init__()
+        self._parent = parent
         self._logger = logger
+        self._loop = get_loop()
         self._socket = None
+        self._fileno = None
         self._connected = False
-        self._accept_notifier = None
+
+    def parent(self):
+        """
+        Get the parent object, if any.
+
+        :return: the parent
+        """
+        return self._parent
 
     @property
     def connected(self):
@@ -354,10 +500,8 @@ class ServerSocket(QObject):
 
         :param sock: the socket
         """
-        self._accept_notifier = QSocketNotifier(sock.fileno(),
-                                                QSocketNotifier.Read, self)
-        self._accept_notifier.activated.connect(self._notify_accept)
-        self._accept_notifier.setEnabled(True)
+        self._fileno = sock.fileno()
+        self._loop.add_reader(self._fileno, self._notify_accept)
 
         self._socket = sock
         self._connected = True
@@ -373,7 +517,7 @@ class ServerSocket(QObject):
         if err:
             self._logger.warning("Connection lost")
             self._logger.exception(err)
-        self._accept_notifier.setEnabled(False)
+        self._loop.forget(self._fileno)
         try:
             self._socket.close()
         except socket.error:
@@ -0,0 +1,315 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+import bisect
+import hashlib
+import json
+import os
+import re
+import sys
+import threading
+import zlib
+
+from .compression import ZLIB, compress
+
+# The databases are split into chunks whose boundaries are placed right
+# after the occurrences of an anchor, so that they only depend on the
+# content and are found again after some data was inserted or removed. This
+# is how a rolling hash would behave, but the anchors are searched by the
+# interpreter at native speed. The anchor must never change, otherwise the
+# chunks already stored would no longer be reused.
+CHUNK_ANCHOR = b'\x9e\x37'
+MIN_CHUNK_SIZE = 16 * 1024
+MAX_CHUNK_SIZE = 256 * 1024
+READ_SIZE = 4 * 1024 * 1024
+
+DIGEST_RE = re.compile(r'^[0-9a-f]{40}$')
+
+
+def replace_file(src, dst):
+    """
+    Atomically replace a file by another one, so that a reader sees either
+    the old or the new file, and never a missing or partial one.
+
+    :param src: the path of the new file
+    :param dst: the path of the file to replace
+    """
+    if hasattr(os, 'replace'):
+        os.replace(src, dst)
+    elif sys.platform == 'win32':
+        # Python 2 can't rename over an existing file on Windows
+        import ctypes
+        MOVEFILE_REPLACE_EXISTING = 0x1
+        if not ctypes.windll.kernel32.MoveFileExW(
+                u'%s' % src, u'%s' % dst, MOVEFILE_REPLACE_EXISTING):
+            raise ctypes.WinError()
+    else:
+        os.rename(src, dst)
+
+
+def chunk_digest(data):
+    """
+    Get the digest used to address a chunk.
+
+    :param data: the content of the chunk
+    :return: the hexadecimal digest
+    """
+    return hashlib.sha1(data).hexdigest()
+
+
+def chunk_file(path):
+    """
+    Split a file into content-defined chunks, reading it only once.
+
+    :param path: the path of the file
+    :return: a generator of (digest, offset, size) tuples
+    """
+    buf = bytearray()
+    base, start, eof = 0, 0, False
+    with open(path, 'rb') as inputFile:
+        while True:
+            # Make sure the buffer holds a whole chunk, if possible
+            if not eof and len(buf) - start < MAX_CHUNK_SIZE:
+                del buf[:start]
+                base, start = base + start, 0
+                data = inputFile.read(READ_SIZE)
+                buf.extend(data)
+                eof = not data
+                continue
+            if start == len(buf):
+                break
+
+            pos = buf.find(CHUNK_ANCHOR, start + MIN_CHUNK_SIZE,
+                           start + MAX_CHUNK_SIZE)
+            if pos >= 0:
+                end = pos + len(CHUNK_ANCHOR)
+            else:
+                end = min(start + MAX_CHUNK_SIZE, len(buf))
+            yield chunk_digest(buf[start:end]), base + start, end - start
+            start = end
+
+
+class ChunkStore(object):
+    """
+    The storage of the chunks of the databases of a repository. The chunks
+    are addressed by their digest and stored compressed, so that a chunk
+    shared by several databases is only stored once.
+    """
+
+    def __init__(self, path):
+        """
+        Initialize the chunk store.
+
+        :param path: the path of the directory
+        """
+        super(ChunkStore, self).__init__()
+        self._path = path
+
+    def chunk_path(self, digest):
+        """
+        Get the path of the file storing a chunk.
+
+        :param digest: the digest of the chunk
+        :return: the path
+        """
+        if not DIGEST_RE.match(digest):
+            raise ValueError("Invalid chunk digest: %s" % digest)
+        return os.path.join(self._path, digest[:2], digest)
+
+    def has_chunk(self, digest):
+        """
+        Check if a chunk is stored. A chunk with an invalid digest never is.
+
+        :param digest: the digest of the chunk
+        :return: is the chunk stored
+        """
+        if not DIGEST_RE.match(digest):
+            return False
+        return os.path.isfile(self.chunk_path(digest))
+
+    def keep_chunk(self, digest):
+        """
+        Check if a chunk is stored, and if it is, mark it as recently used,
+        so that it isn't collected before the upload referencing it is done.
+
+        :param digest: the digest of the chunk
+        :return: is the chunk stored
+        """
+        if not DIGEST_RE.match(digest):
+            return False
+        try:
+            os.utime(self.chunk_path(digest), None)
+        except OSError:
+            return False
+        return True
+
+    def collect_chunks(self, digests, deadline):
+        """
+        Remove the chunks that aren't referenced, unless they were stored
+        or used since the deadline, as an upload might reference them. The
+        partial files older than the deadline are removed too.
+
+        :param digests: the digests of the referenced chunks
+        :param deadline: the time of the deadline
+        :return: the number of chunks removed
+        """
+        count = 0
+        if not os.path.isdir(self._path):
+            return count
+        for dirName in os.listdir(self._path):
+            dirPath = os.path.join(self._path, dirName)
+            if not os.path.isdir(dirPath):
+                continue
+            for fileName in os.listdir(dirPath):
+                if fileName in digests:
+                    continue
+                isChunk = DIGEST_RE.match(fileName) is not None
+                if not isChunk and not fileName.endswith('.part'):
+                    continue
+                path = os.path.join(dirPath, fileName)
+                try:
+                    if os.path.getmtime(path) < deadline:
+                        os.remove(path)
+                        count += isChunk
+                except OSError:
+                    pass  # Removed meanwhile
+        return count
+
+    def put_chunk(self, digest, data, compression=None):
+        """
+        Store a chunk, after checking its content matches its digest.
+
+        :param digest: the digest of the chunk
+        :param data: the content of the chunk
+        :param compression: the compression of the content
+        :return: was the chunk stored
+        """
+        try:
+            raw = zlib.decompress(data) if compression == ZLIB else data
+        except zlib.error:
+            return False
+        if chunk_digest(raw) != digest:
+            return False
+        if compression != ZLIB:
+            data = compress(raw)
+
+        # The chunks are stored from several threads, possibly the same one
+        # by different clients, so each thread writes its own partial file
+        path = self.chunk_path(digest)
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError:
+            if not os.path.isdir(os.path.dirname(path)):
+                raise
+        partPath = '%s.%d.part' % (path, threading.current_thread().ident)
+        with open(partPath, 'wb') as outputFile:
+            outputFile.write(data)
+        replace_file(partPath, path)
+        return True
+
+
+class Manifest(object):
+    """
+    The list of chunks making up a database. The stored form of a database
+    is the concatenation of the compressed chunks, which is a sequence of
+    zlib streams.
+    """
+
+    def __init__(self, store, chunks):
+        """
+        Initialize the manifest.
+
+        :param store: the chunk store
+        :param chunks: a list of (digest, size, stored size) tuples
+        """
+        super(Manifest, self).__init__()
+        self._store = store
+        self._chunks = chunks
+
+        # The offsets of the chunks in the stored form, so that reading a
+        # range doesn't go through all the chunks before it
+        self._offsets = []
+        offset = 0
+        for chunk in chunks:
+            self._offsets.append(offset)
+            offset += chunk[2]
+        self._storedSize = offset
+
+    @staticmethod
+    def load(store, path):
+        """
+        Load a manifest from a file.
+
+        :param store: the chunk store
+        :param path: the path of the file
+        :return: the manifest
+        """
+        with open(path, 'r') as inputFile:
+            return Manifest(store, [tuple(chunk) for chunk
+                                    in json.load(inputFile)['chunks']])
+
+    def save(self, path):
+        """
+        Save the manifest to a file.
+
+        :param path: the path of the file
+        """
+        partPath = '%s.%d.part' % (path, threading.current_thread().ident)
+        with open(partPath, 'w') as outputFile:
+            json.dump({'chunks': self._chunks}, outputFile)
+        replace_file(partPath, path)
+
+    @property
+    def digests(self):
+        """
+        Get the digests of the chunks.
+
+        :return: the digests
+        """
+        return [chunk[0] for chunk in self._chunks]
+
+    @property
+    def stored_size(self):
+        """
+        Get the size of the stored form of the database.
+
+        :return: the size
+        """
+        return self._storedSize
+
+    def read(self, offset, size=None):
+        """
+        Read a range of the stored form of the database.
+
+        :param offset: the offset of the range
+        :param size: the size of the range, or None until the end
+        :return: the data
+        """
+        data = []
+        # Start from the chunk containing the offset
+        index = max(bisect.bisect_right(self._offsets, offset) - 1, 0)
+        if index < len(self._offsets):
+            offset -= self._offsets[index]
+        while index < len(self._chunks):
+            if size is not None and size <= 0:
+                break
+            digest, _, storedSize = self._chunks[index]
+            if offset >= storedSize:
+                break
+            index += 1
+            with open(self._store.chunk_path(digest), 'rb') as inputFile:
+                inputFile.seek(offset)
+                data.append(inputFile.read(-1 if size is None else size))
+            offset = 0
+            if size is not None:
+                size -= len(data[-1])
+        return b''.join(data)
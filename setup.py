@@ -7,9 +7,6 @@ setup(name='idarling',
       description='Collaborative Reverse Engineering plugin for IDA Pro',
       url='https://github.com/IDArlingTeam/IDArling',
       packages=find_packages(),
-      install_requires=[
-          "PyQt5; python_version >= '3.0'"
-      ],
       include_package_data=True,
       entry_points={
           "idapython_plugins": [
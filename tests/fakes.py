@@ -0,0 +1,152 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+Stand-ins for the modules of IDA and PyQt5, so that the modules of the
+plugin can be imported and tested outside of IDA.
+"""
+import sys
+import types
+
+
+class Stub(object):
+    """
+    The default attribute of the fake modules. It can be called, used as a
+    base class, and its instances do nothing.
+    """
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: 0
+
+
+class FakeModule(types.ModuleType):
+    """
+    A module whose missing attributes are stubs, unless they are listed
+    as missing, like the functions not available in some versions of IDA.
+    """
+
+    def __init__(self, name):
+        types.ModuleType.__init__(self, name)
+        self.missing = set()
+
+    def __getattr__(self, name):
+        if name.startswith('__') or name in self.missing:
+            raise AttributeError(name)
+        return Stub
+
+
+class Signal(object):
+    """
+    A stand-in for the signals of Qt.
+    """
+
+    def __init__(self):
+        self._slots = []
+
+    def connect(self, slot):
+        self._slots.append(slot)
+
+    def emit(self, *args):
+        for slot in self._slots:
+            slot(*args)
+
+
+class FakeTimer(object):
+    """
+    A stand-in for QTimer. The timers never fire on their own, the tests
+    fire them, and the single shot calls are run by run_pending().
+    """
+    pending = []
+
+    def __init__(self, parent=None):
+        self.timeout = Signal()
+        self._active = False
+        self._singleShot = False
+        self._interval = 0
+
+    def setSingleShot(self, singleShot):
+        self._singleShot = singleShot
+
+    def setInterval(self, interval):
+        self._interval = interval
+
+    def start(self, interval=None):
+        self._active = True
+
+    def stop(self):
+        self._active = False
+
+    def isActive(self):
+        return self._active
+
+    def fire(self):
+        if self._singleShot:
+            self._active = False
+        self.timeout.emit()
+
+    @staticmethod
+    def singleShot(interval, func):
+        FakeTimer.pending.append(func)
+
+    @staticmethod
+    def run_pending():
+        """
+        Run the single shot calls, including the ones they schedule.
+        """
+        while FakeTimer.pending:
+            FakeTimer.pending.pop(0)()
+
+
+class FakeNetnode(object):
+    """
+    A stand-in for the netnodes of IDA, counting the values written.
+    """
+    nodes = {}
+    writes = 0
+
+    def __init__(self, name, namelen=0, do_create=False):
+        self._values = FakeNetnode.nodes.setdefault(name, {})
+
+    def hashval(self, key):
+        return self._values.get(key)
+
+    def hashset(self, key, value):
+        FakeNetnode.writes += 1
+        self._values[key] = value
+
+    def hashdel(self, key):
+        self._values.pop(key, None)
+
+
+IDA_MODULES = ['ida_bytes', 'ida_diskio', 'ida_enum', 'ida_funcs',
+               'ida_hexrays', 'ida_idaapi', 'ida_idp', 'ida_kernwin',
+               'ida_lines', 'ida_loader', 'ida_nalt', 'ida_name',
+               'ida_netnode', 'ida_pro', 'ida_range', 'ida_segment',
+               'ida_struct', 'ida_typeinf', 'ida_ua', 'idaapi']
+
+
+def install():
+    """
+    Install the fake modules, unless the real ones are already imported.
+    """
+    for name in IDA_MODULES:
+        sys.modules.setdefault(name, FakeModule(name))
+    if 'PyQt5' not in sys.modules:
+        qtCore = FakeModule('PyQt5.QtCore')
+        qtCore.QTimer = FakeTimer
+        pyQt5 = FakeModule('PyQt5')
+        pyQt5.QtCore = qtCore
+        sys.modules['PyQt5'] = pyQt5
+        sys.modules['PyQt5.QtCore'] = qtCore
@@ -0,0 +1,78 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+import pytest
+
+import ida_netnode
+
+from fakes import FakeNetnode
+
+from idarling.core.core import Core
+
+
+@pytest.fixture
+def core(monkeypatch):
+    """
+    An installed core module, subscribed to a branch, using fake netnodes.
+    """
+    monkeypatch.setattr(ida_netnode, 'netnode', FakeNetnode, raising=False)
+    monkeypatch.setattr(FakeNetnode, 'nodes', {})
+    monkeypatch.setattr(FakeNetnode, 'writes', 0)
+    core = Core(mock.Mock())
+    core.install()
+    core.repo = 'repo'
+    core.branch = 'branch'
+    return core
+
+
+def saved_tick():
+    return FakeNetnode.nodes[Core.NETNODE_NAME].get('tick')
+
+
+def test_tick_is_saved_behind_timer(core):
+    writes = FakeNetnode.writes
+    for tick in range(1, 101):
+        core.tick = tick
+    assert FakeNetnode.writes == writes
+    assert core._tickTimer.isActive()
+
+    core._tickTimer.fire()
+    assert saved_tick() == '100'
+    assert not core._tickTimer.isActive()
+
+
+def test_tick_is_saved_before_saving(core):
+    core.tick = 42
+    core._uiHooksCore.saving()
+    assert saved_tick() == '42'
+    assert not core._tickTimer.isActive()
+
+
+def test_tick_is_saved_on_closebase(core):
+    core.tick = 42
+    core._idbHooksCore.closebase()
+    assert saved_tick() == '42'
+    assert core.tick == 0
+    assert core.repo is None and core.branch is None
+    assert not core._tickTimer.isActive()
+
+
+def test_tick_is_saved_on_uninstall(core):
+    core.tick = 42
+    core.uninstall()
+    assert saved_tick() == '42'
+    assert not core._tickTimer.isActive()
@@ -0,0 +1,139 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+import pytest
+
+import ida_funcs
+import ida_hexrays
+import ida_kernwin
+
+from fakes import FakeTimer
+
+from idarling.core.events import (HexRaysEvent, UserIflagsEvent,
+                                  UserLabelsEvent)
+from idarling.core.hooks import HexRaysHooks
+
+
+class View(object):
+    """
+    A pseudocode view showing a function, counting its refreshes.
+    """
+
+    def __init__(self, ea):
+        self.cfunc = mock.Mock(entry_ea=ea)
+        self.refresh_view = mock.Mock()
+
+
+@pytest.fixture
+def hexrays(monkeypatch):
+    """
+    Mock the functions of Hex-Rays used by the events, with two views
+    showing the functions at 0x1000 and 0x2000.
+    """
+    views = {'Pseudocode-A': View(0x1000), 'Pseudocode-B': View(0x2000)}
+    monkeypatch.setattr(ida_kernwin, 'find_widget', views.get,
+                        raising=False)
+    monkeypatch.setattr(ida_hexrays, 'get_widget_vdui', lambda view: view,
+                        raising=False)
+    for name in ('decompile', 'mark_cfunc_dirty', 'save_user_iflags'):
+        monkeypatch.setattr(ida_hexrays, name, mock.Mock(), raising=False)
+    monkeypatch.setattr(ida_hexrays, 'missing', set())
+    monkeypatch.setattr(HexRaysEvent, 'applied_funcs', set())
+    monkeypatch.setattr(HexRaysEvent, 'applied_all', False)
+    monkeypatch.setattr(UserIflagsEvent, '_pending_iflags', {})
+    HexRaysEvent._pending_funcs.clear()
+    del FakeTimer.pending[:]
+    return views
+
+
+def test_refreshes_are_deferred_and_deduplicated(hexrays):
+    funcs = [0x1000, 0x2000, 0x3000]
+    for i in range(60):
+        ea = funcs[i % 3]
+        if i % 2:
+            UserIflagsEvent(ea, [((ea + i, 0), i)])()
+        else:
+            UserLabelsEvent(ea, [])()
+    assert not ida_hexrays.decompile.called
+    assert not hexrays['Pseudocode-A'].refresh_view.called
+
+    FakeTimer.run_pending()
+    # Every view is refreshed once, and every function decompiled once
+    assert hexrays['Pseudocode-A'].refresh_view.call_count == 1
+    assert hexrays['Pseudocode-B'].refresh_view.call_count == 1
+    assert ida_hexrays.decompile.call_count == 3
+    assert ida_hexrays.mark_cfunc_dirty.call_count == 3
+
+    # Only the last flags of a function are set
+    cfunc = ida_hexrays.decompile.return_value
+    assert cfunc.set_user_iflags.call_count == 3
+    assert cfunc.save_user_iflags.call_count == 3
+
+
+def test_decompile_without_mark_cfunc_dirty(hexrays, monkeypatch):
+    monkeypatch.delattr(ida_hexrays, 'mark_cfunc_dirty')
+    ida_hexrays.missing.add('mark_cfunc_dirty')
+    UserIflagsEvent(0x1000, [((0x1004, 0), 1)])()
+    FakeTimer.run_pending()
+    ida_hexrays.decompile.assert_called_once_with(
+        0x1000, None, ida_hexrays.DECOMP_NO_CACHE)
+    assert hexrays['Pseudocode-A'].refresh_view.call_count == 1
+
+
+def test_applied_user_data_is_not_sent_back(hexrays, monkeypatch):
+    monkeypatch.setattr(ida_kernwin, 'get_screen_ea', lambda: 0x1004,
+                        raising=False)
+    monkeypatch.setattr(ida_funcs, 'get_func',
+                        lambda ea: mock.Mock(startEA=0x1000), raising=False)
+    labels = {0x1000: []}
+    plugin = mock.Mock()
+    hooks = HexRaysHooks(plugin)
+    hooks._installed = True
+    hooks._user_data = [('labels', labels.get, UserLabelsEvent)]
+
+    def print_func():
+        hooks._hxe_callback(ida_hexrays.hxe_func_printed)
+
+    # The first printing only records the user data
+    print_func()
+    assert not plugin.core.send_event.called
+
+    # The user data set by a remote event is not sent back
+    labels[0x1000] = [(1, 'remote')]
+    UserLabelsEvent(0x1000, labels[0x1000])
+    HexRaysEvent.refresh_pseudocode_view(0x1000)
+    print_func()
+    assert not plugin.core.send_event.called
+    assert not HexRaysEvent.applied_funcs
+
+    # The one changed by the user is
+    labels[0x1000] = [(1, 'local')]
+    print_func()
+    assert plugin.core.send_event.call_count == 1
+
+
+def test_applied_funcs_are_bounded(hexrays):
+    hooks = HexRaysHooks(mock.Mock())
+    hooks._funcs[0x1000] = {}
+    for ea in range(HexRaysEvent.APPLIED_FUNCS_SIZE + 1):
+        HexRaysEvent.refresh_pseudocode_view(0x10000 + ea)
+    assert HexRaysEvent.applied_all
+    assert len(HexRaysEvent.applied_funcs) <= HexRaysEvent.APPLIED_FUNCS_SIZE
+
+    hooks._forget_applied_funcs()
+    assert not hooks._funcs
+    assert not HexRaysEvent.applied_all